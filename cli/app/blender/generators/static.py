@@ -6,6 +6,7 @@ This is a Blender Python script
 import os
 import sys
 import time
+import random
 import importlib
 import logging
 import shlex
@@ -29,6 +30,14 @@ if '--' in sys.argv:
     help='Path to vframe_synthetic directory')
   parser.add_argument('--checkpoint', dest='opt_checkpoint', type=int, 
     help='Checkpoint to resume')
+  parser.add_argument('--end', dest='opt_end', type=int, default=None,
+    help='Last particle iteration, exclusive. Default is all iterations')
+  parser.add_argument('--progress', dest='opt_fp_progress', default=None,
+    help='Path to file updated with the next unrendered iteration')
+  parser.add_argument('--manifest', dest='opt_fp_manifest', default=None,
+    help='Path to render job manifest. Default plans jobs from config and seed')
+  parser.add_argument('--seed', dest='opt_seed', type=int, default=None,
+    help='Seed used to plan jobs if no manifest. Default is config "seed" or 0')
   parser.add_argument('--verbosity', dest='opt_verbosity', type=int, 
     default=4, help='Verbosity 1 - 4')
 
@@ -58,8 +67,9 @@ log.debug('it works!')
 
 import bpy
 
-from app.utils import file_utils, sys_utils
-from app.utils.file_utils import zpad
+from app.utils import file_utils, sys_utils, farm_utils
+from app.models import manifest as manifest_utils
+from app.models.manifest import RenderManifest
 from app.blender.operators.boss import Boss
 
 # logger
@@ -73,52 +83,125 @@ sigint = sys_utils.SignalInterrupt()
 log.info(f'Running: {os.path.basename(__file__)}')
 log.debug(f'Config : {args.opt_fp_cfg}')
 log.debug(f'Resume checkpoint: {args.opt_checkpoint}')
+log.debug(f'End iteration: {args.opt_end}')
 
 
 # init manager
 st = time.time()
-boss = Boss(args.opt_fp_cfg)
+# farm shards append to per shard files instead of the shared ones
+shard = farm_utils.shard_key(args.opt_fp_progress) if args.opt_fp_progress else None
+boss = Boss(args.opt_fp_cfg, shard=shard)
+
+# render jobs. All random draws are precomputed so resumes are exact
+if args.opt_fp_manifest:
+  manifest = RenderManifest.load(args.opt_fp_manifest)
+else:
+  cfg = file_utils.load_yml(args.opt_fp_cfg)
+  seed = args.opt_seed if args.opt_seed is not None else cfg.get('seed', 0)
+  manifest = RenderManifest.plan(cfg, seed=seed)
+log.debug(f'Render jobs: {len(manifest)}')
+
+# shard range
+idx_end = boss.object_system.iterations
+if args.opt_end is not None:
+  idx_end = min(args.opt_end, idx_end)
+n_skipped = 0
+
+# index masks come from the real render, no material swaps needed
+state = None
+if boss.render.index_mode:
+  boss.render.set_engine_real()
+  state = manifest_utils.STATE_REAL
+n_transitions = {'scheduled': 0, 'interleaved': 0}
+n_visibility = {'skipped': 0, 'rerolled': 0}
 
 # iterate data generate systems
-for particle_idx in trange(args.opt_checkpoint, boss.object_system.iterations, desc='Emitter'):
+for particle_idx in trange(args.opt_checkpoint or 0, idx_end, desc='Emitter'):
   if sigint.interrupted:
     sys.exit('Signal interrupted. Exiting.')
 
-  boss.object_system.randomize()
-  boss.object_system.make_real()
-
-  for cam_idx in trange(boss.camera.num_iterations, desc='Camera', leave=False):
-    if sigint_interrupt: break
-
-    boss.camera.set_cam_idx(cam_idx)
-
-    num_frames = boss.camera.num_view_frames(cam_idx)
-    for cam_rot_iter in trange(1, num_frames + 1, desc='Angle', leave=False):
-      if sigint_interrupt: break
-
-      boss.camera.set_rotation_idx(cam_rot_iter)
-      boss.camera.focus(jitter=True)
-
-      #boss.ground.randomize()
-      boss.world.randomize()
-
-      # real
-      fname = f'emitter_{zpad(particle_idx)}_cam_{zpad(cam_idx)}_{zpad(cam_rot_iter)}'
-      if boss.render.save_real:
-        if boss.render.save_mask:
-          boss.unmask()  # redundant
-        fp_out = boss.fileio.build_fp_out(f'real/{fname}')
-        boss.render.render(fp_out)
-
-      # masked
-      if boss.render.save_mask:
+  # skip jobs rendered by a previous run
+  jobs = manifest.jobs_for(particle_idx)
+  jobs_todo = [j for j in jobs if not j.is_complete(boss.fileio.fp_dir_out) \
+    or (j.annotate and not boss.fileio.is_annotated(j.fn_anno))]
+  n_skipped += len(jobs) - len(jobs_todo)
+
+  if jobs_todo:
+    # emitter randomization and duplicate colors are seeded per iteration
+    random.seed(jobs_todo[0].emitter_seed)
+    boss.object_system.randomize()
+    boss.object_system.make_real()
+    # drop frames with no trainable object in view before rendering
+    jobs_todo, counts = boss.filter_visible(jobs_todo)
+    for k, v in counts.items():
+      n_visibility[k] += v
+
+  # group real frames by environment, then render all masks in one masked state
+  steps = manifest_utils.schedule_steps(jobs_todo)
+  counts = manifest_utils.count_transitions(steps)
+  counts_base = manifest_utils.count_transitions(manifest_utils.interleaved_steps(jobs_todo))
+  n_transitions['scheduled'] += sum(counts.values())
+  n_transitions['interleaved'] += sum(counts_base.values())
+  log.debug(f'Iteration {particle_idx}: {counts} transitions, interleaved: {counts_base}')
+
+  env_idx = None
+  for step_state, job in tqdm(steps, desc='Frame', leave=False):
+    if sigint.interrupted: break
+
+    if step_state != state:
+      if step_state == manifest_utils.STATE_REAL:
+        boss.unmask()
+      else:
         boss.mask()
-        fp_out = boss.fileio.build_fp_out(f'mask/{fname}')
-        boss.render.render(fp_out)
+      state = step_state
 
-      dg = bpy.context.evaluated_depsgraph_get()
-      dg.update()
+    # camera offsets are precomputed, so mask frames repeat the real frame view
+    boss.camera.set_cam_idx(job.cam_idx)
+    boss.camera.set_rotation_idx(job.cam_rot)
+    boss.camera.focus(offset_location=job.jitter_location, offset_target=job.jitter_target)
 
+    if step_state == manifest_utils.STATE_REAL:
+      #boss.ground.randomize()
+      if job.env_idx >= 0 and job.env_idx != env_idx:
+        boss.world.set_environment(job.env_idx)
+        env_idx = job.env_idx
+      boss.world.set_rotation_deg(job.world_rot_deg)
+      # annotated before the render, a resumed job may already have its rows
+      if job.annotate == manifest_utils.ANNOTATE_GEOMETRY \
+        and not boss.fileio.is_annotated(job.fn_anno):
+        boss.annotate_geometry(job, jobs)
+      fp_index = os.path.join(boss.fileio.fp_dir_out, job.fp_index) if job.fp_index else None
+      boss.render.render(os.path.join(boss.fileio.fp_dir_out, job.fp_real), fp_index=fp_index)
+      boss.fileio.append_quality(job.fp_real, boss.render.update_budget())
+    else:
+      # masks can be annotated in memory without writing the image
+      fp_mask = os.path.join(boss.fileio.fp_dir_out, job.fp_mask) if job.fp_mask else None
+      boss.render.render(fp_mask)
+      if job.annotate:
+        boss.annotate(job, jobs)
+
+    dg = bpy.context.evaluated_depsgraph_get()
+    dg.update()
+
+  if jobs_todo:
+    boss.object_system.unmask()
+    boss.object_system.clear_real()
+    # engine, world and ground stay masked, so the next iteration's duplicates
+    # must be masked again even if it starts with a mask step
+    if state == manifest_utils.STATE_MASK:
+      state = None
 
-  boss.object_system.unmask()
-  boss.object_system.clear_real()
\ No newline at end of file
+  if sigint.interrupted:
+    break
+
+  # mark iteration complete for farm restarts
+  if args.opt_fp_progress:
+    farm_utils.write_progress(args.opt_fp_progress, particle_idx + 1)
+
+if n_skipped:
+  log.info(f'Skipped {n_skipped} jobs with existing outputs')
+if boss.camera.visibility_check:
+  log.info(f'Frames without trainable objects in view: {n_visibility["skipped"]} skipped, '
+    f'{n_visibility["rerolled"]} re-rolled')
+n_avoided = n_transitions['interleaved'] - n_transitions['scheduled']
+log.info(f'Scene state transitions: {n_transitions["scheduled"]}, avoided: {n_avoided}')
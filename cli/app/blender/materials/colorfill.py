@@ -23,6 +23,10 @@ class ColorFillObject:
   NODE_TYPE_LIGHT_PATH = 'ShaderNodeLightPath'
   NODE_TYPE_EMISSION = 'ShaderNodeEmission'
   NODE_TYPE_MIX = 'ShaderNodeMixShader'
+  NODE_TYPE_PARTICLE_INFO = 'ShaderNodeParticleInfo'
+  NODE_TYPE_OBJECT_INFO = 'ShaderNodeObjectInfo'
+  NODE_TYPE_MATH = 'ShaderNodeMath'
+  NODE_TYPE_MIX_RGB = 'ShaderNodeMixRGB'
   NODE_TYPE_MAT_OUT = 'ShaderNodeOutputMaterial'
   NODE_TYPE_IS_CAM_RAY = 'Is Camera Ray'
   NODE_TYPE_FAC = 'Fac'
@@ -35,6 +39,8 @@ class ColorFillObject:
   LABEL_BG = 'Background'
   LABEL_RGB = 'RGB'
   LABEL_BSDF = 'BSDF'
+  LABEL_INDEX = 'Index'
+  LABEL_VALUE = 'Value'
   
   nodes = None
   links = None
@@ -67,6 +73,8 @@ class ColorFillWorld(ColorFillObject):
     new_material_name = list(set(new_materials) - set(existing_materials))[0]
     new_material = bpy.data.worlds.get(new_material_name)
     new_material.name = name
+    # Workbench renders the world viewport color
+    new_material.color = color[:3]
 
     super().__init__(new_material)
     
@@ -86,10 +94,15 @@ class ColorFillWorld(ColorFillObject):
 
 class ColorFillMaterial(ColorFillObject):
 
-  def __init__(self, name, color, alpha_image=None):
+  def __init__(self, name, color, alpha_image=None, shades=None, object_color=False):
     """Creates a Color Shader material object
     :param name: (str) name of material
     :param color: (rgb) float rgb (1.0, 0, 0, 1)
+    :param shades: (int) if set, shades the color per particle instance by
+      value 1 - (index % shades) / shades, matching create_shaded_range_rgba
+      for full value colors. Particle Info is only available in Cycles
+    :param object_color: (bool) if True, fills with the color property of each
+      object using this material (Object Info) instead of a fixed color
     """
     
     new_material = bpy.data.materials.new(name=name)
@@ -122,8 +135,20 @@ class ColorFillMaterial(ColorFillObject):
     else:
       self.links.new(node_im_light.outputs[self.NODE_TYPE_IS_CAM_RAY], node_mix.inputs[self.NODE_TYPE_FAC])
 
-    # link RGB to Emission
-    self.links.new(node_rgb.outputs[self.LABEL_COLOR], node_emission.inputs[self.LABEL_COLOR])
+    # link RGB to Emission, shaded by particle index for instanced particles
+    if object_color:
+      node_info = self.nodes.new(self.NODE_TYPE_OBJECT_INFO)
+      self.links.new(node_info.outputs[self.LABEL_COLOR], node_emission.inputs[self.LABEL_COLOR])
+    elif shades:
+      node_shade = self.add_instance_shade(shades)
+      node_multiply = self.nodes.new(self.NODE_TYPE_MIX_RGB)
+      node_multiply.blend_type = 'MULTIPLY'
+      node_multiply.inputs[self.NODE_TYPE_FAC].default_value = 1.0
+      self.links.new(node_rgb.outputs[self.LABEL_COLOR], node_multiply.inputs[1])
+      self.links.new(node_shade.outputs[self.LABEL_VALUE], node_multiply.inputs[2])
+      self.links.new(node_multiply.outputs[self.LABEL_COLOR], node_emission.inputs[self.LABEL_COLOR])
+    else:
+      self.links.new(node_rgb.outputs[self.LABEL_COLOR], node_emission.inputs[self.LABEL_COLOR])
 
     # link Emission to MixShader
     #self.links.new(node_emission.outputs[self.LABEL_EMISSION], node_mix.inputs[1])  # Shader 1 and
@@ -144,4 +169,27 @@ class ColorFillMaterial(ColorFillObject):
       mat.blend_method = 'CLIP'
       mat.shadow_method = 'CLIP'
 
+
+  def add_math(self, operation, a, b):
+    """Adds a Math node. Inputs are node outputs or float values"""
+    node = self.nodes.new(self.NODE_TYPE_MATH)
+    node.operation = operation
+    for idx, x in enumerate((a, b)):
+      if isinstance(x, (int, float)):
+        node.inputs[idx].default_value = x
+      else:
+        self.links.new(x, node.inputs[idx])
+    return node
+
+
+  def add_instance_shade(self, shades):
+    """Adds nodes computing the shade value of a particle instance
+    :param shades: (int) number of shades
+    :returns Math node with the shade value output
+    """
+    node_info = self.nodes.new(self.NODE_TYPE_PARTICLE_INFO)
+    node_mod = self.add_math('MODULO', node_info.outputs[self.LABEL_INDEX], float(shades))
+    node_div = self.add_math('DIVIDE', node_mod.outputs[self.LABEL_VALUE], float(shades))
+    return self.add_math('SUBTRACT', 1.0, node_div.outputs[self.LABEL_VALUE])
+
   
\ No newline at end of file
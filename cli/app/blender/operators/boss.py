@@ -1,16 +1,22 @@
 import sys
 import importlib
+from pathlib import Path
+import random
 import time
 
+import numpy as np
+
 sys.path.append('/work/vframe_synthetic/vframe_synthetic')
 # ----------------------------------------------------------------------
 # It's necessary to reload imports when running interactively
 # because Blender holds Python modules in memory
 from app.blender import operators as ops
 importlib.reload(ops)
-from app.utils import file_utils, log_utils  # reload
+from app.utils import file_utils, log_utils, anno_utils, color_utils  # reload
 importlib.reload(file_utils)
 importlib.reload(log_utils)
+importlib.reload(anno_utils)
+from app.models.bbox import BBoxNorm
 
 # Create logger
 log_utils.Logger.create()
@@ -19,19 +25,35 @@ log = log_utils.Logger.getLogger()
 
 class Boss:
 
-  def __init__(self, fp_cfg):
+  def __init__(self, fp_cfg, shard=None):
     
     cfg = file_utils.load_yml(fp_cfg)
 
     self.prefs = ops.preferences.PreferenceManager(cfg)
     self.render = ops.render.RenderManager(cfg)
-    self.fileio = ops.fileio.FileIOManager(cfg)
+    self.fileio = ops.fileio.FileIOManager(cfg, shard=shard)
     self.camera = ops.camera.CameraManager(cfg)
     self.world = ops.world.WorldManager(cfg)
     self.ground = ops.ground.GroundManager(cfg)
     #self.object_system = ops.static_system.StaticSystem(cfg)
     self.object_system = ops.particle_system.ParticleSystemManager(cfg)
-    self.fileio.annos_to_csv(self.object_system.get_annotation_meta())
+    anno_meta = self.object_system.get_annotation_meta()
+    self.fileio.annos_to_csv(anno_meta, mask_scale=self.render.mask_scale)
+
+    # annotations use the metadata color table, in RGB order
+    if self.render.annotate_mode:
+      cfg_annotate = cfg.get('render').get('annotate')
+      cfg_annotate = cfg_annotate if isinstance(cfg_annotate, dict) else {}
+      colors_rgb = [(o['color_r'], o['color_g'], o['color_b']) for o in anno_meta]
+      self.anno_lut = anno_utils.build_color_lut(colors_rgb)
+      self.anno_objects = [(o['label'], o['label_index'],
+        f'0x{color_utils.rgb_int_to_hex(rgb)}') for o, rgb in zip(anno_meta, colors_rgb)]
+      self.anno_min_pixels = int(cfg_annotate.get('min_pixels', 40))
+      self.anno_instances = bool(cfg_annotate.get('instances', False))
+      # geometry mode: coarse depth buffer to drop objects hidden by other trainable objects
+      grid = cfg_annotate.get('occlusion_grid')
+      self.anno_occlusion_grid = tuple(grid) if grid else None
+      self.anno_min_visible = float(cfg_annotate.get('min_visible', 0.0))
 
 
   def unmask(self):
@@ -48,6 +70,103 @@ class Boss:
     self.object_system.mask()
 
 
+  def filter_visible(self, jobs):
+    """Drops or re-rolls the camera jitter of jobs where no trainable object
+    covers camera.visibility.min_area of the image. Call after make_real
+    :param jobs: list of RenderJob, re-rolled jobs are updated in place
+    :returns (list, dict) visible jobs and "skipped" and "rerolled" counts
+    """
+    counts = {'skipped': 0, 'rerolled': 0}
+    if not self.camera.visibility_check:
+      return jobs, counts
+    corners = self.object_system.trainable_corners()
+    jobs_visible = []
+    # background variants share the camera pose and decision of their first job
+    poses = {}
+    for job in jobs:
+      pose = (job.cam_idx, job.cam_rot)
+      if pose not in poses:
+        poses[pose] = self.check_visible(job, corners)
+      visible, loc, target = poses[pose]
+      if visible and loc is not None:
+        job.jitter_loc_x, job.jitter_loc_y, job.jitter_loc_z = loc
+        job.jitter_target_x, job.jitter_target_y, job.jitter_target_z = target
+        counts['rerolled'] += 1
+      if visible:
+        jobs_visible.append(job)
+      else:
+        counts['skipped'] += 1
+    return jobs_visible, counts
+
+
+  def check_visible(self, job, corners):
+    """Checks the camera pose of a job, re-rolling its jitter if configured
+    :param job: RenderJob
+    :param corners: (numpy) (n, 8, 3) trainable bounding box corners
+    :returns (bool, list, list) visible, and re-rolled location and target
+      offsets or None if the job's offsets are kept
+    """
+    self.camera.set_cam_idx(job.cam_idx)
+    self.camera.set_rotation_idx(job.cam_rot)
+    self.camera.focus(offset_location=job.jitter_location, offset_target=job.jitter_target)
+    if self.camera.visible_area(corners) >= self.camera.visibility_min_area:
+      return True, None, None
+    if self.camera.visibility_action == 'reroll':
+      # seeded per pose so resumed runs and variants re-roll the same offsets
+      rng = random.Random(f'{job.emitter_seed}-{job.particle_idx}-{job.cam_idx}-{job.cam_rot}')
+      for _ in range(self.camera.visibility_retries):
+        loc, target = self.camera.random_offsets(job.cam_idx, rng)
+        self.camera.focus(offset_location=loc, offset_target=target)
+        if self.camera.visible_area(corners) >= self.camera.visibility_min_area:
+          return True, loc, target
+    return False, None, None
+
+
+  def pose_filenames(self, job, jobs):
+    """Returns the real image filenames of the camera pose of a job"""
+    pose = (job.cam_idx, job.cam_rot)
+    return [Path(j.fp_real).name for j in jobs \
+      if j.fp_real and (j.cam_idx, j.cam_rot) == pose] or [job.fn_anno]
+
+
+  def annotate(self, job, jobs):
+    """Annotates the last mask render from the render result and appends the boxes
+    for every real image of the camera pose
+    :param job: RenderJob of the mask render
+    :param jobs: list of RenderJob of the particle iteration
+    """
+    filenames = self.pose_filenames(job, jobs)
+    # same pixel threshold as mask_to_bbox on masks rendered at mask_scale
+    min_pixels = max(1, round(self.anno_min_pixels * self.render.mask_scale ** 2))
+    labels = anno_utils.color_mask_to_labels(self.render.read_viewer(), self.anno_lut)
+    annos = anno_utils.labels_to_annos(labels, self.anno_objects, filenames[0],
+      min_pixels, self.anno_instances)
+    self.fileio.append_annos(filenames, annos)
+
+
+  def annotate_geometry(self, job, jobs):
+    """Annotates the current camera pose by projecting the vertices of trainable
+    objects, without a mask render. Boxes are one per metadata color, like masks
+    :param job: RenderJob with the camera pose set
+    :param jobs: list of RenderJob of the particle iteration
+    """
+    filenames = self.pose_filenames(job, jobs)
+    points, ids = self.object_system.trainable_points()
+    boxes, in_view, visible = self.camera.frustum().project_boxes(points, ids,
+      len(self.anno_objects), grid=self.anno_occlusion_grid)
+    w, h = self.render.size_real
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) * w * h
+    keep = in_view & (areas > self.anno_min_pixels)
+    if visible is not None:
+      keep &= visible >= self.anno_min_visible
+    annos = []
+    for idx in np.flatnonzero(keep):
+      label, label_index, color_hex = self.anno_objects[idx]
+      bbox_norm = BBoxNorm(*map(float, boxes[idx]))
+      annos.append(bbox_norm.to_labeled(label, label_index, filenames[0]).to_colored(color_hex))
+    self.fileio.append_annos(filenames, annos)
+
+
   def cleanup(self):
     """Relays cleanup command to sub managers"""
     self.prefs.cleanup()
@@ -10,8 +10,15 @@ from dataclasses import dataclass
 import bpy
 
 sys.path.append('/work/vframe_synthetic/vframe_synthetic')
-from app.utils import log_utils
+from app.utils import log_utils, frustum_utils
+from app.models import manifest
 importlib.reload(log_utils)
+importlib.reload(frustum_utils)
+importlib.reload(manifest)
+
+# shortcuts
+CameraFrustum = frustum_utils.CameraFrustum
+draw_offset = manifest.draw_offset
 
 
 # ---------------------------------------------------------------------------
@@ -69,6 +76,11 @@ class CameraManager:
     self.camera_orig = self.scene.camera
     # camera views
     self._cam_views = [CameraView(**x) for x in cfg_cam.get('views', [])]
+    # pre-render check that trainable objects are in view
+    cfg_vis = cfg_cam.get('visibility') or {}
+    self.visibility_min_area = float(cfg_vis.get('min_area', 0))
+    self.visibility_action = cfg_vis.get('action', 'skip')
+    self.visibility_retries = int(cfg_vis.get('retries', 5))
     # create camera
     bpy.ops.object.camera_add()
     obj_cam_name = str(list(set(bpy.context.scene.objects.keys()) - set(self.scene_obj_names_orig))[0])
@@ -104,8 +116,12 @@ class CameraManager:
     self.set_camera_random()
     self.set_rotation_random()
 
-  def focus(self, jitter=False):
-    '''Sets current camera position'''
+  def focus(self, jitter=False, offset_location=None, offset_target=None):
+    '''Sets current camera position
+    :param jitter: (bool) randomly jitter location and target
+    :param offset_location: (list) precomputed XYZ location jitter, used instead of random jitter
+    :param offset_target: (list) precomputed XYZ target jitter, used instead of random jitter
+    '''
     self.cam_view = self._cam_views[self.cam_idx]
     self.set_lens_mm(self.cam_view.zoom)
     self.set_sensor_width(self.cam_view.sensor_width)
@@ -123,12 +139,46 @@ class CameraManager:
       x = self.cam_view.x_radius * math.cos((self.cur_cam_rot_iter / nframes) * 2 * math.pi)
       y = self.cam_view.y_radius * math.sin((self.cur_cam_rot_iter / nframes) * 2 * math.pi)
       #z = math.atan2(y, x) + math.pi / 2
-    self.set_location((x, y, z), jitter=jitter)
+    if offset_location is not None:
+      self.set_location([a + b for a, b in zip((x, y, z), offset_location)])
+    else:
+      self.set_location((x, y, z), jitter=jitter)
     # update rotation
     if self.cam_view.target_name:
-      self.look_at_target(self.cam_view.target_name, jitter=jitter)
+      self.look_at_target(self.cam_view.target_name, jitter=jitter, offset=offset_target)
     else:
-      self.look_at_xyz(self.cam_view.target_xyz, jitter=jitter)
+      self.look_at_xyz(self.cam_view.target_xyz, jitter=jitter, offset=offset_target)
+
+  def frustum(self):
+    '''Returns the projection of the current camera pose'''
+    render = self.scene.render
+    cam = self.obj_camera_new.data
+    return CameraFrustum(self.obj_camera_new.matrix_world, cam.lens, cam.sensor_width,
+      (render.resolution_x, render.resolution_y), shift=(cam.shift_x, cam.shift_y))
+
+
+  def visible_area(self, corners):
+    '''Returns the largest image fraction covered by any bounding box
+    :param corners: (numpy) (n, 8, 3) world space bounding box corners
+    '''
+    areas = self.frustum().projected_areas(corners)
+    return float(areas.max()) if len(areas) else 0.0
+
+
+  def random_offsets(self, cam_idx, rng):
+    '''Draws location and target jitter for a camera view
+    :param cam_idx: (int) camera view index
+    :param rng: random.Random
+    :returns (list, list) XYZ location and target offsets
+    '''
+    cam_view = self._cam_views[cam_idx]
+    return draw_offset(rng, cam_view.jitter_location), draw_offset(rng, cam_view.jitter_target)
+
+
+  @property
+  def visibility_check(self):
+    return self.visibility_min_area > 0
+
 
   def set_camera(self, camera):
     '''Sets the current scene camera'''
@@ -215,10 +265,12 @@ class CameraManager:
     return [random.uniform(_xyz - _delta, _xyz + _delta) for _xyz, _delta in zip(xyz, delta)]
 
   
-  def look_at_xyz(self, xyz, jitter=False):
+  def look_at_xyz(self, xyz, jitter=False, offset=None):
       '''Orients camera towards XYZ coords'''
       xyz_targ = mathutils.Vector(xyz)
-      if jitter:
+      if offset is not None:
+        xyz_targ = xyz_targ + mathutils.Vector(offset)
+      elif jitter:
         xyz_targ = self.jitter_xyz(xyz_targ, self.cam_view.jitter_target)
         xyz_targ = mathutils.Vector(xyz_targ)
       xyz_source = self.obj_camera_new.matrix_world.to_translation()
@@ -228,11 +280,13 @@ class CameraManager:
       self.set_rotation(rot_euler)
 
 
-  def look_at_target(self, target_name, jitter=False):
+  def look_at_target(self, target_name, jitter=False, offset=None):
       '''Orients camera towards target object'''
       #xyz_targ = target_obj.matrix_world.to_translation()
       xyz_targ = bpy.data.objects.get(target_name).location
-      if jitter:
+      if offset is not None:
+        xyz_targ = xyz_targ + mathutils.Vector(offset)
+      elif jitter:
         xyz_targ = self.jitter_xyz(xyz_targ, self.cam_view.jitter_target)
         xyz_targ = mathutils.Vector(xyz_targ)
       xyz_source = self.obj_camera_new.matrix_world.to_translation()
@@ -4,16 +4,21 @@ from pathlib import Path
 import importlib
 import math
 import random
+import csv
+from dataclasses import asdict, fields
 
 import pandas as pd
 
 import bpy
 
 sys.path.append('/work/vframe_synthetic/vframe_synthetic')
-from app.utils import log_utils
+from app.utils import log_utils, farm_utils, anno_utils
 from app.settings import app_cfg
+from app.models.bbox import BBoxNormLabelColor
 # reload application python modules
 importlib.reload(log_utils)
+importlib.reload(farm_utils)
+importlib.reload(anno_utils)
 
 # shortcuts
 log = log_utils.Logger.getLogger()
@@ -29,16 +34,38 @@ class FileIOManager:
   fp_dir_out = None
   fp_name = None
 
-  def __init__(self, cfg):
+  def __init__(self, cfg, shard=None):
+    '''
+    :param cfg: config dict
+    :param shard: (str) farm shard key. Shards append to per shard files, merged by
+      the generate command after the farm finishes
+    '''
     cfg_output = cfg.get('render').get('output')
     self.fp_dir_out = cfg_output.get('filepath')
     self.fname_prefix = cfg_output.get('filename_prefix')
     self.ext = cfg_output.get('file_format').lower()
     self.fp_out_annos = join(self.fp_dir_out, app_cfg.FN_METADATA)
+    self.fp_out_quality = join(self.fp_dir_out, app_cfg.FN_RENDER_QUALITY)
+    self.fp_out_bboxes = join(self.fp_dir_out, app_cfg.FN_ANNOTATIONS)
+    self.fp_out_annotated = join(self.fp_dir_out, app_cfg.FN_ANNOTATED_FRAMES)
     
     if not Path(self.fp_dir_out).exists():
       Path(self.fp_dir_out).mkdir(exist_ok=True, parents=True)
 
+    if shard:
+      self.fp_out_quality = farm_utils.shard_filepath(self.fp_out_quality, shard)
+      self.fp_out_bboxes = farm_utils.shard_filepath(self.fp_out_bboxes, shard)
+      self.fp_out_annotated = farm_utils.shard_filepath(self.fp_out_annotated, shard)
+      log.debug(f'Shard output: {shard}')
+
+    self.annotated = set()
+    if cfg.get('render').get('annotate'):
+      if shard:
+        # frames merged by earlier runs, the shared files are read only
+        fp_annotated = join(self.fp_dir_out, app_cfg.FN_ANNOTATED_FRAMES)
+        self.annotated = anno_utils.read_annotated(fp_annotated)
+      self.load_annotated()
+
 
   def build_fp_real(self, fname):
     fp = join(app_cfg.DN_REAL, f'{self.fname_prefix}{fname}.{self.ext}')
@@ -48,10 +75,58 @@ class FileIOManager:
     fp = join(app_cfg.DN_MASK, f'{self.fname_prefix}{fname}.{self.ext}')
     return join(self.fp_dir_out, fp)
 
-  def annos_to_csv(self, anno_data):
+  def annos_to_csv(self, anno_data, mask_scale=None):
+    '''Writes the color coded object metadata
+    :param anno_data: list of object metadata dicts
+    :param mask_scale: (float) mask resolution relative to the real images
+    '''
     df = pd.DataFrame.from_dict(anno_data)
+    if mask_scale is not None:
+      df['mask_scale'] = mask_scale
     df.to_csv(self.fp_out_annos, index=False)
 
+  def append_quality(self, fp_real, quality):
+    '''Appends the render settings of one real frame. Re-rendered frames append
+    another row, the last row per filename is current
+    :param fp_real: (str) real image path relative to the output directory
+    :param quality: RenderQuality
+    '''
+    if quality is None:
+      return
+    row = {'filename': Path(fp_real).name, **asdict(quality)}
+    write_header = not Path(self.fp_out_quality).exists()
+    with open(self.fp_out_quality, 'a', newline='') as fp:
+      writer = csv.DictWriter(fp, fieldnames=list(row.keys()))
+      if write_header:
+        writer.writeheader()
+      writer.writerow(row)
+
+  def load_annotated(self):
+    '''Reads the frames annotated by a previous run and drops annotation rows
+    of frames that were interrupted before they were marked complete
+    '''
+    self.annotated |= anno_utils.load_annotated(self.fp_out_bboxes, self.fp_out_annotated, log=log)
+    log.debug(f'Annotated frames: {len(self.annotated)}')
+
+  def is_annotated(self, fn):
+    return fn in self.annotated
+
+  def append_annos(self, filenames, annos):
+    '''Appends the annotations of one mask render for each real image sharing it,
+    then marks the images annotated
+    :param filenames: list of image filenames
+    :param annos: list of BBoxNormLabelColor
+    '''
+    write_header = not Path(self.fp_out_bboxes).exists()
+    with open(self.fp_out_bboxes, 'a', newline='') as fp:
+      writer = csv.DictWriter(fp, fieldnames=[f.name for f in fields(BBoxNormLabelColor)])
+      if write_header:
+        writer.writeheader()
+      writer.writerows({**asdict(anno), 'filename': fn} for fn in filenames for anno in annos)
+    with open(self.fp_out_annotated, 'a') as fp:
+      fp.writelines(f'{fn}\n' for fn in filenames)
+    self.annotated.update(filenames)
+
   def cleanup(self):
     ''''''
     pass
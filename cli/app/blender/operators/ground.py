@@ -8,9 +8,10 @@ import random
 import bpy
 
 sys.path.append('/work/vframe_synthetic/vframe_synthetic')
-from app.utils import log_utils, color_utils
+from app.utils import log_utils, color_utils, swap_utils
 importlib.reload(log_utils)
 importlib.reload(color_utils)
+importlib.reload(swap_utils)
 from app.blender.materials import colorfill
 importlib.reload(colorfill)
 
@@ -19,6 +20,7 @@ importlib.reload(colorfill)
 # shortcuts
 log = log_utils.Logger.getLogger()
 ColorFillMaterial = colorfill.ColorFillMaterial
+MaterialSwapTable = swap_utils.MaterialSwapTable
 
 # ---------------------------------------------------------------------------
 # Manage ground
@@ -32,6 +34,8 @@ class GroundManager:
     self._iterations = len(cfg_ground.get('materials', []))
     self.ground_materials = cfg_ground.get('materials', [])
     self.ground_objects = self.generate_placeholders(cfg_ground)
+    self.swap_table = MaterialSwapTable()
+    self.build_swap_table()
 
 
   def generate_placeholders(self, cfg):
@@ -48,40 +52,40 @@ class GroundManager:
       # o['ground_materials'] = self.ground_materials
       o['ground_materials'] = o.get('material')
       cf_mat_name = f'mat_{obj_name}_colorfill'
+      color = color_utils.rgb_packed_to_rgba_norm(o.get('color', 0x000000))
       if not cf_mat_name in bpy.data.materials.keys():
-        color = color_utils.rgb_packed_to_rgba_norm(o.get('color', 0x000000))
         cfm = ColorFillMaterial(cf_mat_name, color)
       o['colorfill_material'] = cf_mat_name
+      o['colorfill_color'] = color
       placeholders[obj_name] = o
     return placeholders
 
   
 
-  def mask(self):
-    '''Changes object materials to colorfill'''
+  def build_swap_table(self):
+    '''Resolves object and material handles for mask/unmask'''
+    self.swap_table.clear()
     for name, base_obj in self.ground_objects.items():
-      mat_name = base_obj.get('colorfill_material')
-      cf_mat = bpy.data.materials.get(mat_name)
       obj_scene = bpy.data.objects.get(name)
-      obj_scene.active_material = cf_mat
-      for ms in obj_scene.material_slots:
-        ms.material = cf_mat
+      mats_real = [bpy.data.materials.get(x) for x in base_obj['material_slots_defaults']]
+      if not mats_real:
+        mats_real = [bpy.data.materials.get(base_obj.get('unmask_material'))]
+      cf_mat = bpy.data.materials.get(base_obj.get('colorfill_material'))
+      self.swap_table.add(obj_scene, mats_real, cf_mat, base_obj.get('colorfill_color'))
+
+  def mask(self):
+    '''Changes object materials to colorfill'''
+    self.swap_table.mask()
 
   def unmask(self):
-    for name, base_obj in self.ground_objects.items():
-      mat = bpy.data.materials.get(base_obj.get('unmask_material'))
-      obj_scene = bpy.data.objects.get(name)
-      obj_scene.active_material = mat
-      for i, ms in enumerate(obj_scene.material_slots):
-        mat_name = base_obj['material_slots_defaults'][i]
-        mat = bpy.data.materials.get(mat_name)
-        ms.material = mat
+    self.swap_table.unmask()
 
   def set_ground(self, idx):
     for name, base_obj in self.ground_objects.items():
       mat_name = base_obj.get('ground_materials')[idx]
       base_obj['unmask_material'] = mat_name
       bpy.data.objects.get(name).active_material = bpy.data.materials.get(mat_name)
+    self.build_swap_table()
 
   def randomize(self):
     ridx = random.randint(0, len(self.ground_materials)-1)
@@ -12,23 +12,45 @@ import bpy
 import numpy as np
 
 sys.path.append('/work/vframe_synthetic/vframe_synthetic')
-from app.utils import log_utils, color_utils
+from app.utils import log_utils, color_utils, swap_utils, duplicate_utils, frustum_utils
 from app.blender.materials import colorfill
 
 # reload application python modules
 importlib.reload(log_utils)
 importlib.reload(color_utils)
+importlib.reload(swap_utils)
+importlib.reload(duplicate_utils)
+importlib.reload(frustum_utils)
 importlib.reload(colorfill)
 
 # shortcuts
 log = log_utils.Logger.getLogger()
 ColorFillMaterial = colorfill.ColorFillMaterial
+MaterialSwapTable = swap_utils.MaterialSwapTable
+DuplicateRegistry = duplicate_utils.DuplicateRegistry
+name_stem = duplicate_utils.name_stem
+box_corners = frustum_utils.box_corners
+transform_points = frustum_utils.transform_points
 
 
 # ---------------------------------------------------------------------------
 # Manage Particle Systems
 # ---------------------------------------------------------------------------
 
+def remove_datablocks(ids):
+  '''Removes objects and meshes in one batch if supported by this Blender version'''
+  if not ids:
+    return
+  if hasattr(bpy.data, 'batch_remove'):
+    bpy.data.batch_remove(ids)
+  else:
+    for x in ids:
+      if isinstance(x, bpy.types.Object):
+        bpy.data.objects.remove(x)
+      else:
+        bpy.data.meshes.remove(x)
+
+
 
 class ParticleSystem:
 
@@ -125,10 +147,15 @@ class Emitter:
     self.cfg = cfg
     self.name_emitter = self.cfg.get('name')
     self.opt_make_real = cfg.get('make_real')
+    # instanced particles are shaded per particle index by one material per object
+    self.opt_instance_colors = not self.opt_make_real and cfg.get('instance_colors', False)
     self.emitter = bpy.data.objects[self.name_emitter]
     self.trainable = cfg.get('trainable', False)
     self.opt_randomize = self.cfg.get('randomize', False)
     self.systems = [ParticleSystem(self.name_emitter, x) for x in self.cfg.get('systems')]
+    self.swap_table = MaterialSwapTable()
+    self.base_objects = []
+    self.registry = DuplicateRegistry([])
     
 
   def set_render_visibility(self, opt):
@@ -163,8 +190,19 @@ class Emitter:
   def make_real(self):
     
     self.system_objects = self.generate_placeholders(self.cfg.get('systems'))
+    # duplicate lists are shared with the registry index
+    self.registry = DuplicateRegistry(self.system_objects.keys())
+    for base_name, obj in self.system_objects.items():
+      obj['duplicates'] = self.registry.duplicates[base_name]
+      obj['meshes'] = self.registry.meshes[base_name]
 
     if not self.opt_make_real:
+      # instances render with the source object index, same as its first colorfill material
+      # with instance_colors the mask material shades each instance by its particle index
+      for base_name, obj in self.system_objects.items():
+        if obj.get('pass_index'):
+          bpy.data.objects.get(base_name).pass_index = obj['pass_index']
+      self.build_swap_table()
       return
     '''Makes duplicates into real objects'''
     # make emitter plane active object
@@ -174,111 +212,96 @@ class Emitter:
     for o in bpy.context.selected_objects:
       o.select_set(False)
 
-    # copy list of names of objects before duplicating
-    self.names_objects_orig = bpy.data.objects.keys()
-
-    # add names of scene objects that aren't part of the particle system
-    self.names_objects_ignore = [x for x in self.names_objects_orig if x not in self.system_objects.keys()]
+    # copy set of names of objects before duplicating
+    names_objects_orig = set(bpy.data.objects.keys())
 
     # select target object and convert particle system into objects
     self.emitter.select_set(True)
     bpy.ops.object.duplicates_make_real()
     self.emitter.select_set(False)
-    # subtract list of original particle item names from list of all stage items
-    self.names_objects = [x for x in bpy.data.objects.keys() if x not in self.names_objects_ignore]
 
-    # subtract the existing object names for off-stage objects
-    self.names_new = [x for x in self.names_objects if not any(y == x for y in self.system_objects.keys())]
+    # match new objects to their source object by name stem
+    objects = {o.name: o for o in bpy.data.objects}
+    matches = self.registry.register_new(names_objects_orig, list(objects))
+    for base_name, new_obj_name, ordinal in matches:
+      obj = self.system_objects[base_name]
+      new_obj = objects[new_obj_name]
+      # the duplicate needs a separate mesh object
+      new_mesh = new_obj.data.copy()  # copy objects data
+      new_mesh_name = f'mesh_{new_obj_name}'
+      new_mesh.name = new_mesh_name
+      new_obj.data = new_mesh
+      self.registry.add_mesh(base_name, new_mesh.name)
+      # if the object is a random-jazz items
+      if obj.get('randomize_color'):
+        rgb_node = bpy.data.materials.get(obj.get('material')).node_tree.nodes.get('RGB')
+        rgb_node.outputs.get('Color').default_value = color_utils.random_rgba()
+      # object index pass matches the colorfill material of this duplicate
+      if obj.get('pass_index'):
+        new_obj.pass_index = obj['pass_index'] + ordinal
 
+    self.set_render_visibility(False)
+    self.build_swap_table()
 
-    for new_obj_name in self.names_new:
-      # split name at '.' and match before
-      new_obj_stem = Path(new_obj_name).stem
-      for base_name, obj in self.system_objects.items():
-        # hide the source objects on stage from being rendered
-        if new_obj_stem == base_name:
-          obj['duplicates'].append(new_obj_name)
-          # the duplicate needs a separate mesh object
-          meshes = obj['meshes']
-          new_mesh = bpy.data.objects.get(new_obj_name).data.copy()  # copy objects data
-          new_mesh_name = f'mesh_{new_obj_name}'
-          new_mesh.name = new_mesh_name
-          bpy.data.objects.get(new_obj_name).data = new_mesh
-          meshes.append(new_mesh_name)
-          # if the object is a random-jazz items
-          if obj.get('randomize_color'):
-            rgb_node = bpy.data.materials.get(obj.get('material')).node_tree.nodes.get('RGB')
-            rgb_node.outputs.get('Color').default_value = color_utils.random_rgba()
 
-    self.set_render_visibility(False)
+  def build_swap_table(self):
+    '''Resolves object and material handles once per make_real for mask/unmask'''
+    self.swap_table.clear()
+    self.base_objects = []
+    # one pass over datablocks instead of a name search per object
+    objects = {o.name: o for o in bpy.data.objects}
+    materials = {m.name: m for m in bpy.data.materials}
+    for base_name, obj in self.system_objects.items():
+      if base_name != self.name_emitter:
+        self.base_objects.append(objects.get(base_name))
+      materials_real = obj.get('material_slots') or [materials.get(obj.get('material'))]
+      # one colorfill material per object, the shade is the object color
+      material_cf = materials.get(obj.get('materials')[0])
+      colors = obj.get('colors')
+      if self.opt_make_real:
+        for idx, dupe_name in enumerate(obj.get('duplicates', [])):
+          if idx >= len(colors):
+            log.error(f'No color for {dupe_name}, colors: {len(colors)}')
+            continue
+          self.swap_table.add(objects.get(dupe_name), materials_real, material_cf, colors[idx])
+      else:
+        self.swap_table.add(objects.get(base_name), materials_real, material_cf, colors[0])
 
 
   def clear_real(self):
     '''Clears the duplicated objects from the scene/memory'''
+    # drop handles before objects are removed
+    self.swap_table.clear()
+    objects = {o.name: o for o in bpy.data.objects}
+    meshes = {m.name: m for m in bpy.data.meshes}
+    ids = [objects[x] for x in self.registry.all_duplicates() if x in objects]
+    ids += [meshes[x] for x in self.registry.all_meshes() if x in meshes]
+    remove_datablocks(ids)
+    self.registry.clear()
     for base_name, obj in self.system_objects.items():
-      for dupe_name in obj.get('duplicates', []):
-        if dupe_name in bpy.data.objects.keys():
-          scene_obj = bpy.data.objects.get(dupe_name)
-          bpy.data.objects.remove(scene_obj)
-      for mesh_name in obj.get('meshes', []):
-        if mesh_name in bpy.data.meshes.keys():
-          bpy.data.meshes.remove(bpy.data.meshes.get(mesh_name))
+      obj['duplicates'] = self.registry.duplicates.get(base_name, [])
+      obj['meshes'] = self.registry.meshes.get(base_name, [])
     self.set_render_visibility(True)
 
 
 
   def mask(self):
+    '''Assigns colorfill materials from the swap table'''
     if self.opt_make_real:
       self.emitter.hide_render = True
       self.emitter.hide_viewport = True
-      for base_name, obj in self.system_objects.items():
-        for idx, dupe_name in enumerate(obj.get('duplicates', [])):
-          obj_scene = bpy.data.objects.get(dupe_name)
-          try:
-            material_cf = bpy.data.materials.get(obj.get('materials')[idx])
-            obj_scene.active_material = material_cf
-            #log.debug(f'set colorfill: {obj_scene.name} --> {obj.get("materials")[idx]}')
-            # fill material color slots
-            for material_slot in obj_scene.material_slots:
-              material_slot.material = material_cf
-          except Exception as e:
-            log.error(f'No material for {dupe_name}, materials: {obj.get("materials")}')
-    else:
-      for base_name, obj in self.system_objects.items():
-        material_cf = bpy.data.materials.get(obj.get('materials')[0])
-        obj_scene = bpy.data.objects.get(base_name)
-        obj_scene.active_material = material_cf
-        for material_slot in obj_scene.material_slots:
-          material_slot.material = material_cf
-
+    self.swap_table.mask()
 
 
   def unmask(self):
-    '''move this to cleanup?'''
+    '''Assigns real materials from the swap table'''
     if self.opt_make_real:
       self.emitter.hide_render = False
       self.emitter.hide_viewport = False
-    for base_name, obj in self.system_objects.items():
-      if not self.opt_make_real:
-        # reset to original material
-        obj_scene = bpy.data.objects.get(base_name)
-        material = bpy.data.materials.get(obj.get('material'))
-        obj_scene.active_material = material
-        for i in range(len(obj.get('material_slots'))):          
-          mslot = obj.get('material_slots')[i]
-          log.debug(f'base_name: {base_name}, material: {material}, mslot: {mslot}')
-          obj_scene.material_slots[i].material = obj.get('material_slots')[i]
-
-      if base_name != self.name_emitter:
-        obj_scene = bpy.data.objects.get(base_name)
-        obj_scene.hide_viewport = False
-        obj_scene.hide_render = False
-      for idx, dupe_name in enumerate(obj.get('duplicates', [])):
-        obj_scene = bpy.data.objects.get(dupe_name)
-        material = bpy.data.materials.get(obj.get('material'))
-        obj_scene.active_material = material
-        for i in range(len(obj.get('material_slots'))):          
-          obj_scene.material_slots[i].material = obj.get('material_slots')[i]
+    for obj_scene in self.base_objects:
+      obj_scene.hide_viewport = False
+      obj_scene.hide_render = False
+    self.swap_table.unmask()
 
 
   def cleanup(self):
@@ -308,19 +331,29 @@ class ParticleSystemManager:
     
     # find max number of trainable objects
     n_trainable = 0
+    self.trainable_names = set()
     for e in cfg_sys.get('emitters', []):
       for s in e.get('systems'):
         if s.get('trainable'):
           n_trainable += len(s.get('objects'))
+          self.trainable_names.update(o.get('name') for o in s.get('objects'))
 
 
     # allocate color spectrum, appending color list to objects
     color_range_rgba = color_utils.create_palette_rgba(n_trainable)
 
+    # object index pass values follow annotation metadata row order, 0 is background
+    pass_index_offset = 1
+    cfg_render = cfg.get('render', {})
     for e in cfg_sys.get('emitters', []):
       color_idx_offset = 0
+      opt_instance_colors = not e.get('make_real') and e.get('instance_colors', False)
+      if opt_instance_colors:
+        if str(cfg_render.get('engine', {}).get('mask', 'eevee')).lower() != 'cycles':
+          log.warn(f'Emitter "{e.get("name")}" instance_colors requires the Cycles mask engine')
+        if str(cfg_render.get('mask_mode', 'render')).lower() == 'index':
+          log.warn(f'Emitter "{e.get("name")}" instance_colors share one object index per object')
       for s in e.get('systems'):
-        count = max(s.get('count')) * len(s.get('objects'))
         for object_idx, o in enumerate(s.get('objects')):
           materials = []
           max_emitter_count = np.max(np.array(s.get('count'), dtype=np.uint16))
@@ -329,13 +362,20 @@ class ParticleSystemManager:
             rgba = color_range_rgba[color_idx_offset]  # RGBA norm
             color_idx_offset += 1
             rgba_cf_colors = color_utils.create_shaded_range_rgba(rgba, max_emitter_count)
-            # create a color fill material for all possible emitter objects
-            for c_idx, rgba_cf_color in enumerate(rgba_cf_colors):
-              mat_name = f'{o.get("name")}_colorfill_{c_idx}'
-              rgba_cf_color_int = [int(x * 255) for x in rgba_cf_color]
+            if opt_instance_colors:
+              # one material computes every shade from the particle index
+              mat_name = f'{o.get("name")}_colorfill_instance'
+              if not mat_name in bpy.data.materials.keys():
+                cfm = ColorFillMaterial(mat_name, rgba_cf_colors[0], shades=len(rgba_cf_colors))
+              materials.append(mat_name)
+            else:
+              # one color fill material for all emitter objects, filled with the object color
+              mat_name = f'{o.get("name")}_colorfill_object'
               if not mat_name in bpy.data.materials.keys():
-                cfm = ColorFillMaterial(mat_name, rgba_cf_color)
+                cfm = ColorFillMaterial(mat_name, rgba_cf_colors[0], object_color=True)
               materials.append(mat_name)
+            o['pass_index'] = pass_index_offset
+            pass_index_offset += len(rgba_cf_colors)
           else:
             # single color material for all
             rgba_cf_color = color_utils.rgb_packed_to_rgba_norm(o.get('color', 0x000000))
@@ -344,7 +384,7 @@ class ParticleSystemManager:
             if not mat_name in bpy.data.materials.keys():
               cfm = ColorFillMaterial(mat_name, rgba_cf_color, alpha_image=im_alpha_name)
             rgba_cf_colors = [ rgba_cf_color ] * max_emitter_count
-            materials = [mat_name] * count
+            materials = [mat_name]
           # create materials for each color
           o['materials'] = materials
           o['colors'] = rgba_cf_colors
@@ -386,11 +426,83 @@ class ParticleSystemManager:
                 'mat_idx': color_idx,
                 'object_idx': obj_idx,
                 }
+              if o.get('pass_index'):
+                anno_obj['pass_index'] = o['pass_index'] + color_idx
               annotation_meta.append(anno_obj)
 
     return annotation_meta
 
 
+  def trainable_corners(self):
+    '''Returns world space bounding box corners of rendered trainable objects,
+    duplicates and particle instances
+    :returns (numpy) (n, 8, 3)
+    '''
+    names = self.trainable_names
+    matrices, bounds = [], []
+    dg = bpy.context.evaluated_depsgraph_get()
+    for inst in dg.object_instances:
+      obj = inst.instance_object if inst.is_instance else inst.object
+      name = obj.original.name
+      if not (name in names or name_stem(name) in names):
+        continue
+      if not inst.is_instance and obj.original.hide_render:
+        continue
+      matrices.append(np.array(inst.matrix_world))
+      bounds.append(np.array(obj.bound_box))
+    if not matrices:
+      return np.zeros((0, 8, 3))
+    return box_corners(matrices, bounds)
+
+
+  def trainable_points(self):
+    '''Returns world space vertices of rendered trainable objects, duplicates and
+    particle instances, with the annotation metadata row of their mask color
+    :returns (points, ids): (numpy) (k, 3) points and (k,) metadata row per point,
+      sorted by row
+    '''
+    # metadata rows follow the pass index order, one row per color of an object
+    rows, instance_colors = {}, {}
+    for e in self.emitters:
+      for base_name, o in e.system_objects.items():
+        if base_name in self.trainable_names:
+          rows[base_name] = (o['pass_index'] - 1, len(o['colors']))
+          instance_colors[base_name] = e.opt_instance_colors
+          dupe_names = e.registry.duplicates.get(base_name, [])[:len(o['colors'])]
+          for idx, dupe_name in enumerate(dupe_names):
+            rows[dupe_name] = (o['pass_index'] - 1 + idx, 1)
+    # instances of one mesh are transformed together
+    groups = {}
+    verts = {}
+    dg = bpy.context.evaluated_depsgraph_get()
+    for inst in dg.object_instances:
+      obj = inst.instance_object if inst.is_instance else inst.object
+      name = obj.original.name
+      if obj.type != 'MESH' or name not in rows:
+        continue
+      if not inst.is_instance and obj.original.hide_render:
+        continue
+      row, n_colors = rows[name]
+      # instance_colors shades by particle index, like the colorfill material
+      if inst.is_instance and instance_colors.get(name):
+        row += inst.persistent_id[0] % n_colors
+      if name not in verts:
+        mesh = obj.data
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        verts[name] = co.reshape(-1, 3)
+      groups.setdefault(name, ([], []))
+      groups[name][0].append(np.array(inst.matrix_world))
+      groups[name][1].append(row)
+    points, ids = [np.zeros((0, 3))], [np.zeros(0, dtype=np.int64)]
+    for name, (matrices, rows_inst) in groups.items():
+      points.append(transform_points(matrices, verts[name]).reshape(-1, 3))
+      ids.append(np.repeat(rows_inst, len(verts[name])))
+    points, ids = np.concatenate(points), np.concatenate(ids)
+    order = np.argsort(ids, kind='stable')
+    return points[order], ids[order]
+
+
   def randomize(self):
     '''Randomizes all emitter systems'''
     for e in self.emitters:
@@ -5,23 +5,56 @@ from pathlib import Path
 import importlib
 import math
 import random
+import struct
+import tempfile
+import time
+import zlib
+
+import numpy as np
 
 import bpy
 
 sys.path.append('/work/vframe_synthetic/vframe_synthetic')
-from app.utils import log_utils
+from app.utils import log_utils, render_profile_utils, render_budget_utils
+from app.models import manifest
 
 # reload application python modules
 importlib.reload(log_utils)
+importlib.reload(render_profile_utils)
+importlib.reload(render_budget_utils)
+importlib.reload(manifest)
 
 # shortcuts
 log = log_utils.Logger.getLogger()
+RenderProfile = render_profile_utils.RenderProfile
+RenderBudget = render_budget_utils.RenderBudget
+RenderQuality = render_budget_utils.RenderQuality
 
 
 # ---------------------------------------------------------------------------
 # Mange render settings
 # ---------------------------------------------------------------------------
 
+def write_png_gray16(fp, im):
+  '''Writes a 16-bit grayscale PNG without color management
+  :param fp: (str) output filepath
+  :param im: (numpy) uint16 image (h, w)
+  '''
+  im = np.ascontiguousarray(im, dtype='>u2')
+  h, w = im.shape
+  def chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+  # filter type 0 at the start of each scanline
+  raw = np.zeros((h, 1 + w * 2), dtype=np.uint8)
+  raw[:, 1:] = im.view(np.uint8).reshape(h, w * 2)
+  with open(fp, 'wb') as f:
+    f.write(b'\x89PNG\r\n\x1a\n')
+    f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 16, 0, 0, 0, 0)))
+    f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+    f.write(chunk(b'IEND', b''))
+
+
 class RenderManager:
   '''Manages the render settings'''
   OPT_FILMIC = 'Filmic'
@@ -32,7 +65,13 @@ class RenderManager:
   OPT_NONE = 'None'
   OPT_EEVEE = 'BLENDER_EEVEE'
   OPT_CYCLES = 'CYCLES'
+  OPT_WORKBENCH = 'BLENDER_WORKBENCH'
   OPT_DEVICE_GPU = 'GPU'
+  OPT_MASK_RENDER = 'render'
+  OPT_MASK_INDEX = 'index'
+  NODE_INDEX_OUTPUT = 'VFRAME_INDEX_OUTPUT'
+  NODE_VIEWER = 'VFRAME_VIEWER'
+  IMAGE_VIEWER = 'Viewer Node'
 
   def __init__(self, cfg):
 
@@ -42,6 +81,7 @@ class RenderManager:
     # TODO: include all settings
     self.cycles_device_default = self.scene.cycles.device
     self.engine_default = self.scene.render.engine 
+    self.film_transparent_default = self.scene.render.film_transparent
 
     cfg_render = cfg.get('render')
 
@@ -54,12 +94,60 @@ class RenderManager:
     self.scene.render.resolution_x = int(dimensions.get('width'))
     self.scene.render.resolution_y = int(dimensions.get('height'))
     self.scene.render.resolution_percentage = int(float(dimensions.get('scale', 1.0)) * 100)
+    # masks can render at a lower resolution than real images
+    self.resolution_real = (self.scene.render.resolution_x, self.scene.render.resolution_y)
+    self._mask_scale = float(dimensions.get('mask_scale', 1.0))
+    self.resolution_mask = tuple(max(1, round(x * self._mask_scale)) for x in self.resolution_real)
 
     # render engine
     engine = cfg_render.get('engine')
     self.engine_mask = engine.get('mask', 'eevee').lower()
     self.engine_real = engine.get('real', 'cycles').lower()
     self.opt_gpu = engine.get('gpu', True)
+    if self.engine_mask == 'workbench':
+      self.setup_workbench()
+    else:
+      self.workbench_defaults = None
+
+    # named Cycles profile, eg draft or production. Unset keeps the .blend settings
+    self.profile = None
+    profile_name = cfg_render.get('profile')
+    if profile_name:
+      profile_cfg = (cfg_render.get('profiles') or {}).get(profile_name)
+      self.profile = RenderProfile(profile_name, profile_cfg)
+      skipped = self.profile.apply(self.scene)
+      if skipped:
+        log.warn(f'Render profile settings not available in this Blender version: {skipped}')
+      log.info(f'Render profile "{profile_name}": {self.profile.summary(self.scene)}')
+    self.render_time = None
+
+    # adjusts samples or noise threshold of real renders to a target seconds per frame
+    self.budget = None
+    cfg_budget = cfg_render.get('budget')
+    if cfg_budget:
+      if self.engine_real != 'cycles':
+        log.warn('Render budget requires Cycles for real renders. Ignoring')
+      else:
+        self.budget = RenderBudget.from_cfg(cfg_budget)
+        self.budget_defaults = (self.scene.cycles.samples, self.scene.cycles.adaptive_threshold)
+        log.info(f'Render budget: {self.budget.target}s per frame, mode: {self.budget.mode}')
+
+    # mask mode: "render" renders colorfill materials in a second pass,
+    # "index" writes the object index pass from the real render
+    self.mask_mode = cfg_render.get('mask_mode', self.OPT_MASK_RENDER).lower()
+    self.node_index_output = None
+    if self.mask_mode == self.OPT_MASK_INDEX:
+      if self.engine_real != 'cycles':
+        log.warn('Object index pass requires Cycles. Index masks will be empty')
+      self.setup_index_pass()
+
+    # annotate masks from the render result through a compositor Viewer node
+    self.node_viewer = None
+    self.annotate_mode = manifest.annotate_mode(cfg_render)
+    if cfg_render.get('annotate') and not self.annotate_mode:
+      log.warn('Annotating the render result requires mask_mode: render. Ignoring')
+    if self.annotate_mode == manifest.ANNOTATE_MASK:
+      self.setup_viewer()
 
     # set render prefences
     self.scene.display_settings.display_device = self.OPT_SRGB
@@ -68,7 +156,8 @@ class RenderManager:
     render_opts = self.scene.render
     output = cfg_render.get('output')
     render_opts.image_settings.file_format = output.get('file_format', 'PNG')
-    render_opts.image_settings.color_mode = output.get('color_mode', 'RGB')
+    self.color_mode = output.get('color_mode', 'RGB')
+    render_opts.image_settings.color_mode = self.color_mode
     render_opts.image_settings.compression = int(output.get('compression', 0))
     render_opts.image_settings.color_depth = str(output.get('color_depth', 8))
     render_opts.use_overwrite = output.get('overwrite', True)
@@ -76,6 +165,11 @@ class RenderManager:
     render_opts.use_placeholder = output.get('placeholders', False)
     render_opts.use_render_cache = output.get('render_cache', False)
 
+    # real images with a transparent background, for compositing onto photos
+    self.opt_film_transparent = cfg_render.get('film_transparent', False)
+    if self.opt_film_transparent and render_opts.image_settings.file_format != 'PNG':
+      log.warn('Transparent film requires PNG output. Real images will have no alpha')
+
     # Color management
     color_mgmt = cfg_render.get('color_management')
     self.color_mgmt = color_mgmt
@@ -84,7 +178,15 @@ class RenderManager:
 
 
   def set_engine_mask(self):
-    self.set_engine_eevee()
+    if self.engine_mask == 'workbench':
+      self.set_engine_workbench()
+    elif self.engine_mask == 'cycles':
+      self.set_engine_cycles()
+    else:
+      self.set_engine_eevee()
+    self.set_resolution(self.resolution_mask)
+    self.scene.render.film_transparent = False
+    self.scene.render.image_settings.color_mode = self.color_mode
     self.scene.display_settings.display_device = self.OPT_NONE
     self.scene.view_settings.view_transform = self.OPT_STANDARD
     self.scene.view_settings.look = self.OPT_NONE
@@ -93,6 +195,8 @@ class RenderManager:
     self.scene.render.use_sequencer = False
     self.scene.render.dither_intensity = 0
     self.scene.render.filter_size = 0
+    if self.node_viewer:
+      self.node_viewer.mute = False
 
 
   def set_engine_real(self):
@@ -100,6 +204,12 @@ class RenderManager:
       self.set_engine_eevee()
     elif self.engine_real == 'cycles':
       self.set_engine_cycles()
+    self.set_resolution(self.resolution_real)
+    if self.opt_film_transparent:
+      self.scene.render.film_transparent = True
+      self.scene.render.image_settings.color_mode = 'RGBA'
+    if self.node_viewer:
+      self.node_viewer.mute = True
 
     self.display_settings.display_device = self.OPT_SRGB
     self.view_settings.view_transform = self.OPT_FILMIC
@@ -120,8 +230,151 @@ class RenderManager:
       self.scene.cycles.device = self.OPT_DEVICE_GPU
 
 
-  def render(self, fp_out):
-    self.scene.render.filepath = fp_out
+  def set_engine_workbench(self):
+    self.scene.render.engine = self.OPT_WORKBENCH
+
+
+  def set_resolution(self, resolution):
+    self.scene.render.resolution_x, self.scene.render.resolution_y = resolution
+
+
+  def setup_workbench(self):
+    '''Sets Workbench to render flat, unlit object colors without anti-aliasing.
+    Object colors are set by the mask swap tables, the background is the mask
+    world viewport color. No shaders are compiled
+    '''
+    display = self.scene.display
+    shading = display.shading
+    settings = {
+      'light': 'FLAT',
+      'color_type': 'OBJECT',
+      'show_shadows': False,
+      'show_cavity': False,
+      'show_object_outline': False,
+      'show_specular_highlight': False,
+      'show_xray': False,
+      'use_dof': False,
+    }
+    self.workbench_defaults = {k: getattr(shading, k) for k in settings.keys()}
+    self.workbench_defaults['render_aa'] = display.render_aa
+    for k, v in settings.items():
+      setattr(shading, k, v)
+    display.render_aa = 'OFF'
+
+
+  @property
+  def size_real(self):
+    '''Real image width and height in pixels after the resolution scale'''
+    scale = self.scene.render.resolution_percentage / 100
+    return tuple(round(x * scale) for x in self.resolution_real)
+
+
+  @property
+  def mask_scale(self):
+    '''Mask resolution relative to the real image. Index masks come from the real render'''
+    return 1.0 if self.mask_mode == self.OPT_MASK_INDEX else self._mask_scale
+
+
+  def setup_index_pass(self):
+    '''Adds a compositor File Output node for the object index pass'''
+    self.view_layer = self.scene.view_layers[0]
+    self.use_pass_object_index_default = self.view_layer.use_pass_object_index
+    self.use_nodes_default = self.scene.use_nodes
+    self.view_layer.use_pass_object_index = True
+    node_rl = self.render_layers_node()
+    tree = self.scene.node_tree
+    # float EXR keeps index values exact, PNG output would apply the view transform
+    node_out = tree.nodes.new('CompositorNodeOutputFile')
+    node_out.name = self.NODE_INDEX_OUTPUT
+    node_out.format.file_format = 'OPEN_EXR'
+    node_out.format.color_depth = '32'
+    node_out.format.color_mode = 'RGB'
+    node_out.format.exr_codec = 'ZIP'
+    node_out.file_slots[0].path = 'index_'
+    node_out.base_path = tempfile.mkdtemp(prefix='vframe_index_')
+    tree.links.new(node_rl.outputs['IndexOB'], node_out.inputs[0])
+    self.node_index_output = node_out
+
+
+  def render_layers_node(self):
+    '''Enables compositing and returns the Render Layers node, adding it if needed'''
+    self.scene.use_nodes = True
+    tree = self.scene.node_tree
+    node_rl = next((n for n in tree.nodes if n.type == 'R_LAYERS'), None)
+    if node_rl is None:
+      node_rl = tree.nodes.new('CompositorNodeRLayers')
+      node_comp = next((n for n in tree.nodes if n.type == 'COMPOSITE'), None)
+      if node_comp is None:
+        node_comp = tree.nodes.new('CompositorNodeComposite')
+      tree.links.new(node_rl.outputs['Image'], node_comp.inputs['Image'])
+    return node_rl
+
+
+  def setup_viewer(self):
+    '''Adds a compositor Viewer node to read mask pixels of the render result.
+    The Render Result image itself has no pixel data in Python
+    '''
+    self.use_nodes_default = self.scene.use_nodes
+    node_rl = self.render_layers_node()
+    tree = self.scene.node_tree
+    node_viewer = tree.nodes.new('CompositorNodeViewer')
+    node_viewer.name = self.NODE_VIEWER
+    node_viewer.use_alpha = False
+    tree.links.new(node_rl.outputs['Image'], node_viewer.inputs['Image'])
+    self.node_viewer = node_viewer
+
+
+  def read_viewer(self):
+    '''Returns the last mask render as 8-bit RGB, as it would be written to PNG.
+    Masks render without view transform or dither, so values only need quantizing
+    :returns (numpy) uint8 (h, w, 3), top row first
+    '''
+    im = bpy.data.images[self.IMAGE_VIEWER]
+    w, h = im.size
+    pixels = np.empty(w * h * 4, dtype=np.float32)
+    try:
+      im.pixels.foreach_get(pixels)
+    except AttributeError:
+      pixels[:] = im.pixels[:]
+    # Blender images are stored bottom-up
+    pixels = pixels.reshape(h, w, 4)[::-1, :, :3]
+    return np.rint(np.clip(pixels, 0, 1) * 255).astype(np.uint8)
+
+
+  def write_index(self, fp_index):
+    '''Converts the index pass EXR of the last render to a 16-bit PNG'''
+    fn_exr = f'index_{self.scene.frame_current:04d}.exr'
+    fp_exr = join(self.node_index_output.base_path, fn_exr)
+    im = bpy.data.images.load(fp_exr)
+    im.colorspace_settings.name = 'Non-Color'
+    w, h = im.size
+    pixels = np.empty(w * h * 4, dtype=np.float32)
+    try:
+      im.pixels.foreach_get(pixels)
+    except AttributeError:
+      pixels[:] = im.pixels[:]
+    bpy.data.images.remove(im)
+    os.remove(fp_exr)
+    # Blender images are stored bottom-up
+    im_index = np.rint(pixels.reshape(h, w, 4)[::-1, :, 0]).astype(np.uint16)
+    Path(fp_index).parent.mkdir(parents=True, exist_ok=True)
+    write_png_gray16(fp_index, im_index)
+
+
+  @property
+  def index_mode(self):
+    return self.node_index_output is not None
+
+
+  def render(self, fp_out, fp_index=None):
+    '''Renders still image
+    :param fp_out: (str) filepath for rendered image, or None to only keep the render result
+    :param fp_index: (str) filepath for 16-bit object index PNG, index mask mode only
+    '''
+    if fp_out:
+      self.scene.render.filepath = fp_out
+    if self.index_mode:
+      self.node_index_output.mute = not fp_index
     # redirect output to log file
     logfile = 'blender_render.log'
     open(logfile, 'a').close()
@@ -131,13 +384,39 @@ class RenderManager:
     os.open(logfile, os.O_WRONLY)
 
     # do the rendering
-    bpy.ops.render.render(write_still=True)
+    st = time.perf_counter()
+    bpy.ops.render.render(write_still=bool(fp_out))
+    self.render_time = time.perf_counter() - st
 
     # disable output redirection
     os.close(1)
     os.dup(old)
     os.close(old)
 
+    name = Path(fp_out).name if fp_out else 'render result'
+    msg = f'{name}: {self.scene.render.engine} {self.render_time:.2f}s'
+    if self.profile and self.scene.render.engine == self.OPT_CYCLES:
+      msg += f' [{self.profile.name}: {self.profile.summary(self.scene)}]'
+    log.debug(msg)
+
+    if self.index_mode and fp_index:
+      self.write_index(fp_index)
+
+
+  def update_budget(self):
+    '''Returns the quality of the last real render and sets the next frame's
+    samples and noise threshold from the render budget
+    :returns RenderQuality, or None if real images are not rendered with Cycles
+    '''
+    if self.engine_real != 'cycles' or self.render_time is None:
+      return None
+    cycles = self.scene.cycles
+    quality = RenderQuality(cycles.samples, cycles.adaptive_threshold, round(self.render_time, 3))
+    if self.budget:
+      cycles.samples, cycles.adaptive_threshold = self.budget.update(self.render_time,
+        quality.samples, quality.adaptive_threshold)
+    return quality
+
 
   @property
   def save_real(self):
@@ -151,6 +430,31 @@ class RenderManager:
 
   def cleanup(self):
     '''Resets render engine to original settings'''
+    if self.index_mode:
+      dir_tmp = self.node_index_output.base_path
+      self.scene.node_tree.nodes.remove(self.node_index_output)
+      if Path(dir_tmp).is_dir() and not os.listdir(dir_tmp):
+        os.rmdir(dir_tmp)
+      self.view_layer.use_pass_object_index = self.use_pass_object_index_default
+      self.scene.use_nodes = self.use_nodes_default
+      self.node_index_output = None
+    if self.node_viewer:
+      self.scene.node_tree.nodes.remove(self.node_viewer)
+      self.scene.use_nodes = self.use_nodes_default
+      self.node_viewer = None
+    if self.workbench_defaults:
+      display = self.scene.display
+      display.render_aa = self.workbench_defaults.pop('render_aa')
+      for k, v in self.workbench_defaults.items():
+        setattr(display.shading, k, v)
+      self.workbench_defaults = None
+    if self.budget:
+      self.scene.cycles.samples, self.scene.cycles.adaptive_threshold = self.budget_defaults
+    if self.profile:
+      self.profile.restore(self.scene)
+    self.set_resolution(self.resolution_real)
+    self.scene.render.film_transparent = self.film_transparent_default
+    self.scene.render.image_settings.color_mode = self.color_mode
     self.scene.render.engine = self.engine_default
     self.scene.cycles.device = self.cycles_device_default
     # TODO set to original if EEVEE or Cycles
@@ -13,9 +13,10 @@ import numpy as np
 
 sys.path.append('/work/vframe_synthetic/cli')
 # reload application python modules for Blender
-from app.utils import log_utils, color_utils
+from app.utils import log_utils, color_utils, swap_utils
 importlib.reload(log_utils)
 importlib.reload(color_utils)
+importlib.reload(swap_utils)
 from app.blender.materials import colorfill
 importlib.reload(colorfill)
 
@@ -23,6 +24,7 @@ importlib.reload(colorfill)
 # shortcuts
 log = log_utils.Logger.getLogger()
 ColorFillMaterial = colorfill.ColorFillMaterial
+MaterialSwapTable = swap_utils.MaterialSwapTable
 
 
 # ---------------------------------------------------------------------------
@@ -62,27 +64,27 @@ class SceneObject:
     # generate new colorfill material. Data is stored in blender. Discard var
     _mat_cf_tmp = ColorFillMaterial(metadata.material_mask, metadata.rgba_norm)
     # init metadata material slots
-    scene_obj = bpy.data.objects.get(self.metadata.name)
-    self.material_slots = [ms.material for ms in scene_obj.material_slots]
+    self.scene_obj = bpy.data.objects.get(self.metadata.name)
+    self.material_slots = [ms.material for ms in self.scene_obj.material_slots]
+    # resolve material handles once
+    self.mat_cf = bpy.data.materials.get(self.metadata.material_mask)
+    self.mat_real = bpy.data.materials.get(self.metadata.material)
+    self.swap_table = MaterialSwapTable()
+    self.add_to_swap_table(self.swap_table)
+
+  def add_to_swap_table(self, swap_table):
+    """Adds real and colorfill material assignments to a swap table"""
+    swap_table.add(self.scene_obj, self.material_slots or [self.mat_real], self.mat_cf,
+      self.metadata.rgba_norm)
 
   def mask(self):
     """Switches material to colorfill mask material name"""
-    scene_obj = bpy.data.objects.get(self.metadata.name)
-    mat_cf = bpy.data.materials.get(self.metadata.material_mask)
-    scene_obj.active_material = mat_cf
-    mat_slots = self.material_slots
-    for i in range(len(self.material_slots)):
-      scene_obj.material_slots[i].material = mat_cf
+    self.swap_table.mask(force=True)
 
 
   def unmask(self):
     """Switches material to default material name"""
-    scene_obj = bpy.data.objects.get(self.metadata.name)
-    mat_real = bpy.data.materials.get(self.metadata.material)
-    scene_obj.active_material = mat_real
-    mat_slots = self.material_slots
-    for i in range(len(self.material_slots)):
-      scene_obj.material_slots[i].material = self.material_slots[i]
+    self.swap_table.unmask(force=True)
 
 
   def cleanup(self):
@@ -123,6 +125,11 @@ class StaticSystem:
       o['color'] = rgba_int
       self._scene_objects.append(SceneObject(meta))
 
+    # one flat table for all scene objects
+    self.swap_table = MaterialSwapTable()
+    for o in self._scene_objects:
+      o.add_to_swap_table(self.swap_table)
+
 
   def get_annotation_meta(self):
     """Returns annotation metadata"""
@@ -157,13 +164,11 @@ class StaticSystem:
 
 
   def mask(self):
-    for o in self._scene_objects:
-      o.mask()
+    self.swap_table.mask()
 
 
   def unmask(self):
-    for o in self._scene_objects:
-      o.unmask()
+    self.swap_table.unmask()
 
 
   def cleanup(self):
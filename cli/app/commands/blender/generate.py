@@ -19,6 +19,18 @@ from app.utils import click_utils
   help='Path to input Python script', show_default=True,)
 @click.option('--resume', 'opt_checkpoint', default='0', type=str,
   help='Resume particle iteration', show_default=True)
+@click.option('--end', 'opt_end', default=None, type=int,
+  help='Last particle iteration, exclusive. Default is all iterations')
+@click.option('--workers', 'opt_workers', default=1, type=int, show_default=True,
+  help='Number of Blender processes. Splits iterations into shards if > 1')
+@click.option('--restarts', 'opt_max_restarts', default=3, type=int, show_default=True,
+  help='Number of times a crashed shard is restarted')
+@click.option('--logs', 'opt_dir_logs', default=None,
+  help='Directory for shard log and progress files. Default is <output>/logs')
+@click.option('--manifest', 'opt_fp_manifest', default=None,
+  help='Path to render job manifest from "plan". Farm mode writes one if not set')
+@click.option('--seed', 'opt_seed', default=None, type=int,
+  help='Seed for planning render jobs. Default is config "seed" or 0')
 @click.option('--dry-run', 'opt_dry_run', is_flag=True, default=False,
   show_default=True)
 @click.option('--root', 'opt_dir_cli_root', default=app_cfg.DIR_CLI,
@@ -29,27 +41,110 @@ from app.utils import click_utils
   help=click_utils.show_help(types.GeneratorSystem))
 @click.pass_context
 def cli(ctx, opt_fp_blender, opt_fp_blend, opt_system, opt_fp_cfg, 
-  opt_checkpoint, opt_dry_run, opt_dir_cli_root):
+  opt_checkpoint, opt_end, opt_workers, opt_max_restarts, opt_dir_logs, opt_fp_manifest,
+  opt_seed, opt_dry_run, opt_dir_cli_root):
   """Runs Blender synthetic data generator"""
   
   import subprocess
 
+  from tqdm import tqdm
+
+  from app.models.manifest import RenderManifest
+  from app.utils import file_utils, farm_utils, anno_utils
+
   log = app_cfg.LOG
   log.info('Running Blender generator')
 
   # Blender variables. The trailing '--' indicates end of arguments
   fn_generator = f'{opt_system.name.lower()}.py'
   fp_generator = join(app_cfg.DIR_GENERATORS, fn_generator)
-  args = [opt_fp_blender, opt_fp_blend, '--background', '--python', fp_generator, '--']
 
-  # Python script variables
-  args.append(f'--cfg {opt_fp_cfg}')
-  args.append(f'--root {opt_dir_cli_root}')
-  args.append(f'--checkpoint {opt_checkpoint}')
+  def build_args(checkpoint, end=None, fp_progress=None):
+    args = [opt_fp_blender, opt_fp_blend, '--background', '--python', fp_generator, '--']
+    # Python script variables
+    args.append(f'--cfg {opt_fp_cfg}')
+    args.append(f'--root {opt_dir_cli_root}')
+    args.append(f'--checkpoint {checkpoint}')
+    if end is not None:
+      args.append(f'--end {end}')
+    if fp_progress:
+      args.append(f'--progress {fp_progress}')
+    if opt_fp_manifest:
+      args.append(f'--manifest {opt_fp_manifest}')
+    elif opt_seed is not None:
+      args.append(f'--seed {opt_seed}')
+    return args
+
+  if opt_workers <= 1:
+    args = build_args(opt_checkpoint, opt_end)
+    if opt_dry_run:
+      log.debug('This was a dry run. Script would have called:')
+      log.debug(' '.join([str(x) for x in args]))
+    else:
+      # Dispatch subprocess to Blender
+      subprocess.call(args, stdin=None, stdout=None, stderr=None, shell=False)
+    return
+
+  # Farm mode: shard the particle iterations. Output filenames include the
+  # particle index so disjoint ranges write disjoint files
+  cfg = file_utils.load_yml(opt_fp_cfg)
+  n_iters = cfg.get('particle_system', {}).get('iterations', 0)
+  idx_start = int(opt_checkpoint)
+  idx_end = n_iters if opt_end is None else min(opt_end, n_iters)
+  dir_out = cfg.get('render').get('output').get('filepath')
+  if not opt_dir_logs:
+    opt_dir_logs = join(dir_out, 'logs')
+
+  # plan once so every shard renders from the same job list
+  if not opt_fp_manifest:
+    seed = opt_seed if opt_seed is not None else cfg.get('seed', 0)
+    manifest = RenderManifest.plan(cfg, seed=seed)
+    opt_fp_manifest = join(dir_out, app_cfg.FN_MANIFEST)
+    if not opt_dry_run:
+      Path(dir_out).mkdir(parents=True, exist_ok=True)
+      manifest.save(opt_fp_manifest)
+    log.info(f'Planned {len(manifest)} render jobs: {opt_fp_manifest}')
+
+  shards = farm_utils.build_shards(idx_start, idx_end, opt_workers, opt_dir_logs)
+  if not shards:
+    log.error(f'No iterations in range [{idx_start}, {idx_end})')
+    return
+  log.info(f'Rendering iterations [{idx_start}, {idx_end}) in {len(shards)} shards')
+  for shard in shards:
+    log.debug(f'Shard {shard.idx}: [{shard.start}, {shard.end}) log: {shard.fp_log}')
 
   if opt_dry_run:
     log.debug('This was a dry run. Script would have called:')
-    log.debug(' '.join([str(x) for x in args]))
+    for shard in shards:
+      args = build_args(farm_utils.read_progress(shard.fp_progress, shard.start),
+        shard.end, shard.fp_progress)
+      log.debug(' '.join([str(x) for x in args]))
+    return
+
+  # shards only read the shared annotation files, drop interrupted rows before they start
+  annotate = cfg.get('render').get('annotate')
+  fp_annos = join(dir_out, app_cfg.FN_ANNOTATIONS)
+  fp_annotated = join(dir_out, app_cfg.FN_ANNOTATED_FRAMES)
+  if annotate:
+    anno_utils.load_annotated(fp_annos, fp_annotated, log=log)
+
+  farm = farm_utils.RenderFarm(
+    lambda shard, checkpoint: build_args(checkpoint, shard.end, shard.fp_progress),
+    shards, max_restarts=opt_max_restarts, log=log)
+  with tqdm(total=sum(s.size for s in shards), desc='Iterations') as pbar:
+    ok = farm.run(pbar=pbar)
+
+  # shards append to their own files, merge them now that all stopped
+  fp_quality = join(dir_out, app_cfg.FN_RENDER_QUALITY)
+  n_quality = farm_utils.merge_csv(fp_quality,
+    [farm_utils.shard_filepath(fp_quality, s.key) for s in shards])
+  log.debug(f'Merged {n_quality} render quality rows into {fp_quality}')
+  if annotate:
+    n_annotated = anno_utils.merge_annotations(fp_annos, fp_annotated, [s.key for s in shards])
+    log.debug(f'Merged annotations of {n_annotated} frames into {fp_annos}')
+
+  if ok:
+    log.info(f'Done. Rendered {farm.completed()} iterations')
   else:
-    # Dispatch subprocess to Blender
-    subprocess.call(args, stdin=None, stdout=None, stderr=None, shell=False)
+    log.error(f'{len(farm.failed)} shards failed: ' +
+      ', '.join(f'[{s.start}, {s.end})' for s in farm.failed))
@@ -0,0 +1,45 @@
+"""
+Plans render jobs from a Blender generator config
+"""
+from os.path import join
+import click
+
+from app.settings import app_cfg
+
+
+@click.command()
+@click.option('--config', 'opt_fp_cfg', required=True,
+  help='Path to generator YAML config', show_default=True,)
+@click.option('-o', '--output', 'opt_fp_out', default=None,
+  help='Path to manifest. Default is <output>/manifest.csv.gz')
+@click.option('--seed', 'opt_seed', default=None, type=int,
+  help='Seed for all random draws. Default is config "seed" or 0')
+@click.option('-f', '--force', 'opt_force', is_flag=True,
+  help='Overwrite existing manifest')
+@click.pass_context
+def cli(ctx, opt_fp_cfg, opt_fp_out, opt_seed, opt_force):
+  """Writes render job manifest for exact resume"""
+
+  from pathlib import Path
+
+  from app.models.manifest import RenderManifest
+  from app.utils import file_utils
+
+  log = app_cfg.LOG
+
+  cfg = file_utils.load_yml(opt_fp_cfg)
+  dir_out = cfg.get('render').get('output').get('filepath')
+  if not opt_fp_out:
+    opt_fp_out = join(dir_out, app_cfg.FN_MANIFEST)
+  if Path(opt_fp_out).exists() and not opt_force:
+    log.error(f'{opt_fp_out} exists. Use "-f/--force" to overwrite')
+    return
+
+  seed = opt_seed if opt_seed is not None else cfg.get('seed', 0)
+  manifest = RenderManifest.plan(cfg, seed=seed)
+  Path(opt_fp_out).parent.mkdir(parents=True, exist_ok=True)
+  manifest.save(opt_fp_out)
+
+  n_done = sum(job.is_complete(dir_out) for job in manifest.jobs)
+  log.info(f'{len(manifest)} jobs in {manifest.iterations} iterations, seed: {seed}')
+  log.info(f'{n_done} jobs already rendered. Wrote: {opt_fp_out}')
@@ -0,0 +1,136 @@
+"""
+Pastes object cutouts onto background photos for copy-paste augmentation
+"""
+
+import click
+
+from app.settings import app_cfg
+
+@click.command()
+@click.option('-i', '--input', 'opt_dir_in', required=True,
+  help='Path to cutout bank (cutouts.csv), from masks_to_cutouts')
+@click.option('-b', '--backgrounds', 'opt_dir_bgs', required=True,
+  help='Path to folder of background photos')
+@click.option('-o', '--output', 'opt_dir_out', required=True,
+  help='Path to output folder')
+@click.option('-n', '--num', 'opt_num', default=1000, show_default=True,
+  help='Number of images to write')
+@click.option('--objects', 'opt_objects', type=(int, int), default=(1, 8), show_default=True,
+  help='Min and max number of cutouts per image')
+@click.option('--label', 'opt_labels', multiple=True,
+  help='Only paste cutouts with these labels')
+@click.option('--balance', 'opt_balance', is_flag=True,
+  help='Sample labels uniformly instead of in proportion to the number of cutouts')
+@click.option('--size', 'opt_size', type=(int, int), default=(0, 0), show_default=True,
+  help='Output width and height. Use 0 0 for background size')
+@click.option('--scale', 'opt_scale', type=(float, float), default=(0.1, 0.3), show_default=True,
+  help='Min and max cutout size relative to the shorter side of the output')
+@click.option('--jitter', 'opt_jitter', type=(float, float, float), default=(0.1, 0.1, 0.1),
+  show_default=True, help='Brightness, contrast and saturation jitter of the cutouts')
+@click.option('--feather', 'opt_feather', default=0.0, show_default=True,
+  help='Blur sigma in pixels to soften cutout edges')
+@click.option('--min-pixels', 'opt_min_pixels', default=40, show_default=True,
+  help='Minimum number of visible pixels per annotation')
+@click.option('--ext', 'opt_ext', type=click.Choice(['jpg', 'png']), default='jpg',
+  show_default=True, help='Output image format')
+@click.option('--seed', 'opt_seed', default=0, show_default=True)
+@click.option('--workers', 'opt_workers', default=None, type=int,
+  help='Number of processes. Default is number of CPUs')
+@click.option('--chunksize', 'opt_chunksize', default=8, show_default=True,
+  help='Number of images sent to a worker process at a time')
+@click.option('-f', '--force', 'opt_force', is_flag=True,
+  help='Force overwrite annotations file')
+@click.pass_context
+def cli(ctx, opt_dir_in, opt_dir_bgs, opt_dir_out, opt_num, opt_objects, opt_labels,
+  opt_balance, opt_size, opt_scale, opt_jitter, opt_feather, opt_min_pixels, opt_ext,
+  opt_seed, opt_workers, opt_chunksize, opt_force):
+  """Pastes object cutouts onto background photos"""
+
+  from os.path import join
+  from glob import glob
+  from pathlib import Path
+  from dataclasses import fields
+  from multiprocessing import Pool
+  import csv
+  import random
+  import shutil
+  import time
+
+  import pandas as pd
+  from tqdm import tqdm
+
+  from app.models.bbox import BBoxNormLabelColor
+  from app.utils import composite_utils
+
+  log = app_cfg.LOG
+  log.info('Pasting cutouts onto background photos')
+
+  fp_annotations = join(opt_dir_out, app_cfg.FN_ANNOTATIONS)
+  if Path(fp_annotations).exists() and not opt_force:
+    log.error(f'File exists: {fp_annotations}. Use "-f/--force" to overwrite')
+    return
+
+  fp_cutouts = join(opt_dir_in, app_cfg.FN_CUTOUTS)
+  if not Path(fp_cutouts).exists():
+    log.error(f'No cutout bank: {fp_cutouts}. Run masks_to_cutouts first')
+    return
+  df_cutouts = pd.read_csv(fp_cutouts)
+  if opt_labels:
+    df_cutouts = df_cutouts[df_cutouts.label.isin(opt_labels)]
+  cutouts = [(join(opt_dir_in, df.filename), df.label, int(df.label_index), df.color) \
+    for df in df_cutouts.itertuples()]
+  cutouts_by_label = {}
+  for cutout in cutouts:
+    cutouts_by_label.setdefault(cutout[1], []).append(cutout)
+
+  exts = ('.jpg', '.jpeg', '.png')
+  fps_bgs = sorted(fp for fp in glob(join(opt_dir_bgs, '**', '*'), recursive=True) \
+    if Path(fp).suffix.lower() in exts)
+  if not cutouts or not fps_bgs:
+    log.error(f'Found {len(cutouts)} cutouts and {len(fps_bgs)} backgrounds')
+    return
+  log.info(f'{len(cutouts):,} cutouts of {len(cutouts_by_label)} labels, '
+    f'{len(fps_bgs):,} backgrounds')
+
+  dir_out_ims = join(opt_dir_out, app_cfg.DN_REAL)
+  Path(dir_out_ims).mkdir(parents=True, exist_ok=True)
+  fp_metadata = join(opt_dir_in, app_cfg.FN_METADATA)
+  if Path(fp_metadata).exists():
+    shutil.copy(fp_metadata, join(opt_dir_out, app_cfg.FN_METADATA))
+
+  # cutouts are sampled here so the dataset only depends on the seed
+  rng = random.Random(opt_seed)
+  labels = sorted(cutouts_by_label.keys())
+  def sample_cutout():
+    if opt_balance:
+      return rng.choice(cutouts_by_label[rng.choice(labels)])
+    return rng.choice(cutouts)
+
+  def tasks():
+    for idx in range(opt_num):
+      n = rng.randint(*opt_objects)
+      yield {
+        'fp_bg': rng.choice(fps_bgs),
+        'fp_out': join(dir_out_ims, f'{idx:06d}.{opt_ext}'),
+        'cutouts': [sample_cutout() for _ in range(n)],
+        'dim': opt_size if all(opt_size) else None,
+        'scale': opt_scale,
+        'jitter': opt_jitter,
+        'feather': opt_feather,
+        'min_pixels': opt_min_pixels,
+        'seed': (opt_seed, idx),
+      }
+
+  st = time.time()
+  n_annos = 0
+  with open(fp_annotations, 'w', newline='') as fp, Pool(opt_workers) as pool:
+    writer = csv.DictWriter(fp, fieldnames=[f.name for f in fields(BBoxNormLabelColor)])
+    writer.writeheader()
+    results = pool.imap(composite_utils.paste_file, tasks(), chunksize=opt_chunksize)
+    for annos in tqdm(results, total=opt_num):
+      writer.writerows(annos)
+      n_annos += len(annos)
+
+  elapsed = max(time.time() - st, 1e-6)
+  log.info(f'Wrote {opt_num:,} images in {elapsed:.2f}s ({opt_num / elapsed:.2f} images/sec)')
+  log.info(f'Wrote {n_annos:,} annotations to {fp_annotations}')
@@ -26,20 +26,28 @@ ops_interpolation = ['nearest', 'antialias']
 @click.option('--interpolation', 'opt_interp', type=click.Choice(ops_interpolation),
   default='nearest',
   help='Type of interpolation for resizing. Use "nearst" for annotation masks.')
+@click.option('--colors', 'opt_colors', default=256, type=click.IntRange(2, 256),
+  help='Number of colors in the global palette')
+@click.option('--palette-frames', 'opt_palette_frames', default=16, show_default=True,
+  help='Number of frames sampled to build the global palette')
+@click.option('--dither', 'opt_dither', is_flag=True,
+  help='Dither frames. Do not use for annotation masks')
+@click.option('--threads', 'opt_threads', type=int, default=None,
+  help='Number of decode threads. Default is number of CPUs')
 @click.pass_context
-def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_ext, 
-  opt_slice, opt_decimate, opt_width, opt_force, opt_interp):
+def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_ext,
+  opt_slice, opt_decimate, opt_width, opt_force, opt_interp, opt_colors,
+  opt_palette_frames, opt_dither, opt_threads):
   """Converts still image to GIF"""
-  
+
   from glob import glob
   from pathlib import Path
 
   from PIL import Image
   import numpy as np
   from tqdm import tqdm
-  from moviepy.editor import VideoClip
 
-  from app.utils import file_utils, im_utils
+  from app.utils import file_utils, sys_utils, video_utils
 
   log = app_cfg.LOG
   log.info('Generating animated GIF')
@@ -49,45 +57,35 @@ def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_ext,
     if Path(opt_fp_out).is_dir() and not opt_force:
       log.error(f'{opt_fp_out} exists. Use "-f/--force" to overwrite')
 
-  # glob comp images  
+  # glob comp images
   fps_im = sorted([im for im in glob(str(Path(opt_dir_in) / f'*.{opt_ext}'))])
   if opt_slice:
     fps_im = fps_im[opt_slice[0]:opt_slice[1]]
   if opt_decimate:
     fps_im = [x for i, x in enumerate(fps_im) if i % opt_decimate]
 
-  if len(fps_im) > 100:
-    log.warn('Creating GIF with over 100 frames. Could create memory issues')
+  if not fps_im:
+    log.error(f'No {opt_ext} images in {opt_dir_in}')
+    return
+
+  resample = Image.NEAREST if opt_interp == 'nearest' else Image.LANCZOS
 
-  # load all images into list
-  ims = []
-  for fp_im in tqdm(fps_im):
-    log.debug(fp_im)
-    im = Image.open(fp_im)
-    log.debug(im.size)
+  def load_frame(fp_im):
+    """Loads and resizes one frame"""
+    im = Image.open(fp_im).convert('RGB')
     w, h = im.size
     h = int(opt_width * h / w)
-    im = im.resize((opt_width, h), Image.NEAREST)
-    ims.append(im)
-
-  num_frames = len(fps_im)
-  duration_sec = num_frames / opt_fps
-
-  def make_frame(t):
-    frame_idx = int(np.clip(np.round(t * opt_fps), 0, num_frames - 1))
-    im = ims[frame_idx]
-    im_np_rgb = im_utils.pil2np(im, swap=False)
-    return im_np_rgb
-
-  animation = VideoClip(make_frame, duration=duration_sec)
-  animation.write_gif(opt_fp_out, fps=opt_fps) # export as GIF (slow)
+    return im.resize((opt_width, h), resample)
 
+  # build one global palette from evenly spaced sample frames
+  idxs_sample = np.unique(np.linspace(0, len(fps_im) - 1, min(opt_palette_frames, len(fps_im))).astype(int))
+  ims_sample = [load_frame(fps_im[i]) for i in idxs_sample]
+  im_palette = video_utils.build_gif_palette(ims_sample, n_colors=opt_colors)
 
-  # ims[0].save(opt_fp_out,
-  #            save_all=True,
-  #            append_images=ims[1:],
-  #            duration=int((1.0/opt_fps)*1000),
-  #            loop=0)
+  # stream resized frames into the GIF. Memory is independent of frame count
+  frames = sys_utils.imap_threaded(load_frame, fps_im, workers=opt_threads)
+  with video_utils.GifWriter(opt_fp_out, im_palette, opt_fps, dither=opt_dither) as writer:
+    for im in tqdm(frames, total=len(fps_im)):
+      writer.write(im)
 
-  
-  log.info('Done.')
\ No newline at end of file
+  log.info('Done.')
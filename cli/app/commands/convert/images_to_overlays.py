@@ -19,83 +19,84 @@ from app.settings import app_cfg
 @click.option('--mp4_codec', 'opt_codec', default='libx264', help='Video bitrate (Mbp/s')
 @click.option('--cleanup', 'opt_cleanup', is_flag=True, default=False, show_default=True,
   help='Deletes image sequence files after writing video')
+@click.option('--no-comp', 'opt_no_comp', is_flag=True, default=False,
+  help='Skip writing composite images and stream frames to the video only')
+@click.option('--threads', 'opt_threads', type=int, default=None,
+  help='Number of reader and blend threads. Default is number of CPUs')
+@click.option('--prefetch', 'opt_prefetch', type=int, default=None,
+  help='Max number of frames decoded ahead of the writer. Default is 2x threads')
 @click.pass_context
-def cli(ctx, opt_dir_ims, opt_fps, opt_bitrate, opt_codec, opt_fp_out_video, opt_bg_color, 
-  opt_write_video, opt_cleanup):
+def cli(ctx, opt_dir_ims, opt_fps, opt_bitrate, opt_codec, opt_fp_out_video, opt_bg_color,
+  opt_write_video, opt_cleanup, opt_no_comp, opt_threads, opt_prefetch):
   """Composites real and mask images, writes optional video"""
-  
-  import pandas as pd
+
   from glob import glob
   from pathlib import Path
 
   import cv2 as cv
   import numpy as np
-  import blend_modes
-  from moviepy.editor import VideoClip
   from tqdm import tqdm
 
-  from app.utils import log_utils, file_utils
+  from app.utils import log_utils, file_utils, sys_utils, im_utils, video_utils
 
   log = app_cfg.LOG
   log.info('Compositing masks and synthetic 3D images')
 
-  # init
-  fps_ims_comp = []
-
   # glob images
-  fps_ims_real = [im for im in glob(str(Path(opt_dir_ims) / app_cfg.DN_REAL / '*.png'))]
-  fps_ims_mask = [im for im in glob(str(Path(opt_dir_ims) / app_cfg.DN_MASK / '*.png'))]
+  fps_ims_real = sorted([im for im in glob(str(Path(opt_dir_ims) / app_cfg.DN_REAL / '*.png'))])
+  fps_ims_mask = sorted([im for im in glob(str(Path(opt_dir_ims) / app_cfg.DN_MASK / '*.png'))])
   if not len(fps_ims_mask) == len(fps_ims_real):
     print('Error: number images not same')
   print(f'found {len(fps_ims_mask)} masks, {len(fps_ims_real)} images')
 
+  if not opt_fp_out_video and opt_write_video:
+    opt_fp_out_video = str(Path(opt_dir_ims) / f'{Path(opt_dir_ims).name}.mp4')
+
+  if opt_no_comp and not opt_fp_out_video:
+    log.error('Nothing to write. Use "--video" or "-o/--output" with "--no-comp"')
+    return
+
   # ensure output dir
   opt_dir_ims_comp = Path(opt_dir_ims) / app_cfg.DN_COMP
-  if not Path(opt_dir_ims_comp).is_dir():
+  if not opt_no_comp and not Path(opt_dir_ims_comp).is_dir():
     Path(opt_dir_ims_comp).mkdir(parents=True, exist_ok=True)
 
-  # generate image sequence
-  for fp_im_mask, fp_im_real in tqdm(zip(fps_ims_mask, fps_ims_real), total=len(fps_ims_real)):
-    
-    #im_mask = cv.cvtColor(cv.imread(fp_im_mask).astype(np.float32), cv.COLOR_BGR2BGRA)
-    im_mask = cv.cvtColor(cv.imread(fp_im_mask), cv.COLOR_BGR2BGRA).astype(np.float32)
-    bg_color = np.array([0.,0.,0.,255.])  # black fill
-    mask_idxs = np.all(im_mask == bg_color, axis=2)
-    im_mask[mask_idxs] = [0,0,0,opt_bg_color]
-
-    im_real = cv.cvtColor(cv.imread(fp_im_real), cv.COLOR_BGR2BGRA).astype(np.float32)
-    im_comp = blend_modes.multiply(im_real, im_mask, 0.5)
-    im_comp = blend_modes.addition(im_comp, im_mask, 0.5)
-    im_comp = cv.cvtColor(im_comp, cv.COLOR_BGRA2BGR)
-    fp_out = Path(opt_dir_ims_comp) / Path(fp_im_mask).name
-    cv.imwrite(str(fp_out), im_comp)
-
-  if not opt_fp_out_video and opt_write_video:
-    opt_fp_out_video = str(Path(opt_dir_ims) / f'{Path(opt_dir_ims).name}.mp4')
-
+  def read_pair(fps_pair):
+    """Decodes mask and real image"""
+    fp_im_mask, fp_im_real = fps_pair
+    return (fp_im_mask, cv.imread(fp_im_mask), cv.imread(fp_im_real))
+
+  def composite(frame):
+    """Blends mask over real image"""
+    fp_im_mask, im_mask, im_real = frame
+    im_comp = im_utils.blend_overlay(im_real, im_mask, opt_bg_color, im_out=im_real)
+    if not opt_no_comp:
+      fp_out = Path(opt_dir_ims_comp) / Path(fp_im_mask).name
+      cv.imwrite(str(fp_out), im_comp)
+    return im_comp
+
+  # stream: prefetch reads -> blend pool -> ordered writer
+  fps_pairs = list(zip(fps_ims_mask, fps_ims_real))
+  frames = sys_utils.imap_threaded(read_pair, fps_pairs, workers=opt_threads, prefetch=opt_prefetch)
+  frames = sys_utils.imap_threaded(composite, frames, workers=opt_threads, prefetch=opt_prefetch)
+
+  writer = None
   if opt_fp_out_video:
-    # glob comp images  
-    fps_ims_comp = sorted([im for im in glob(str(Path(opt_dir_ims_comp) / '*.png'))])
-
-    opt_bitrate = f'{opt_bitrate}M'  # megabits / second
-    num_frames = len(fps_ims_comp)
-    duration_sec = num_frames / opt_fps
-
-    log.debug(f'num images: {len(fps_ims_comp)}')
-    def make_frame(t):
-      #global fps_ims_comp
-      frame_idx = int(np.clip(np.round(t * opt_fps), 0, num_frames - 1))
-      fp_im = fps_ims_comp[frame_idx]
-      im = cv.cvtColor(cv.imread(fp_im), cv.COLOR_BGR2RGB)  # Moviepy uses RGB
-      return im
-
-    log.info(f'Generating movieclip to: {opt_fp_out_video}')
-    VideoClip(make_frame, duration=duration_sec).write_videofile(opt_fp_out_video, fps=opt_fps, codec=opt_codec, bitrate=opt_bitrate)
+    log.info(f'Generating video to: {opt_fp_out_video}')
+  for im_comp in tqdm(frames, total=len(fps_pairs)):
+    if opt_fp_out_video:
+      if writer is None:
+        h, w = im_comp.shape[:2]
+        writer = video_utils.FFmpegWriter(opt_fp_out_video, (w, h), opt_fps, codec=opt_codec,
+          bitrate=f'{opt_bitrate}M')  # megabits / second
+      writer.write(im_comp)
+  if writer is not None:
+    writer.close()
     log.info('Done.')
 
-  if opt_cleanup:
+  if opt_cleanup and Path(opt_dir_ims_comp).is_dir():
     # remove all comp images
     log.info('Removing all temporary images...')
     import shutil
     shutil.rmtree(opt_dir_ims_comp)
-    log.info(f'Deleted {opt_dir_ims_comp}')
\ No newline at end of file
+    log.info(f'Deleted {opt_dir_ims_comp}')
@@ -22,21 +22,20 @@ from app.utils import click_utils
   help='Randomize list')
 @click.option('-f', '--force', 'opt_force', is_flag=True,
   help='Force overwrite video file')
+@click.option('--threads', 'opt_threads', type=int, default=None,
+  help='Number of decode threads. Default is number of CPUs')
 @click.pass_context
-def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_bitrate, opt_codec, opt_ext, 
-  opt_slice, opt_random, opt_force):
+def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_bitrate, opt_codec, opt_ext,
+  opt_slice, opt_random, opt_force, opt_threads):
   """Converts still image sequence to video"""
-  
+
   from glob import glob
   from pathlib import Path
   import random
 
   import cv2 as cv
-  import numpy as np
-  import blend_modes
-  from moviepy.editor import VideoClip
   from tqdm import tqdm
-  from app.utils import file_utils
+  from app.utils import file_utils, sys_utils, video_utils
 
   log = app_cfg.LOG
   log.info('Generating movie file')
@@ -46,7 +45,7 @@ def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_bitrate, opt_codec, opt_ext,
     if Path(opt_fp_out).is_dir() and not opt_force:
       log.error(f'{opt_fp_out} exists. Use "-f/--force" to overwrite')
 
-  # glob comp images  
+  # glob comp images
   fps_im = sorted([im for im in glob(str(Path(opt_dir_in) / f'*.{opt_ext}'))])
   if opt_slice:
     fps_im = fps_im[opt_slice[0]:opt_slice[1]]
@@ -54,17 +53,22 @@ def cli(ctx, opt_dir_in, opt_fp_out, opt_fps, opt_bitrate, opt_codec, opt_ext,
   if opt_random:
     random.shuffle(fps_im)
 
+  if not fps_im:
+    log.error(f'No {opt_ext} images in {opt_dir_in}')
+    return
+
   opt_bitrate = f'{opt_bitrate}M'  # megabits / second
-  num_frames = len(fps_im)
-  duration_sec = num_frames / opt_fps
 
-  def make_frame(t):
-    #global fps_im
-    frame_idx = int(np.clip(np.round(t * opt_fps), 0, num_frames - 1))
-    fp_im = fps_im[frame_idx]
-    im = cv.cvtColor(cv.imread(fp_im), cv.COLOR_BGR2RGB)  # Moviepy uses RGB
-    return im
+  # decode ahead in background threads, encode in frame index order
+  frames = sys_utils.imap_threaded(cv.imread, fps_im, workers=opt_threads)
 
-  log.info('Generating movieclip...')
-  VideoClip(make_frame, duration=duration_sec).write_videofile(opt_fp_out, fps=opt_fps, codec=opt_codec, bitrate=opt_bitrate)
-  log.info('Done.')
\ No newline at end of file
+  log.info('Generating video...')
+  writer = None
+  for im in tqdm(frames, total=len(fps_im)):
+    if writer is None:
+      h, w = im.shape[:2]
+      writer = video_utils.FFmpegWriter(opt_fp_out, (w, h), opt_fps,
+        codec=opt_codec, bitrate=opt_bitrate)
+    writer.write(im)
+  writer.close()
+  log.info('Done.')
@@ -9,36 +9,52 @@ from app.utils import click_utils
   help='Path to project folder (metadata.csv, mask, real)')
 @click.option('-f', '--force', 'opt_force', is_flag=True,
   help='Force overwrite annotations file')
-@click.option('--width', 'opt_width', default=320,
-  help='Image width to process mask at (over 320 is slow)')
+@click.option('--incremental', 'opt_incremental', is_flag=True,
+  help='Only decode new or changed masks and merge with existing annotations')
+@click.option('--width', 'opt_width', default=0,
+  help='Image width to process mask at. Use 0 for native resolution')
+@click.option('--min-pixels', 'opt_min_pixels', default=40, show_default=True,
+  help='Minimum number of mask pixels per annotation')
+@click.option('--instances', 'opt_instances', is_flag=True,
+  help='One annotation per connected component instead of one per color')
+@click.option('--source', 'opt_source', type=click.Choice(['auto', 'mask', 'index']),
+  default='auto', show_default=True,
+  help='Decode color masks or 16-bit object index passes. Auto uses index if there are no masks')
+@click.option('--workers', 'opt_workers', default=1, show_default=True,
+  help='Number of processes to decode masks with')
+@click.option('--chunksize', 'opt_chunksize', default=16, show_default=True,
+  help='Number of masks sent to a worker process at a time')
 @click.pass_context
-def cli(ctx, opt_dir_in, opt_force, opt_width):
+def cli(ctx, opt_dir_in, opt_force, opt_incremental, opt_width, opt_min_pixels,
+  opt_instances, opt_source, opt_workers, opt_chunksize):
   """Converts image, masks, and metadata to CSV annotations"""
-  
+
   from os.path import join
   from glob import glob
   from pathlib import Path
-  from dataclasses import asdict
-  import logging
+  from dataclasses import asdict, fields
+  from functools import partial
+  from multiprocessing import Pool
+  import os
+  import csv
+  import json
+  import hashlib
+  import time
 
   import pandas as pd
-  import cv2 as cv
-  import numpy as np
   from tqdm import tqdm
 
+  from app.models.bbox import BBoxNormLabelColor
   from app.utils import file_utils, color_utils, anno_utils
 
   # init log
   log = app_cfg.LOG
   log.info('Converting masks to annotations')
 
-  # init
-  records = []
-
   # output file
-  fp_annotations = join(opt_dir_in, 'annotations.csv')
-  if Path(fp_annotations).exists() and not opt_force:
-    log.error(f'File exists: {fp_annotations}. Use "-f/--force" to overwrite')
+  fp_annotations = join(opt_dir_in, app_cfg.FN_ANNOTATIONS)
+  if Path(fp_annotations).exists() and not (opt_force or opt_incremental):
+    log.error(f'File exists: {fp_annotations}. Use "-f/--force" or "--incremental" to overwrite')
     return
 
   # load the color coded CSV
@@ -49,45 +65,125 @@ def cli(ctx, opt_dir_in, opt_force, opt_width):
   # glob mask
   fp_dir_im_reals = join(opt_dir_in, app_cfg.DN_REAL)
   fp_dir_im_masks = join(opt_dir_in, app_cfg.DN_MASK)
+  fp_dir_im_index = join(opt_dir_in, app_cfg.DN_INDEX)
   fps_reals = glob(join(fp_dir_im_reals, '*.png'))
-  fps_masks = glob(join(fp_dir_im_masks, '*.png'))
-  if len(fps_masks) != len(fps_reals):
-    log.warn(f'Directories not balanced: {len(fps_masks)} masks != {len(fps_real)}')
-  
-  log.info(f'Converting {len(fps_masks)} mask images to annotations...')
-
-  # iterate through all images
-  for fp_mask in tqdm(fps_masks):
-    fn_mask = Path(fp_mask).name
-    im_mask = cv.imread(fp_mask)
-    w, h = im_mask.shape[:2][::-1]
-    scale = opt_width / w
-    im_mask_sm = cv.resize(im_mask, None, fx=scale, fy=scale, interpolation=cv.INTER_NEAREST)
-
-    # flatten image and find unique colors
-    im_mask_sm_rgb = cv.cvtColor(im_mask_sm, cv.COLOR_BGR2RGB)
-    w_sm, h_sm = im_mask_sm.shape[:2][::-1]
-    im_flat_rgb = im_mask_sm_rgb.reshape((w_sm * h_sm, 3))
-    rgb_unique = np.unique(im_flat_rgb, axis=0)
-
-    # iterate through all colors for all objects
-    for df in df_objects.itertuples():
-      # if the color is found in the image with a large enough area, append bbox
-      rgb_int = (df.color_r, df.color_g, df.color_b)  # RGB uint8
-      found = any([(rgb_int == tuple(c)) for c in rgb_unique])
-      if found:
-        color_hex = f'0x{color_utils.rgb_int_to_hex(rgb_int)}'
-        bbox_norm = anno_utils.color_mask_to_rect(im_mask_sm_rgb, rgb_int)
-        if bbox_norm:
-          bbox_nlc = bbox_norm.to_labeled(df.label, df.label_index, fn_mask).to_colored(color_hex)
-          records.append(asdict(bbox_nlc))
-
-  # Convert to dataframe
-  df_annos = pd.DataFrame.from_dict(records)
-
-  # write CSV
-  df_annos.to_csv(fp_annotations, index=False)
+  fps_masks = sorted(glob(join(fp_dir_im_masks, '*.png')))
+  if opt_source == 'index' or (opt_source == 'auto' and not fps_masks):
+    opt_source = 'index'
+    fps_masks = sorted(glob(join(fp_dir_im_index, '*.png')))
+    log.info(f'Decoding object index passes in {fp_dir_im_index}')
+  else:
+    # resolved so auto and mask runs share the incremental index
+    opt_source = 'mask'
+
+  # build lookup table. Masks are read as BGR, index passes by object pass index
+  colors_bgr = list(zip(df_objects.color_b, df_objects.color_g, df_objects.color_r))
+  if opt_source == 'index':
+    if 'pass_index' not in df_objects.columns:
+      log.error(f'No "pass_index" column in {fp_metadata}. Render with render.mask_mode: index')
+      return
+    lut = anno_utils.build_index_lut(df_objects.pass_index)
+  else:
+    lut = anno_utils.build_color_lut(colors_bgr)
+  objects = [(df.label, df.label_index, f'0x{color_utils.rgb_int_to_hex(bgr[::-1])}') \
+    for df, bgr in zip(df_objects.itertuples(), colors_bgr)]
+  # background variants <mask stem>_vNN share the mask of their camera pose
+  fns_real = {}
+  for fp_real in sorted(fps_reals):
+    stem = Path(fp_real).stem
+    stem_mask, sep, variant = stem.rpartition(app_cfg.VARIANT_SEP)
+    key = stem_mask if sep and variant.isdigit() and opt_source != 'index' else stem
+    fns_real.setdefault(key, []).append(Path(fp_real).name)
+  n_variants = len(fps_reals) - len(fns_real)
+  if n_variants:
+    log.info(f'{len(fps_reals):,} real images share {len(fns_real):,} masks')
+  if len(fps_masks) != len(fns_real):
+    log.warn(f'Directories not balanced: {len(fps_masks)} masks != {len(fns_real)}')
+
+  def real_filenames(fp_mask):
+    """Returns filenames of the real images annotated by a mask"""
+    if not n_variants:
+      return [Path(fp_mask).name]
+    return fns_real.get(Path(fp_mask).stem, [Path(fp_mask).name])
+
+  # masks rendered at a lower resolution keep the real image pixel threshold
+  mask_scale = 1.0
+  if opt_source != 'index' and 'mask_scale' in df_objects.columns:
+    mask_scale = float(df_objects.mask_scale.iloc[0])
+  min_pixels = opt_min_pixels
+  if not opt_width and mask_scale != 1.0:
+    min_pixels = max(1, round(opt_min_pixels * mask_scale ** 2))
+    log.info(f'Masks rendered at {mask_scale:.3g}x resolution, minimum pixels: {min_pixels}')
+
+  mask_to_annos = partial(anno_utils.mask_file_to_annos, lut=lut, objects=objects,
+    width=opt_width, non_zero_thresh=min_pixels, instances=opt_instances)
+
+  def decode(fps):
+    """Yields annotations for each mask in the order of fps"""
+    if opt_workers > 1:
+      with Pool(opt_workers) as pool:
+        yield from tqdm(pool.imap(mask_to_annos, fps, chunksize=opt_chunksize), total=len(fps))
+    else:
+      yield from tqdm(map(mask_to_annos, fps), total=len(fps))
+
+  st = time.time()
+
+  if opt_incremental:
+    # index is only valid for the same metadata and decode settings
+    with open(fp_metadata, 'rb') as fp:
+      settings = {
+        'metadata': hashlib.md5(fp.read()).hexdigest(),
+        'width': opt_width,
+        'min_pixels': opt_min_pixels,
+        'instances': opt_instances,
+        'source': opt_source,
+      }
+    fp_index = join(opt_dir_in, app_cfg.FN_ANNOTATIONS_INDEX)
+    index = {}
+    if Path(fp_index).exists():
+      with open(fp_index, 'r') as fp:
+        index_data = json.load(fp)
+      if index_data.get('settings') == settings:
+        index = index_data.get('masks', {})
+      else:
+        log.warn('Metadata or settings changed since last build. Rebuilding all annotations')
+
+    # fingerprint masks, keep unchanged entries
+    fingerprints = {}
+    for fp_mask in fps_masks:
+      stat = os.stat(fp_mask)
+      fingerprints[Path(fp_mask).name] = [stat.st_size, stat.st_mtime_ns]
+    index = {fn: v for fn, v in index.items() if fingerprints.get(fn) == v.get('fingerprint')}
+    fps_todo = [fp for fp in fps_masks if Path(fp).name not in index]
+    log.info(f'Converting {len(fps_todo):,} new or changed masks ({len(index):,} unchanged)...')
+
+    for fp_mask, annos in zip(fps_todo, decode(fps_todo)):
+      fn_mask = Path(fp_mask).name
+      index[fn_mask] = {'fingerprint': fingerprints[fn_mask], 'annos': [asdict(x) for x in annos]}
+
+    with open(fp_index, 'w') as fp:
+      json.dump({'settings': settings, 'masks': index}, fp)
+    n_decoded = len(fps_todo)
+    annos_iter = (index[Path(fp).name]['annos'] for fp in fps_masks)
+  else:
+    log.info(f'Converting {len(fps_masks):,} mask images to annotations...')
+    n_decoded = len(fps_masks)
+    annos_iter = ([asdict(x) for x in annos] for annos in decode(fps_masks))
+
+  # stream annotations to CSV in filename order, once per real image of a mask
+  n_annos = 0
+  with open(fp_annotations, 'w', newline='') as fp:
+    writer = csv.DictWriter(fp, fieldnames=[f.name for f in fields(BBoxNormLabelColor)])
+    writer.writeheader()
+    for fp_mask, annos in zip(fps_masks, annos_iter):
+      fns = real_filenames(fp_mask)
+      if fns == [Path(fp_mask).name]:
+        writer.writerows(annos)
+      else:
+        writer.writerows({**anno, 'filename': fn} for fn in fns for anno in annos)
+      n_annos += len(annos) * len(fns)
 
   # status
-  log.info(f'Wrote {len(df_annos)} annotations to {fp_annotations} ')
-
+  elapsed = max(time.time() - st, 1e-6)
+  log.info(f'Processed {n_decoded:,} masks in {elapsed:.2f}s ({n_decoded / elapsed:.2f} frames/sec)')
+  log.info(f'Wrote {n_annos} annotations to {fp_annotations} ')
@@ -0,0 +1,103 @@
+"""
+Extracts RGBA object cutouts from real and mask images into a reusable cutout bank
+"""
+
+import click
+
+from app.settings import app_cfg
+
+@click.command()
+@click.option('-i', '--input', 'opt_dir_in', required=True,
+  help='Path to project folder (metadata.csv, mask, real)')
+@click.option('-o', '--output', 'opt_dir_out', default=None,
+  help='Path to cutout bank. Default is <input>/cutouts')
+@click.option('--min-pixels', 'opt_min_pixels', default=400, show_default=True,
+  help='Minimum number of visible pixels per cutout')
+@click.option('--truncated', 'opt_truncated', is_flag=True,
+  help='Keep objects cut off by the image border')
+@click.option('--workers', 'opt_workers', default=None, type=int,
+  help='Number of processes. Default is number of CPUs')
+@click.option('--chunksize', 'opt_chunksize', default=8, show_default=True,
+  help='Number of images sent to a worker process at a time')
+@click.option('-f', '--force', 'opt_force', is_flag=True,
+  help='Force overwrite cutout bank')
+@click.pass_context
+def cli(ctx, opt_dir_in, opt_dir_out, opt_min_pixels, opt_truncated, opt_workers,
+  opt_chunksize, opt_force):
+  """Extracts object cutouts from real and mask images"""
+
+  from os.path import join
+  from glob import glob
+  from pathlib import Path
+  from functools import partial
+  from multiprocessing import Pool
+  import csv
+  import shutil
+  import time
+
+  import pandas as pd
+  from tqdm import tqdm
+
+  from app.utils import anno_utils, color_utils, composite_utils
+
+  log = app_cfg.LOG
+  log.info('Extracting object cutouts')
+
+  opt_dir_out = opt_dir_out or join(opt_dir_in, app_cfg.DN_CUTOUTS)
+  fp_cutouts = join(opt_dir_out, app_cfg.FN_CUTOUTS)
+  if Path(fp_cutouts).exists() and not opt_force:
+    log.error(f'File exists: {fp_cutouts}. Use "-f/--force" to overwrite')
+    return
+
+  fp_metadata = join(opt_dir_in, app_cfg.FN_METADATA)
+  df_objects = pd.read_csv(fp_metadata)
+  colors_bgr = list(zip(df_objects.color_b, df_objects.color_g, df_objects.color_r))
+  objects = [(df.label, df.label_index, f'0x{color_utils.rgb_int_to_hex(bgr[::-1])}') \
+    for df, bgr in zip(df_objects.itertuples(), colors_bgr)]
+
+  # color masks, or object index passes if there are no masks
+  fps_masks = sorted(glob(join(opt_dir_in, app_cfg.DN_MASK, '*.png')))
+  if fps_masks:
+    lut = anno_utils.build_color_lut(colors_bgr)
+  else:
+    fps_masks = sorted(glob(join(opt_dir_in, app_cfg.DN_INDEX, '*.png')))
+    if 'pass_index' not in df_objects.columns:
+      log.error(f'No masks in {opt_dir_in}')
+      return
+    lut = anno_utils.build_index_lut(df_objects.pass_index)
+  masks_by_stem = {Path(fp).stem: fp for fp in fps_masks}
+
+  # every background variant of a camera pose is cut out with the shared mask
+  pairs = []
+  for fp_real in sorted(glob(join(opt_dir_in, app_cfg.DN_REAL, '*.png'))):
+    stem = Path(fp_real).stem
+    stem_mask, sep, variant = stem.rpartition(app_cfg.VARIANT_SEP)
+    fp_mask = masks_by_stem.get(stem) or (masks_by_stem.get(stem_mask) \
+      if sep and variant.isdigit() else None)
+    if fp_mask:
+      pairs.append((fp_real, fp_mask))
+  if not pairs:
+    log.error(f'No real and mask image pairs in {opt_dir_in}')
+    return
+  log.info(f'Cutting {len(objects):,} objects out of {len(pairs):,} images')
+
+  Path(opt_dir_out).mkdir(parents=True, exist_ok=True)
+  shutil.copy(fp_metadata, join(opt_dir_out, app_cfg.FN_METADATA))
+
+  cutout = partial(composite_utils.cutout_file, dir_out=opt_dir_out, lut=lut, objects=objects,
+    min_pixels=opt_min_pixels, truncated=opt_truncated)
+
+  st = time.time()
+  n_cutouts = 0
+  fieldnames = ['filename', 'label', 'label_index', 'color', 'width', 'height', 'pixels',
+    'truncated', 'source']
+  with open(fp_cutouts, 'w', newline='') as fp, Pool(opt_workers) as pool:
+    writer = csv.DictWriter(fp, fieldnames=fieldnames)
+    writer.writeheader()
+    for rows in tqdm(pool.imap(cutout, pairs, chunksize=opt_chunksize), total=len(pairs)):
+      writer.writerows(rows)
+      n_cutouts += len(rows)
+
+  elapsed = max(time.time() - st, 1e-6)
+  log.info(f'Processed {len(pairs):,} images in {elapsed:.2f}s ({len(pairs) / elapsed:.2f} images/sec)')
+  log.info(f'Wrote {n_cutouts:,} cutouts to {opt_dir_out}')
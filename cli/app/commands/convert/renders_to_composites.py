@@ -0,0 +1,119 @@
+"""
+Composites transparent renders onto background photos with transformed annotations
+"""
+
+import click
+
+from app.settings import app_cfg
+
+@click.command()
+@click.option('-i', '--input', 'opt_dir_in', required=True,
+  help='Path to project folder (real, annotations.csv). Render with render.film_transparent')
+@click.option('-b', '--backgrounds', 'opt_dir_bgs', required=True,
+  help='Path to folder of background photos')
+@click.option('-o', '--output', 'opt_dir_out', default=None,
+  help='Path to output folder. Default is <input>/composite')
+@click.option('-n', '--num', 'opt_num', default=10, show_default=True,
+  help='Number of composites per render')
+@click.option('--size', 'opt_size', type=(int, int), default=(0, 0), show_default=True,
+  help='Output width and height. Use 0 0 for render size')
+@click.option('--scale', 'opt_scale', type=(float, float), default=(0.5, 1.0), show_default=True,
+  help='Min and max scale of the rendered objects relative to fitting the output')
+@click.option('--jitter', 'opt_jitter', type=(float, float, float), default=(0.1, 0.1, 0.1),
+  show_default=True, help='Brightness, contrast and saturation jitter of the rendered objects')
+@click.option('--ext', 'opt_ext', type=click.Choice(['jpg', 'png']), default='jpg',
+  show_default=True, help='Output image format')
+@click.option('--seed', 'opt_seed', default=0, show_default=True)
+@click.option('--workers', 'opt_workers', default=None, type=int,
+  help='Number of processes. Default is number of CPUs')
+@click.option('--chunksize', 'opt_chunksize', default=8, show_default=True,
+  help='Number of composites sent to a worker process at a time')
+@click.option('-f', '--force', 'opt_force', is_flag=True,
+  help='Force overwrite annotations file')
+@click.pass_context
+def cli(ctx, opt_dir_in, opt_dir_bgs, opt_dir_out, opt_num, opt_size, opt_scale, opt_jitter,
+  opt_ext, opt_seed, opt_workers, opt_chunksize, opt_force):
+  """Composites transparent renders onto background photos"""
+
+  from os.path import join
+  from glob import glob
+  from pathlib import Path
+  from dataclasses import fields
+  from multiprocessing import Pool
+  import csv
+  import random
+  import shutil
+  import time
+
+  import pandas as pd
+  from tqdm import tqdm
+
+  from app.models.bbox import BBoxNormLabelColor
+  from app.utils import composite_utils
+
+  log = app_cfg.LOG
+  log.info('Compositing renders onto background photos')
+
+  opt_dir_out = opt_dir_out or join(opt_dir_in, app_cfg.DN_COMPOSITE)
+  fp_annotations = join(opt_dir_out, app_cfg.FN_ANNOTATIONS)
+  if Path(fp_annotations).exists() and not opt_force:
+    log.error(f'File exists: {fp_annotations}. Use "-f/--force" to overwrite')
+    return
+
+  # annotations of the renders, from mask_to_bbox
+  fp_annos_in = join(opt_dir_in, app_cfg.FN_ANNOTATIONS)
+  if not Path(fp_annos_in).exists():
+    log.error(f'No annotations: {fp_annos_in}. Run mask_to_bbox first')
+    return
+  df_annos = pd.read_csv(fp_annos_in)
+  annos_by_fn = {fn: df.to_dict('records') for fn, df in df_annos.groupby('filename')}
+
+  fps_reals = sorted(glob(join(opt_dir_in, app_cfg.DN_REAL, '*.png')))
+  exts = ('.jpg', '.jpeg', '.png')
+  fps_bgs = sorted(fp for fp in glob(join(opt_dir_bgs, '**', '*'), recursive=True) \
+    if Path(fp).suffix.lower() in exts)
+  if not fps_reals or not fps_bgs:
+    log.error(f'Found {len(fps_reals)} renders and {len(fps_bgs)} backgrounds')
+    return
+  log.info(f'{len(fps_reals):,} renders x {opt_num} composites from {len(fps_bgs):,} backgrounds')
+
+  dir_out_ims = join(opt_dir_out, app_cfg.DN_REAL)
+  Path(dir_out_ims).mkdir(parents=True, exist_ok=True)
+  # keep the color table with the annotations
+  fp_metadata = join(opt_dir_in, app_cfg.FN_METADATA)
+  if Path(fp_metadata).exists():
+    shutil.copy(fp_metadata, join(opt_dir_out, app_cfg.FN_METADATA))
+
+  # one task per output image, seeded by index so outputs don't depend on scheduling
+  rng = random.Random(opt_seed)
+  def tasks():
+    idx = 0
+    for fp_real in fps_reals:
+      fn = Path(fp_real).name
+      for k in range(opt_num):
+        yield {
+          'fp_fg': fp_real,
+          'fp_bg': rng.choice(fps_bgs),
+          'fp_out': join(dir_out_ims, f'{Path(fn).stem}_{k:04d}.{opt_ext}'),
+          'annos': annos_by_fn.get(fn, []),
+          'dim': opt_size if all(opt_size) else None,
+          'scale': opt_scale,
+          'jitter': opt_jitter,
+          'seed': (opt_seed, idx),
+        }
+        idx += 1
+
+  n_tasks = len(fps_reals) * opt_num
+  st = time.time()
+  n_annos = 0
+  with open(fp_annotations, 'w', newline='') as fp, Pool(opt_workers) as pool:
+    writer = csv.DictWriter(fp, fieldnames=[f.name for f in fields(BBoxNormLabelColor)])
+    writer.writeheader()
+    results = pool.imap(composite_utils.composite_file, tasks(), chunksize=opt_chunksize)
+    for annos in tqdm(results, total=n_tasks):
+      writer.writerows(annos)
+      n_annos += len(annos)
+
+  elapsed = max(time.time() - st, 1e-6)
+  log.info(f'Wrote {n_tasks:,} composites in {elapsed:.2f}s ({n_tasks / elapsed:.2f} images/sec)')
+  log.info(f'Wrote {n_annos:,} annotations to {fp_annotations}')
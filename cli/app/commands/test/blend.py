@@ -0,0 +1,67 @@
+"""
+Benchmarks the overlay blend kernel against blend_modes
+"""
+import click
+
+from app.settings import app_cfg
+
+
+@click.command()
+@click.option('--iters', 'opt_iters', default=10, show_default=True,
+  help='Number of timed iterations per size')
+@click.option('--bg', 'opt_bg_color', default=125, type=click.IntRange(0,255),
+  show_default=True, help='Background color')
+@click.pass_context
+def cli(ctx, opt_iters, opt_bg_color):
+  """Benchmark uint8 overlay blend vs blend_modes"""
+
+  import time
+
+  import cv2 as cv
+  import numpy as np
+  import blend_modes
+
+  from app.utils import im_utils
+
+  log = app_cfg.LOG
+  log.info('Benchmarking overlay blend')
+
+  def blend_float(im_real, im_mask):
+    """Reference float32 blend_modes path from images_to_overlays"""
+    im_mask = cv.cvtColor(im_mask, cv.COLOR_BGR2BGRA).astype(np.float32)
+    mask_idxs = np.all(im_mask == np.array([0.,0.,0.,255.]), axis=2)
+    im_mask[mask_idxs] = [0,0,0,opt_bg_color]
+    im_real = cv.cvtColor(im_real, cv.COLOR_BGR2BGRA).astype(np.float32)
+    im_comp = blend_modes.multiply(im_real, im_mask, 0.5)
+    im_comp = blend_modes.addition(im_comp, im_mask, 0.5)
+    im_comp = cv.cvtColor(im_comp, cv.COLOR_BGRA2BGR)
+    return np.clip(np.round(im_comp), 0, 255).astype(np.uint8)
+
+  sizes = {'1080p': (1920, 1080), '4K': (3840, 2160)}
+  rng = np.random.default_rng(0)
+
+  for name, (w, h) in sizes.items():
+    im_real = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    # mask with black background and random color fill areas
+    im_mask = np.zeros_like(im_real)
+    for _ in range(200):
+      x, y = rng.integers(0, w), rng.integers(0, h)
+      color = tuple(int(c) for c in rng.integers(1, 256, 3))
+      cv.circle(im_mask, (int(x), int(y)), int(rng.integers(5, h // 8)), color, -1)
+
+    im_ref = blend_float(im_real, im_mask)
+    st = time.perf_counter()
+    for _ in range(opt_iters):
+      blend_float(im_real, im_mask)
+    t_float = (time.perf_counter() - st) / opt_iters
+
+    im_out = np.empty_like(im_real)
+    im_utils.blend_overlay(im_real, im_mask, opt_bg_color, im_out=im_out)
+    err = int(np.abs(im_out.astype(np.int16) - im_ref).max())
+    st = time.perf_counter()
+    for _ in range(opt_iters):
+      im_utils.blend_overlay(im_real, im_mask, opt_bg_color, im_out=im_out)
+    t_uint8 = (time.perf_counter() - st) / opt_iters
+
+    log.info(f'{name}: blend_modes {t_float * 1000:.1f} ms, uint8 {t_uint8 * 1000:.1f} ms, '
+      f'speedup {t_float / t_uint8:.1f}x, max error {err} LSB')
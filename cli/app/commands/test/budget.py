@@ -0,0 +1,62 @@
+"""
+Simulates the render time budget controller on frames of varying complexity
+"""
+import click
+
+from app.settings import app_cfg
+
+
+@click.command()
+@click.option('-n', '--frames', 'opt_frames', default=500, show_default=True)
+@click.option('--target', 'opt_target', default=5.0, show_default=True,
+  help='Target seconds per frame')
+@click.option('--samples', 'opt_samples', default=256, show_default=True,
+  help='Fixed sample count to compare with')
+@click.option('--mode', 'opt_mode', type=click.Choice(['samples', 'threshold']),
+  default='samples', show_default=True)
+@click.option('--seed', 'opt_seed', default=0, show_default=True)
+@click.pass_context
+def cli(ctx, opt_frames, opt_target, opt_samples, opt_mode, opt_seed):
+  """Simulate render budget vs fixed quality"""
+
+  import random
+
+  import numpy as np
+
+  from app.utils.render_budget_utils import RenderBudget
+
+  log = app_cfg.LOG
+  log.info(f'Simulating render budget, target: {opt_target}s per frame')
+
+  rng = random.Random(opt_seed)
+  # scene complexity drifts with particle iterations, with occasional pathological frames
+  complexity = []
+  level = 1.0
+  for i in range(opt_frames):
+    if i % 20 == 0:
+      level = rng.lognormvariate(0, 0.6)
+    spike = 8.0 if rng.random() < 0.03 else 1.0
+    complexity.append(level * spike * rng.uniform(0.9, 1.1))
+
+  def render_time(c, samples, threshold):
+    """Sync overhead plus sampling time. A higher threshold converges earlier"""
+    return 0.5 + c * samples * 0.02 * (0.01 / threshold) ** 0.5
+
+  threshold_default = 0.01
+  times_fixed = [render_time(c, opt_samples, threshold_default) for c in complexity]
+
+  budget = RenderBudget(opt_target, samples=(16, 1024), mode=opt_mode)
+  samples, threshold = opt_samples, threshold_default
+  times_budget, samples_used = [], []
+  for c in complexity:
+    t = render_time(c, samples, threshold)
+    times_budget.append(t)
+    samples_used.append(samples)
+    samples, threshold = budget.update(t, samples, threshold)
+
+  for name, times in (('fixed', times_fixed), ('budget', times_budget)):
+    times = np.array(times)
+    log.info(f'{name}: total {times.sum() / 60:.1f} min, mean {times.mean():.2f}s, '
+      f'p95 {np.percentile(times, 95):.2f}s, max {times.max():.2f}s')
+  log.info(f'budget samples: min {min(samples_used)}, median {int(np.median(samples_used))}, '
+    f'max {max(samples_used)}')
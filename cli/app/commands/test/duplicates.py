@@ -0,0 +1,75 @@
+"""
+Benchmarks duplicate indexing for particle make_real and clear_real
+"""
+import click
+
+from app.settings import app_cfg
+
+
+@click.command()
+@click.option('-n', '--num', 'opt_nums', multiple=True, type=int, default=(100, 1000, 10000),
+  show_default=True, help='Number of particle duplicates')
+@click.option('--bases', 'opt_bases', default=20, show_default=True,
+  help='Number of source objects in the particle system')
+@click.option('--scene', 'opt_scene', default=500, show_default=True,
+  help='Number of other scene objects')
+@click.pass_context
+def cli(ctx, opt_nums, opt_bases, opt_scene):
+  """Benchmark duplicate registry vs list scans"""
+
+  import time
+  from pathlib import Path
+
+  from app.utils.duplicate_utils import DuplicateRegistry
+
+  log = app_cfg.LOG
+  log.info('Benchmarking duplicate registry')
+
+  base_names = [f'object_{i:02d}' for i in range(opt_bases)]
+  scene_names = [f'scene_{i:04d}' for i in range(opt_scene)] + base_names
+
+  for n in opt_nums:
+    # Blender names duplicates "<source>.<nnn>" and keeps bpy.data.objects sorted
+    dupe_names = [f'{base_names[i % opt_bases]}.{i // opt_bases + 1:03d}' for i in range(n)]
+    names_after = sorted(scene_names + dupe_names)
+    system_keys = {x: None for x in base_names}.keys()
+
+    # legacy make_real and clear_real list scans
+    st = time.perf_counter()
+    names_ignore = [x for x in scene_names if x not in system_keys]
+    names_objects = [x for x in names_after if x not in names_ignore]
+    names_new = [x for x in names_objects if not any(y == x for y in system_keys)]
+    dupes_legacy = {x: [] for x in base_names}
+    for new_name in names_new:
+      new_stem = Path(new_name).stem
+      for base_name in system_keys:
+        if new_stem == base_name:
+          dupes_legacy[base_name].append(new_name)
+    t_match_legacy = time.perf_counter() - st
+    st = time.perf_counter()
+    n_removed = 0
+    for base_name in base_names:
+      for dupe_name in dupes_legacy[base_name]:
+        if dupe_name in names_after:  # bpy.data.objects.keys()
+          n_removed += 1
+    t_clear_legacy = time.perf_counter() - st
+
+    # registry
+    st = time.perf_counter()
+    registry = DuplicateRegistry(base_names)
+    matches = registry.register_new(scene_names, names_after)
+    t_match = time.perf_counter() - st
+    st = time.perf_counter()
+    objects = set(names_after)
+    ids = [x for x in registry.all_duplicates() if x in objects]
+    t_clear = time.perf_counter() - st
+
+    # pass index offsets per base object must be distinct and consecutive
+    ordinals = {x: [] for x in base_names}
+    for base_name, name, ordinal in matches:
+      ordinals[base_name].append(ordinal)
+    ok_pass_index = all(v == list(range(len(registry.duplicates[k]))) \
+      for k, v in ordinals.items())
+    ok = registry.duplicates == dupes_legacy and len(ids) == n_removed == n and ok_pass_index
+    log.info(f'{n:,} duplicates: make_real {t_match_legacy * 1000:.1f} -> {t_match * 1000:.2f} ms, '
+      f'clear_real {t_clear_legacy * 1000:.1f} -> {t_clear * 1000:.2f} ms, match: {ok}')
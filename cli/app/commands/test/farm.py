@@ -0,0 +1,124 @@
+"""
+Tests the render farm launcher with a stub Blender binary
+"""
+import click
+
+from app.settings import app_cfg
+
+# Stands in for Blender: parses generator args after "--", writes one file per
+# iteration, appends render quality and annotation rows to its shard files,
+# updates the progress file and crashes once at iterations in --crash, after
+# writing the annotation row but before marking the frame annotated
+STUB_BLENDER = '''#!{python}
+import os, sys, shlex, time
+sys.path.insert(0, {dir_cli!r})
+from app.utils import anno_utils, farm_utils
+argv = shlex.split(' '.join(sys.argv[sys.argv.index('--') + 1:]))
+opts = dict(zip(argv[::2], argv[1::2]))
+start, end = int(opts['--checkpoint']), int(opts['--end'])
+dir_out, crash = {dir_out!r}, {crash!r}
+key = farm_utils.shard_key(opts['--progress'])
+fp_quality = farm_utils.shard_filepath(os.path.join(dir_out, 'render_quality.csv'), key)
+fp_annos = farm_utils.shard_filepath(os.path.join(dir_out, 'annotations.csv'), key)
+fp_annotated = farm_utils.shard_filepath(os.path.join(dir_out, 'annotated_frames.txt'), key)
+anno_utils.load_annotated(fp_annos, fp_annotated)
+
+def append_row(fp, header, row):
+  write_header = not os.path.exists(fp)
+  with open(fp, 'a') as f:
+    f.write(header + '\\n' if write_header else '')
+    f.write(row + '\\n')
+
+for i in range(start, end):
+  fn = f'emitter_{{i:04d}}.png'
+  fp_crashed = os.path.join(dir_out, f'crashed_{{i}}')
+  if i in crash and not os.path.exists(fp_crashed):
+    open(fp_crashed, 'w').close()
+    append_row(fp_annos, 'filename,label', f'{{fn}},interrupted')
+    print(f'crash at {{i}}', flush=True)
+    os._exit(1)
+  time.sleep({delay})
+  open(os.path.join(dir_out, fn), 'w').close()
+  append_row(fp_quality, 'filename,samples', f'{{fn}},16')
+  append_row(fp_annos, 'filename,label', f'{{fn}},object')
+  with open(fp_annotated, 'a') as f:
+    f.write(fn + '\\n')
+  fp = opts['--progress']
+  with open(fp + '.tmp', 'w') as f:
+    f.write(str(i + 1))
+  os.replace(fp + '.tmp', fp)
+  print(f'rendered {{i}}', flush=True)
+'''
+
+
+@click.command()
+@click.option('--iterations', 'opt_iterations', default=50, show_default=True)
+@click.option('--workers', 'opt_workers', default=4, show_default=True)
+@click.option('--crash', 'opt_crash', multiple=True, type=int, default=(3, 17, 18),
+  show_default=True, help='Iterations where the stub crashes once')
+@click.option('--delay', 'opt_delay', default=0.02, show_default=True,
+  help='Seconds per stub iteration')
+@click.pass_context
+def cli(ctx, opt_iterations, opt_workers, opt_crash, opt_delay):
+  """Run render farm against stub Blender binary"""
+
+  import os
+  import sys
+  import tempfile
+  from os.path import join
+  from glob import glob
+
+  import pandas as pd
+  from tqdm import tqdm
+
+  from app.utils import farm_utils, anno_utils
+
+  log = app_cfg.LOG
+  log.info('Testing render farm with stub Blender')
+
+  with tempfile.TemporaryDirectory() as dir_tmp:
+    dir_out = join(dir_tmp, 'out')
+    os.makedirs(dir_out)
+    fp_stub = join(dir_tmp, 'blender')
+    with open(fp_stub, 'w') as fp:
+      fp.write(STUB_BLENDER.format(python=sys.executable, dir_cli=app_cfg.DIR_CLI,
+        dir_out=dir_out, crash=set(opt_crash), delay=opt_delay))
+    os.chmod(fp_stub, 0o755)
+
+    def build_args(shard, checkpoint):
+      return [fp_stub, 'scene.blend', '--background', '--python', 'static.py', '--',
+        f'--checkpoint {checkpoint}', f'--end {shard.end}', f'--progress {shard.fp_progress}']
+
+    shards = farm_utils.build_shards(0, opt_iterations, opt_workers, join(dir_tmp, 'logs'))
+    farm = farm_utils.RenderFarm(build_args, shards, max_restarts=2, poll=0.05, log=log)
+    with tqdm(total=opt_iterations, desc='Iterations') as pbar:
+      ok = farm.run(pbar=pbar)
+
+    fps_out = sorted(glob(join(dir_out, '*.png')))
+    expected = [join(dir_out, f'emitter_{i:04d}.png') for i in range(opt_iterations)]
+    restarts = sum(s.restarts for s in shards)
+
+    # shards write their own quality files, merged into one with a single header
+    fp_quality = join(dir_out, app_cfg.FN_RENDER_QUALITY)
+    farm_utils.merge_csv(fp_quality, [farm_utils.shard_filepath(fp_quality, s.key) \
+      for s in shards])
+    fns_quality = sorted(pd.read_csv(fp_quality).filename)
+    ok_quality = fns_quality == [os.path.basename(fp) for fp in expected] \
+      and not glob(join(dir_out, 'render_quality.*.csv'))
+    log.info(f'Quality rows merged: {ok_quality}')
+
+    # interrupted annotation rows are dropped, one row per frame is merged
+    fp_annos = join(dir_out, app_cfg.FN_ANNOTATIONS)
+    fp_annotated = join(dir_out, app_cfg.FN_ANNOTATED_FRAMES)
+    anno_utils.merge_annotations(fp_annos, fp_annotated, [s.key for s in shards])
+    df_annos = pd.read_csv(fp_annos)
+    ok_annos = sorted(df_annos.filename) == [os.path.basename(fp) for fp in expected] \
+      and set(df_annos.label) == {'object'} \
+      and anno_utils.read_annotated(fp_annotated) == set(df_annos.filename) \
+      and not glob(join(dir_out, '*.*.*'))
+    log.info(f'Annotations merged: {ok_annos}')
+
+    if ok and fps_out == expected and ok_quality and ok_annos:
+      log.info(f'Passed: {len(fps_out)} files from {len(shards)} shards, {restarts} restarts')
+    else:
+      log.error(f'Failed: {len(fps_out)}/{opt_iterations} files, failed shards: {farm.failed}')
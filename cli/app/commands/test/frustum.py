@@ -0,0 +1,87 @@
+"""
+Tests bounding box projection for the pre-render visibility check and
+vertex projection for geometric annotations
+"""
+import click
+
+from app.settings import app_cfg
+
+
+@click.command()
+@click.option('-n', '--num', 'opt_num', default=10000, show_default=True,
+  help='Number of random boxes to time')
+@click.pass_context
+def cli(ctx, opt_num):
+  """Test camera frustum projected areas"""
+
+  import time
+
+  import numpy as np
+
+  from app.utils.frustum_utils import CameraFrustum, box_corners, transform_points
+
+  log = app_cfg.LOG
+  log.info('Testing camera frustum projection')
+
+  # camera 10m above the origin looking down -Z, 50mm lens on a 36mm sensor
+  matrix_cam = np.eye(4)
+  matrix_cam[:3, 3] = (0, 0, 10)
+  frustum = CameraFrustum(matrix_cam, 50, 36, (1920, 1080))
+
+  # sensor edge maps to the image edge
+  uv, depth = frustum.project([(0, 0, 0), (3.6, 0, 0), (0, 3.6 * 1080 / 1920, 0)])
+  ok_project = np.allclose(uv, [(0.5, 0.5), (1, 0.5), (0.5, 1)]) and np.allclose(depth, 10)
+
+  # lens shift 0.1 right and up, Blender's world_to_camera_view of the same points
+  frustum_shift = CameraFrustum(matrix_cam, 50, 36, (1920, 1080), shift=(0.1, 0.1))
+  uv, _ = frustum_shift.project([(0, 0, 0), (3.6, 0, 0), (0, 3.6 * 1080 / 1920, 0)])
+  v_shift = 0.1 * 1920 / 1080
+  ok_shift = np.allclose(uv, [(0.4, 0.5 - v_shift), (0.9, 0.5 - v_shift), (0.4, 1 - v_shift)])
+
+  # unit cubes: centered, out of frame, behind the camera, around the camera
+  unit = np.array([(x, y, z) for x in (-.5, .5) for y in (-.5, .5) for z in (-.5, .5)])
+  locations = [(0, 0, 0), (100, 0, 0), (0, 0, 20), (0, 0, 10)]
+  matrices = np.tile(np.eye(4), (len(locations), 1, 1))
+  matrices[:, :3, 3] = locations
+  areas = frustum.projected_areas(box_corners(matrices, np.tile(unit, (len(locations), 1, 1))))
+  # front face at 9.5m: 1m covers 50 / 36 / 9.5 of the width
+  w = 50 / 36 / 9.5
+  ok_areas = np.allclose(areas, [w * w * 1920 / 1080, 0, 0, 1])
+  log.info(f'projection: {ok_project}, shift: {ok_shift}, areas: {ok_areas} {np.round(areas, 4).tolist()}')
+
+  rng = np.random.default_rng(0)
+  matrices = np.tile(np.eye(4), (opt_num, 1, 1))
+  matrices[:, :3, 3] = rng.uniform(-20, 5, (opt_num, 3))
+  corners = box_corners(matrices, np.tile(unit, (opt_num, 1, 1)))
+  st = time.perf_counter()
+  areas = frustum.projected_areas(corners)
+  elapsed = time.perf_counter() - st
+  log.info(f'{opt_num:,} boxes in {elapsed * 1000:.2f} ms, {int((areas > 0).sum()):,} in view')
+
+  # vertex boxes: cube surface points, a cube partly hidden behind it and one out of view
+  t = np.linspace(-.5, .5, 11)
+  face = np.array([(a, b) for a in t for b in t])
+  surface = np.concatenate([np.insert(face, axis, side, axis=1) \
+    for axis in range(3) for side in (-.5, .5)])
+  matrices = np.tile(np.eye(4), (3, 1, 1))
+  matrices[:, :3, 3] = [(0, 0, 0), (0.8, 0, -3), (100, 0, 0)]
+  points = transform_points(matrices, surface)
+  ids = np.repeat(np.arange(3), len(surface))
+  boxes, in_view, visible = frustum.project_boxes(points.reshape(-1, 3), ids, 3, grid=(64, 36))
+  # the front face at 9.5m, centered
+  hw, hh = w / 2, w * 1920 / 1080 / 2
+  ok_boxes = np.allclose(boxes[0], [0.5 - hw, 0.5 - hh, 0.5 + hw, 0.5 + hh]) \
+    and in_view.tolist() == [True, True, False]
+  ok_visible = visible[0] == 1 and 0 < visible[1] < 1 and visible[2] == 0
+  log.info(f'vertex boxes: {ok_boxes}, occlusion: {ok_visible} {np.round(visible, 3).tolist()}')
+
+  n_verts = 1000
+  points = transform_points(matrices[:1].repeat(opt_num // 10, axis=0),
+    rng.uniform(-.5, .5, (n_verts, 3)))
+  points[:] += rng.uniform(-20, 5, (len(points), 1, 3))
+  ids = np.repeat(np.arange(len(points)), n_verts)
+  st = time.perf_counter()
+  boxes, in_view, _ = frustum.project_boxes(points.reshape(-1, 3), ids, len(points))
+  elapsed = time.perf_counter() - st
+  log.info(f'{len(points):,} objects x {n_verts:,} vertices in {elapsed * 1000:.2f} ms, '
+    f'{int(in_view.sum()):,} in view')
@@ -0,0 +1,129 @@
+"""
+Benchmarks material swap tables against name lookups with a bpy stand-in
+"""
+import click
+
+from app.settings import app_cfg
+
+
+class StandInSlot:
+  def __init__(self, material):
+    self.material = material
+
+
+class StandInObject:
+  def __init__(self, name, materials):
+    self.name = name
+    self.material_slots = [StandInSlot(m) for m in materials]
+    self.hide_render = False
+    self.hide_viewport = False
+
+  @property
+  def active_material(self):
+    return self.material_slots[0].material
+
+  @active_material.setter
+  def active_material(self, material):
+    self.material_slots[0].material = material
+
+
+class StandInCollection:
+  '''Name lookups scan the list, like bpy.data ID collections'''
+  def __init__(self, items):
+    self.items = list(items)
+
+  def get(self, name):
+    for item in self.items:
+      if item.name == name:
+        return item
+    return None
+
+  def keys(self):
+    return [item.name for item in self.items]
+
+
+class StandInMaterial:
+  def __init__(self, name):
+    self.name = name
+
+
+@click.command()
+@click.option('-n', '--num', 'opt_nums', multiple=True, type=int, default=(100, 1000, 5000),
+  show_default=True, help='Number of particle duplicates')
+@click.option('--slots', 'opt_slots', default=2, show_default=True,
+  help='Material slots per object')
+@click.option('--iters', 'opt_iters', default=5, show_default=True,
+  help='Number of timed mask/unmask cycles')
+@click.pass_context
+def cli(ctx, opt_nums, opt_slots, opt_iters):
+  """Benchmark mask/unmask swap tables vs name lookups"""
+
+  import time
+
+  from app.utils.swap_utils import MaterialSwapTable
+
+  log = app_cfg.LOG
+  log.info('Benchmarking material swap tables')
+
+  for n in opt_nums:
+    # scene: one source object with n duplicates, each with its own colorfill material
+    mats_real = [StandInMaterial(f'mat_real_{i}') for i in range(opt_slots)]
+    mats_cf = [StandInMaterial(f'obj_colorfill_{i}') for i in range(n)]
+    dupes = [StandInObject(f'obj.{i:05d}', mats_real) for i in range(n)]
+    objects = StandInCollection(dupes)
+    materials = StandInCollection(mats_real + mats_cf)
+    obj = {
+      'material': mats_real[0].name,
+      'material_slots': mats_real,
+      'materials': [m.name for m in mats_cf],
+      'duplicates': [o.name for o in dupes],
+    }
+
+    def mask_lookup():
+      """Emitter.mask name lookups per object and slot"""
+      for idx, dupe_name in enumerate(obj['duplicates']):
+        obj_scene = objects.get(dupe_name)
+        material_cf = materials.get(obj['materials'][idx])
+        obj_scene.active_material = material_cf
+        for material_slot in obj_scene.material_slots:
+          material_slot.material = material_cf
+
+    def unmask_lookup():
+      """Emitter.unmask name lookups per object and slot"""
+      for dupe_name in obj['duplicates']:
+        obj_scene = objects.get(dupe_name)
+        obj_scene.active_material = materials.get(obj['material'])
+        for i in range(len(obj['material_slots'])):
+          obj_scene.material_slots[i].material = obj['material_slots'][i]
+
+    st = time.perf_counter()
+    for _ in range(opt_iters):
+      mask_lookup()
+      unmask_lookup()
+    t_lookup = (time.perf_counter() - st) / opt_iters
+
+    # Emitter.build_swap_table: resolve names in one pass over each collection
+    st = time.perf_counter()
+    table = MaterialSwapTable()
+    objects_by_name = {o.name: o for o in objects.items}
+    materials_by_name = {m.name: m for m in materials.items}
+    for idx, dupe_name in enumerate(obj['duplicates']):
+      table.add(objects_by_name.get(dupe_name), obj['material_slots'],
+        materials_by_name.get(obj['materials'][idx]))
+    t_build = time.perf_counter() - st
+
+    # verify table reproduces lookup results
+    mask_lookup()
+    ref = [[s.material for s in o.material_slots] for o in dupes]
+    unmask_lookup()
+    table.mask()
+    ok = ref == [[s.material for s in o.material_slots] for o in dupes]
+
+    st = time.perf_counter()
+    for _ in range(opt_iters):
+      table.mask(force=True)
+      table.unmask(force=True)
+    t_table = (time.perf_counter() - st) / opt_iters
+
+    log.info(f'{n:,} objects: lookup {t_lookup * 1000:.2f} ms, table {t_table * 1000:.2f} ms '
+      f'({t_lookup / t_table:.1f}x), build {t_build * 1000:.2f} ms, match: {ok}')
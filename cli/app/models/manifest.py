@@ -0,0 +1,238 @@
+"""
+Render job manifest
+- expands a generator config into a fixed list of render jobs before rendering
+- all random draws are made here so a resumed or sharded run renders exactly
+  what an uninterrupted run would have rendered
+- no Blender imports, can be planned from the CLI
+"""
+
+import random
+from dataclasses import dataclass, asdict, fields
+from os.path import join
+from pathlib import Path
+
+from app.settings import app_cfg
+from app.utils.file_utils import zpad
+
+
+ANNOTATE_MASK = 1  # boxes from the mask render result
+ANNOTATE_GEOMETRY = 2  # boxes from projected mesh vertices, no mask render
+
+
+def annotate_mode(cfg_render):
+  '''Returns how frames are annotated while rendering
+  :param cfg_render: (dict) render config
+  :returns (int) 0 for mask_to_bbox after rendering, ANNOTATE_MASK or ANNOTATE_GEOMETRY
+  '''
+  cfg_annotate = cfg_render.get('annotate')
+  if not cfg_annotate:
+    return 0
+  mode = cfg_annotate.get('mode', 'mask') if isinstance(cfg_annotate, dict) else 'mask'
+  if str(mode).lower() == 'geometry':
+    # geometry is annotated in the real render step, for the real image filenames
+    if not cfg_render.get('save_real', True):
+      raise ValueError('render.annotate mode: geometry requires save_real: True')
+    return ANNOTATE_GEOMETRY
+  # index masks are only written to disk
+  if str(cfg_render.get('mask_mode', 'render')).lower() == 'index':
+    return 0
+  return ANNOTATE_MASK
+
+
+@dataclass
+class RenderJob:
+  '''One rendered frame. Output paths are relative to the render output directory'''
+  job_idx: int
+  particle_idx: int
+  emitter_seed: int
+  cam_idx: int
+  cam_rot: int
+  jitter_loc_x: float
+  jitter_loc_y: float
+  jitter_loc_z: float
+  jitter_target_x: float
+  jitter_target_y: float
+  jitter_target_z: float
+  env_idx: int  # -1 keeps the current environment
+  world_rot_deg: int
+  fp_real: str = ''
+  fp_mask: str = ''
+  fp_index: str = ''
+  variant: int = 0  # background variant of the same geometry and camera pose
+  annotate: int = 0  # ANNOTATE_MASK or ANNOTATE_GEOMETRY, annotated in Blender
+
+  @property
+  def fn_anno(self):
+    '''Returns the image filename annotated by this job'''
+    return Path(self.fp_real or self.fp_mask).name
+
+  @property
+  def jitter_location(self):
+    return (self.jitter_loc_x, self.jitter_loc_y, self.jitter_loc_z)
+
+  @property
+  def jitter_target(self):
+    return (self.jitter_target_x, self.jitter_target_y, self.jitter_target_z)
+
+  def outputs(self, dir_out):
+    '''Returns absolute paths of all outputs for this job'''
+    return [join(dir_out, fp) for fp in (self.fp_real, self.fp_mask, self.fp_index) if fp]
+
+  def is_complete(self, dir_out):
+    '''Returns True if every output exists and is not empty'''
+    return all(Path(fp).is_file() and Path(fp).stat().st_size > 0 for fp in self.outputs(dir_out))
+
+
+def draw_offset(rng, delta):
+  '''Draws a camera jitter offset. Used by planning and visibility re-rolls
+  :param rng: random.Random
+  :param delta: (float, float, float) max XYZ offset, or None
+  :returns list of XYZ offsets
+  '''
+  # rounded so planned and reloaded manifests match exactly
+  return [round(rng.uniform(-d, d), 6) for d in (delta or (0, 0, 0))]
+
+
+def variant_stem(stem, variant, n_variants):
+  '''Returns the real image filename stem of a background variant. Variants of
+  one camera pose share the mask named by the stem without variant suffix
+  '''
+  return f'{stem}{app_cfg.VARIANT_SEP}{variant:02d}' if n_variants > 1 else stem
+
+
+class RenderManifest:
+  '''Ordered list of RenderJobs grouped by particle iteration'''
+
+  def __init__(self, jobs):
+    self.jobs = jobs
+    self._by_particle = {}
+    for job in jobs:
+      self._by_particle.setdefault(job.particle_idx, []).append(job)
+
+  def __len__(self):
+    return len(self.jobs)
+
+  @property
+  def iterations(self):
+    return len(self._by_particle)
+
+  def jobs_for(self, particle_idx):
+    '''Returns jobs for one particle iteration in render order'''
+    return self._by_particle.get(particle_idx, [])
+
+  @classmethod
+  def plan(cls, cfg, seed=0):
+    '''Expands a generator config into render jobs
+    :param cfg: (dict) generator YAML config
+    :param seed: (int) seed for all random draws
+    :returns RenderManifest
+    '''
+    rng = random.Random(seed)
+
+    cfg_render = cfg.get('render', {})
+    cfg_output = cfg_render.get('output', {})
+    prefix = cfg_output.get('filename_prefix') or ''
+    ext = cfg_output.get('file_format', 'PNG').lower()
+    save_real = cfg_render.get('save_real', True)
+    save_mask = cfg_render.get('save_mask', True)
+    # index masks are written from the real render
+    save_index = str(cfg_render.get('mask_mode', 'render')).lower() == 'index'
+    if save_index:
+      save_real, save_mask = True, False
+
+    # boxes from the mask render result or geometry. Masks are rendered even if not saved
+    annotate = annotate_mode(cfg_render)
+
+    # real variants with different backgrounds share the mask of variant 0
+    n_variants = max(1, int(cfg_render.get('variants', 1)))
+
+    views = cfg.get('camera', {}).get('views', [])
+    n_envs = len(cfg.get('world', {}).get('backgrounds', []) or [])
+    n_iters = cfg.get('particle_system', {}).get('iterations', 0)
+
+    jobs = []
+    for particle_idx in range(n_iters):
+      emitter_seed = rng.randrange(2**31)
+      for cam_idx, view in enumerate(views):
+        for cam_rot in range(1, int(view.get('frames', 1)) + 1):
+          loc = draw_offset(rng, view.get('jitter_location'))
+          target = draw_offset(rng, view.get('jitter_target'))
+          stem = f'{prefix}emitter_{zpad(particle_idx)}_cam_{zpad(cam_idx)}_{zpad(cam_rot)}'
+          for variant in range(n_variants):
+            env_idx = rng.randint(0, n_envs - 1) if n_envs else -1
+            world_rot_deg = rng.randint(0, 360)
+            fname = f'{variant_stem(stem, variant, n_variants)}.{ext}'
+            jobs.append(RenderJob(len(jobs), particle_idx, emitter_seed, cam_idx, cam_rot,
+              *loc, *target, env_idx, world_rot_deg,
+              fp_real=join(app_cfg.DN_REAL, fname) if save_real else '',
+              fp_mask=join(app_cfg.DN_MASK, f'{stem}.{ext}') if save_mask and not variant else '',
+              fp_index=join(app_cfg.DN_INDEX, f'{Path(fname).stem}.png') if save_index else '',
+              variant=variant, annotate=0 if variant else annotate))
+    return cls(jobs)
+
+  def save(self, fp):
+    '''Writes manifest as CSV, gzip compressed if path ends with .gz'''
+    import pandas as pd
+    df = pd.DataFrame([asdict(j) for j in self.jobs], columns=[f.name for f in fields(RenderJob)])
+    df.to_csv(fp, index=False, compression='infer')
+
+  @classmethod
+  def load(cls, fp):
+    '''Reads manifest CSV'''
+    import pandas as pd
+    df = pd.read_csv(fp, keep_default_na=False, compression='infer')
+    types = {f.name: f.type for f in fields(RenderJob)}
+    jobs = [RenderJob(**{k: types[k](v) for k, v in row.items()})
+      for row in df.to_dict('records')]
+    return cls(jobs)
+
+
+# ---------------------------------------------------------------------------
+# Scheduling
+# ---------------------------------------------------------------------------
+
+STATE_REAL = 'real'
+STATE_MASK = 'mask'
+
+
+def interleaved_steps(jobs):
+  '''Returns render steps in job order, alternating real and mask per frame
+  :param jobs: list of RenderJob
+  :returns list of (state, RenderJob)
+  '''
+  steps = []
+  for job in jobs:
+    if job.fp_real:
+      steps.append((STATE_REAL, job))
+    if job.fp_mask or job.annotate == ANNOTATE_MASK:
+      steps.append((STATE_MASK, job))
+  return steps
+
+
+def schedule_steps(jobs):
+  '''Orders render steps to minimize scene state changes. All real frames come
+  first, grouped by environment image, then all mask frames in one masked state
+  :param jobs: list of RenderJob for one particle iteration
+  :returns list of (state, RenderJob)
+  '''
+  # stable sort keeps job order within an environment
+  jobs_real = sorted([j for j in jobs if j.fp_real], key=lambda j: j.env_idx)
+  jobs_mask = [j for j in jobs if j.fp_mask or j.annotate == ANNOTATE_MASK]
+  return [(STATE_REAL, j) for j in jobs_real] + [(STATE_MASK, j) for j in jobs_mask]
+
+
+def count_transitions(steps):
+  '''Counts mask/unmask and environment image changes for render steps
+  :param steps: list of (state, RenderJob)
+  :returns (dict) number of "state" and "environment" transitions
+  '''
+  counts = {'state': 0, 'environment': 0}
+  state, env_idx = None, None
+  for step_state, job in steps:
+    if step_state != state:
+      counts['state'] += 1
+      state = step_state
+    if step_state == STATE_REAL and job.env_idx >= 0 and job.env_idx != env_idx:
+      counts['environment'] += 1
+      env_idx = job.env_idx
+  return counts
@@ -41,9 +41,19 @@ DIR_GENERATORS = join(DIR_CLI, 'app/blender/generators')
 
 # standardize Blender output files
 FN_METADATA = 'metadata.csv'  # filenamne
+FN_ANNOTATIONS = 'annotations.csv'  # filename
+FN_ANNOTATIONS_INDEX = 'annotations_index.json'  # filename, incremental builds
+FN_ANNOTATED_FRAMES = 'annotated_frames.txt'  # filename, frames annotated while rendering
+FN_MANIFEST = 'manifest.csv.gz'  # filename, precomputed render jobs
+FN_RENDER_QUALITY = 'render_quality.csv'  # filename, per-frame render settings
+FN_CUTOUTS = 'cutouts.csv'  # filename, cutout bank index
 DN_REAL = 'real'  # directory name
 DN_MASK = 'mask'  # directory name
+DN_INDEX = 'index'  # directory name, object index passes
 DN_COMP = 'comp'  # directory name
+DN_COMPOSITE = 'composite'  # directory name, renders composited onto background photos
+DN_CUTOUTS = 'cutouts'  # directory name, RGBA object cutouts
+VARIANT_SEP = '_v'  # real image background variant suffix, eg <mask stem>_v01.png
 
 
 # -----------------------------------------------------------------------------
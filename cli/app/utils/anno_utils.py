@@ -2,10 +2,15 @@
 Annotation utility helpers
 """
 
+import csv
+import os
+from pathlib import Path
+
 import numpy as np
 import cv2 as cv
 
 from app.models.bbox import BBoxNorm, BBoxDim
+from app.utils import farm_utils
 
 
 def color_mask_to_rect(im, color, non_zero_thresh=40):
@@ -30,6 +35,221 @@ def color_mask_to_rect(im, color, non_zero_thresh=40):
     return None
 
 
+def pack_colors(im):
+  '''Packs 3-channel uint8 pixels into one uint32 value per pixel
+  :param im: (numpy) uint8 image (h, w, 3) in any channel order
+  :returns (numpy) uint32 array (h, w)
+  '''
+  im_4c = cv.cvtColor(np.ascontiguousarray(im, dtype=np.uint8), cv.COLOR_BGR2BGRA)
+  return im_4c.view(np.uint32)[:, :, 0]
+
+
+def build_color_lut(colors):
+  '''Builds a sorted lookup table of packed colors to object ids
+  :param colors: list of uint8 color tuples in the channel order of the mask image.
+    The list index is the object id.
+  :returns (tuple) of sorted packed colors and their object ids
+  '''
+  colors = np.array(colors, dtype=np.uint8).reshape((-1, 1, 3))
+  packed = pack_colors(colors).ravel()
+  order = np.argsort(packed, kind='stable')
+  return (packed[order], order)
+
+
+def color_mask_to_labels(im, lut):
+  '''Decodes a color mask into an object id label map
+  :param im: (numpy) uint8 image in the channel order used to build the lut
+  :param lut: (tuple) color lookup table from build_color_lut
+  :returns (numpy) int32 label map (h, w) with -1 for unknown colors
+  '''
+  keys, ids = lut
+  packed = pack_colors(im)
+  idxs = np.minimum(np.searchsorted(keys, packed), len(keys) - 1)
+  return np.where(keys[idxs] == packed, ids[idxs], -1).astype(np.int32)
+
+
+def build_index_lut(pass_indices):
+  '''Builds a lookup table of object index pass values to object ids
+  :param pass_indices: list of object pass indices. The list index is the object id.
+  :returns (numpy) int32 array indexed by pass value, -1 for unknown values
+  '''
+  pass_indices = np.array(pass_indices, dtype=np.int64)
+  lut = np.full(max(pass_indices.max(initial=0) + 1, 2**16), -1, dtype=np.int32)
+  lut[pass_indices] = np.arange(len(pass_indices), dtype=np.int32)
+  return lut
+
+
+def index_mask_to_labels(im, lut):
+  '''Decodes an object index pass image into an object id label map
+  :param im: (numpy) uint16 single channel index image
+  :param lut: (numpy) index lookup table from build_index_lut
+  :returns (numpy) int32 label map (h, w) with -1 for unknown values
+  '''
+  return lut[im]
+
+
+def read_mask_labels(fp_mask, lut, width=0):
+  '''Reads a color mask or index pass image and decodes it into a label map
+  :param fp_mask: (str) path to mask image
+  :param lut: color lookup table from build_color_lut (BGR) or index lookup table
+    from build_index_lut
+  :param width: (int) width to resize mask to, or 0 for native resolution
+  :returns (numpy) int32 label map (h, w) with -1 for background
+  '''
+  index = isinstance(lut, np.ndarray)
+  im = cv.imread(fp_mask, cv.IMREAD_UNCHANGED if index else cv.IMREAD_COLOR)
+  if width:
+    scale = width / im.shape[1]
+    im = cv.resize(im, None, fx=scale, fy=scale, interpolation=cv.INTER_NEAREST)
+  if index:
+    return index_mask_to_labels(im if im.ndim == 2 else im[:, :, 0], lut)
+  return color_mask_to_labels(im, lut)
+
+
+def labels_to_stats(labels, n_labels):
+  '''Computes pixel count and bounds for every label in one pass
+  :param labels: (numpy) int label map (h, w) with -1 for background
+  :param n_labels: (int) number of labels
+  :returns (tuple) of arrays: ids, counts, x1, y1, x2, y2 (x2, y2 exclusive)
+  '''
+  w = labels.shape[1]
+  labels_flat = labels.ravel()
+  idxs_fg = np.flatnonzero(labels_flat >= 0)
+  ids_fg = labels_flat[idxs_fg]
+  counts = np.bincount(ids_fg, minlength=n_labels)
+  ids = np.flatnonzero(counts)
+  if not len(ids):
+    empty = np.zeros(0, dtype=np.int64)
+    return (empty, empty, empty, empty, empty, empty)
+  # stable radix sort groups pixels by label and keeps raster order within a label
+  dtype_sort = np.int16 if n_labels < np.iinfo(np.int16).max else np.int32
+  order = np.argsort(ids_fg.astype(dtype_sort), kind='stable')
+  ys, xs = np.divmod(idxs_fg[order], w)
+  starts = np.cumsum(counts[ids]) - counts[ids]
+  ends = starts + counts[ids] - 1
+  x1 = np.minimum.reduceat(xs, starts)
+  x2 = np.maximum.reduceat(xs, starts) + 1
+  y1 = ys[starts]
+  y2 = ys[ends] + 1
+  return (ids, counts[ids], x1, y1, x2, y2)
+
+
+def color_mask_to_rects(im, lut, n_labels, non_zero_thresh=40):
+  '''Converts all color mask areas to BBoxes in a single pass
+  :param im: (numpy) uint8 image in the channel order used to build the lut
+  :param lut: (tuple) color lookup table from build_color_lut
+  :param n_labels: (int) number of colors in the lut
+  :param non_zero_thresh: minimum number of non-zero pixels
+  :returns (list) of (object id, BBoxNorm, pixel count) tuples
+  '''
+  return labels_to_rects(color_mask_to_labels(im, lut), n_labels, non_zero_thresh)
+
+
+def labels_to_rects(labels, n_labels, non_zero_thresh=40):
+  '''Converts all label map areas to BBoxes in a single pass
+  :param labels: (numpy) int label map (h, w) with -1 for background
+  :param n_labels: (int) number of labels
+  :param non_zero_thresh: minimum number of non-zero pixels
+  :returns (list) of (object id, BBoxNorm, pixel count) tuples
+  '''
+  dim = labels.shape[:2][::-1]
+  ids, counts, x1s, y1s, x2s, y2s = labels_to_stats(labels, n_labels)
+  results = []
+  for idx, count, x1, y1, x2, y2 in zip(ids, counts, x1s, y1s, x2s, y2s):
+    if count > non_zero_thresh:
+      bbox_norm = BBoxDim(int(x1), int(y1), int(x2), int(y2), dim).as_bbox_norm()
+      results.append((int(idx), bbox_norm, int(count)))
+  return results
+
+
+def color_mask_to_instance_rects(im, lut, n_labels, min_area=40, connectivity=8):
+  '''Converts color mask areas to one BBox per connected component
+  :param im: (numpy) uint8 image in the channel order used to build the lut
+  :param lut: (tuple) color lookup table from build_color_lut
+  :param n_labels: (int) number of colors in the lut
+  :param min_area: minimum number of pixels per component
+  :param connectivity: (int) 4 or 8 pixel connectivity
+  :returns (list) of (object id, BBoxNorm, pixel count) tuples
+  '''
+  return labels_to_instance_rects(color_mask_to_labels(im, lut), n_labels, min_area, connectivity)
+
+
+def labels_to_instance_rects(labels, n_labels, min_area=40, connectivity=8):
+  '''Converts label map areas to one BBox per connected component
+  :param labels: (numpy) int label map (h, w) with -1 for background
+  :param n_labels: (int) number of labels
+  :param min_area: minimum number of pixels per component
+  :param connectivity: (int) 4 or 8 pixel connectivity
+  :returns (list) of (object id, BBoxNorm, pixel count) tuples
+  '''
+  dim = labels.shape[:2][::-1]
+  # label components of all colors at once
+  n_cc, im_cc = cv.connectedComponents((labels >= 0).view(np.uint8), 
+    connectivity=connectivity, ltype=cv.CV_32S)
+  # split components into (component, color) pairs
+  idxs_fg = np.flatnonzero(labels.ravel() >= 0)
+  pairs = (im_cc.ravel()[idxs_fg].astype(np.int64) - 1) * n_labels + labels.ravel()[idxs_fg]
+  pairs_uniq, pairs_inv = np.unique(pairs, return_inverse=True)
+  im_pairs = np.full(labels.shape, -1, dtype=np.int32)
+  im_pairs.ravel()[idxs_fg] = pairs_inv.ravel()
+  pair_ids, counts, x1s, y1s, x2s, y2s = labels_to_stats(im_pairs, len(pairs_uniq))
+  ccs, idxs = np.divmod(pairs_uniq[pair_ids], n_labels)
+  n_colors_cc = np.bincount(ccs, minlength=n_cc)
+  results = []
+  for cc, idx, count, x1, y1, x2, y2 in zip(ccs, idxs, counts, x1s, y1s, x2s, y2s):
+    if count < min_area:
+      continue
+    if n_colors_cc[cc] == 1:
+      xywh = (int(x1), int(y1), int(x2 - x1), int(y2 - y1))
+      stats = [(xywh, int(count))]
+    else:
+      # touching colors: relabel this color within its component and the pair bounds
+      im_bin = ((labels[y1:y2, x1:x2] == idx) & (im_cc[y1:y2, x1:x2] == cc + 1)).view(np.uint8)
+      _, _, cc_stats, _ = cv.connectedComponentsWithStats(im_bin, connectivity=connectivity)
+      stats = [((int(x1 + x), int(y1 + y), int(w), int(h)), int(area)) \
+        for x, y, w, h, area in cc_stats[1:]]
+    for xywh, area in stats:
+      if area >= min_area:
+        bbox_norm = BBoxDim.from_xywh_dim(xywh, dim).as_bbox_norm()
+        results.append((int(idx), bbox_norm, area))
+  return results
+
+
+def mask_file_to_annos(fp_mask, lut, objects, width=0, non_zero_thresh=40, instances=False):
+  '''Reads a color mask or index pass image and converts it to annotations
+  :param fp_mask: (str) path to mask image
+  :param lut: BGR color lookup table from build_color_lut, or index lookup table
+    from build_index_lut for 16-bit index pass images
+  :param objects: list of (label, label_index, color_hex) tuples per object id
+  :param width: (int) width to resize mask to, or 0 for native resolution
+  :param non_zero_thresh: minimum number of non-zero pixels
+  :param instances: (bool) one annotation per connected component instead of per color
+  :returns (list) of BBoxNormLabelColor
+  '''
+  labels = read_mask_labels(fp_mask, lut, width)
+  return labels_to_annos(labels, objects, Path(fp_mask).name, non_zero_thresh, instances)
+
+
+def labels_to_annos(labels, objects, filename, non_zero_thresh=40, instances=False):
+  '''Converts a label map to annotations
+  :param labels: (numpy) int label map (h, w) with -1 for background
+  :param objects: list of (label, label_index, color_hex) tuples per object id
+  :param filename: (str) image filename of the annotations
+  :param non_zero_thresh: minimum number of non-zero pixels
+  :param instances: (bool) one annotation per connected component instead of per color
+  :returns (list) of BBoxNormLabelColor
+  '''
+  if instances:
+    rects = labels_to_instance_rects(labels, len(objects), min_area=non_zero_thresh)
+  else:
+    rects = labels_to_rects(labels, len(objects), non_zero_thresh)
+  annos = []
+  for object_idx, bbox_norm, n_pixels in rects:
+    label, label_index, color_hex = objects[object_idx]
+    annos.append(bbox_norm.to_labeled(label, label_index, filename).to_colored(color_hex))
+  return annos
+
+
 # def fuzz_color(color):
 #   '''Adds/Sub one color value in every direction'
 #   :param color: color as uint8 (255,255,255)
@@ -48,3 +268,68 @@ def color_mask_to_rect(im, color, non_zero_thresh=40):
 #   colors.append([c[0], c[1], min(255, c[2] + 1)])  # R+1
 #   colors.append([min(255, x + 1) if x is not 0 else 0 for x in c])  # R+1
 #   return colors
+
+
+def read_annotated(fp_annotated):
+  '''Reads the filenames marked annotated while rendering
+  :param fp_annotated: (str) path to annotated frames file
+  :returns set of filenames
+  '''
+  if not Path(fp_annotated).exists():
+    return set()
+  with open(fp_annotated, 'r') as fp:
+    return set(fp.read().split())
+
+
+def load_annotated(fp_annos, fp_annotated, log=None):
+  '''Reads the frames annotated by a previous run and drops annotation rows
+  of frames that were interrupted before they were marked complete.
+  Rewrites fp_annos, only call it on files no other process appends to
+  :param fp_annos: (str) path to annotations CSV
+  :param fp_annotated: (str) path to annotated frames file
+  :param log: optional logger
+  :returns set of annotated filenames
+  '''
+  annotated = read_annotated(fp_annotated)
+  if not Path(fp_annotated).exists() and Path(fp_annos).exists():
+    # no frames marked, eg written by mask_to_bbox. Keep it out of the stream
+    fp_bak = f'{fp_annos}.bak'
+    if log:
+      log.warn(f'Moving existing annotations to {fp_bak}')
+    Path(fp_annos).replace(fp_bak)
+  if Path(fp_annos).exists():
+    with open(fp_annos, 'r', newline='') as fp:
+      reader = csv.DictReader(fp)
+      rows = list(reader)
+    rows_done = [r for r in rows if r['filename'] in annotated]
+    if len(rows_done) < len(rows):
+      fp_tmp = f'{fp_annos}.tmp'
+      with open(fp_tmp, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        writer.writerows(rows_done)
+      os.replace(fp_tmp, fp_annos)
+  return annotated
+
+
+def merge_annotations(fp_annos, fp_annotated, keys):
+  '''Merges per shard annotation files into the shared files after a render farm
+  finished. Rows are merged before their frames are marked, so an interrupted
+  merge leaves only unmarked rows that the next run drops
+  :param fp_annos: (str) path to shared annotations CSV
+  :param fp_annotated: (str) path to shared annotated frames file
+  :param keys: list of shard keys
+  :returns (int) number of frames merged
+  '''
+  n = 0
+  for key in keys:
+    fp_shard_annotated = farm_utils.shard_filepath(fp_annotated, key)
+    annotated = read_annotated(fp_shard_annotated)
+    farm_utils.merge_csv(fp_annos, [farm_utils.shard_filepath(fp_annos, key)], keep=annotated)
+    if annotated:
+      with open(fp_annotated, 'a') as fp:
+        fp.writelines(f'{fn}\n' for fn in sorted(annotated))
+    if Path(fp_shard_annotated).exists():
+      os.remove(fp_shard_annotated)
+    n += len(annotated)
+  return n
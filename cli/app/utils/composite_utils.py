@@ -0,0 +1,325 @@
+"""
+2D compositing of transparent renders and cutouts onto background photos
+- vectorized alpha blending with uint16 fixed-point math
+- box transforms follow the crop, scale and offset applied to the image
+- worker functions are module level so they can run in a process pool
+"""
+
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+from app.utils import anno_utils
+
+
+def alpha_bounds(alpha):
+  '''Returns the bounds of non-zero alpha as (x1, y1, x2, y2), or None if empty
+  :param alpha: (numpy) uint8 alpha channel (h, w)
+  '''
+  x, y, w, h = cv.boundingRect(cv.findNonZero(alpha)) if cv.countNonZero(alpha) else (0, 0, 0, 0)
+  return (x, y, x + w, y + h) if w and h else None
+
+
+def premultiply(im_bgr, alpha):
+  '''Returns BGR premultiplied by alpha
+  :param im_bgr: (numpy) uint8 (h, w, 3)
+  :param alpha: (numpy) uint8 (h, w)
+  '''
+  acc = im_bgr.astype(np.uint16) * alpha[:, :, None]
+  acc += 128  # round(x / 255) == (x + 128 + ((x + 128) >> 8)) >> 8
+  acc += acc >> 8
+  acc >>= 8
+  return acc.astype(np.uint8)
+
+
+def alpha_paste(im_dst, im_fg, alpha, x, y):
+  '''Pastes a premultiplied foreground over an image in place. The foreground
+  may extend past the image edges
+  :param im_dst: (numpy) uint8 BGR (h, w, 3), modified in place
+  :param im_fg: (numpy) uint8 premultiplied BGR (fh, fw, 3)
+  :param alpha: (numpy) uint8 alpha (fh, fw)
+  :param x: (int) left position of the foreground in im_dst
+  :param y: (int) top position of the foreground in im_dst
+  :returns im_dst
+  '''
+  h, w = im_dst.shape[:2]
+  fh, fw = alpha.shape[:2]
+  x1, y1, x2, y2 = max(x, 0), max(y, 0), min(x + fw, w), min(y + fh, h)
+  if x1 >= x2 or y1 >= y2:
+    return im_dst
+  roi = im_dst[y1:y2, x1:x2]
+  fg = im_fg[y1 - y:y2 - y, x1 - x:x2 - x]
+  a_inv = 255 - alpha[y1 - y:y2 - y, x1 - x:x2 - x, None]
+  # dst = fg + dst * (255 - a) / 255
+  acc = roi.astype(np.uint16) * a_inv
+  acc += 128
+  acc += acc >> 8
+  acc >>= 8
+  acc += fg
+  np.minimum(acc, 255, out=acc)
+  np.copyto(roi, acc, casting='unsafe')
+  return im_dst
+
+
+def color_jitter(im_bgr, rng, brightness=0.0, contrast=0.0, saturation=0.0):
+  '''Randomly changes brightness, contrast and saturation
+  :param im_bgr: (numpy) uint8 (h, w, 3)
+  :param rng: numpy.random.Generator
+  :param brightness: (float) max offset as fraction of 255
+  :param contrast: (float) max relative change of contrast
+  :param saturation: (float) max relative change of saturation
+  :returns (numpy) uint8 (h, w, 3)
+  '''
+  if not (brightness or contrast or saturation):
+    return im_bgr
+  im = im_bgr.astype(np.float32)
+  gray = im @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+  s = 1 + rng.uniform(-saturation, saturation)
+  c = 1 + rng.uniform(-contrast, contrast)
+  b = 255 * rng.uniform(-brightness, brightness)
+  im = gray[:, :, None] + s * (im - gray[:, :, None])
+  im = (im - gray.mean()) * c + gray.mean() + b
+  return np.clip(im, 0, 255).astype(np.uint8)
+
+
+def random_crop_resize(im, dim, rng):
+  '''Randomly crops the largest region with the aspect ratio of dim and resizes to dim
+  :param im: (numpy) image
+  :param dim: (int, int) output width and height
+  :param rng: numpy.random.Generator
+  '''
+  h, w = im.shape[:2]
+  dw, dh = dim
+  scale = min(w / dw, h / dh)
+  cw, ch = min(w, round(dw * scale)), min(h, round(dh * scale))
+  x, y = rng.integers(0, w - cw + 1), rng.integers(0, h - ch + 1)
+  im = im[y:y + ch, x:x + cw]
+  interpolation = cv.INTER_AREA if cw > dw else cv.INTER_LINEAR
+  return cv.resize(im, (dw, dh), interpolation=interpolation)
+
+
+def prepare_foreground(im_bgra, size, rng, jitter=(0, 0, 0), feather=0):
+  '''Color jitters, premultiplies and resizes a BGRA foreground for alpha_paste
+  :param im_bgra: (numpy) uint8 (h, w, 4)
+  :param size: (int, int) output width and height
+  :param rng: numpy.random.Generator
+  :param jitter: (float, float, float) brightness, contrast and saturation jitter
+  :param feather: (float) gaussian blur sigma in output pixels to soften hard mask edges
+  :returns (numpy) premultiplied BGR (sh, sw, 3) and alpha (sh, sw)
+  '''
+  h, w = im_bgra.shape[:2]
+  alpha = np.ascontiguousarray(im_bgra[:, :, 3])
+  im_rgb = color_jitter(np.ascontiguousarray(im_bgra[:, :, :3]), rng, *jitter)
+  # premultiply before resizing so transparent pixels don't darken edges
+  im_rgb = premultiply(im_rgb, alpha)
+  interpolation = cv.INTER_AREA if size[0] < w else cv.INTER_LINEAR
+  im_rgb = cv.resize(im_rgb, tuple(size), interpolation=interpolation)
+  alpha = cv.resize(alpha, tuple(size), interpolation=interpolation)
+  if feather:
+    # blur premultiplied color with alpha so it stays premultiplied
+    im_rgb = cv.GaussianBlur(im_rgb, (0, 0), feather)
+    alpha = cv.GaussianBlur(alpha, (0, 0), feather)
+  return im_rgb.reshape(size[1], size[0], 3), alpha
+
+
+def transform_boxes(xyxy, scale, offset, dim):
+  '''Applies a scale and offset to pixel boxes and normalizes them to an image
+  :param xyxy: (numpy) (n, 4) boxes in source pixels
+  :param scale: (float) source to output scale
+  :param offset: (int, int) output position of the source origin
+  :param dim: (int, int) output width and height
+  :returns (numpy) (n, 4) normalized boxes clipped to the image, and (n,) bool
+    mask of boxes with area left after clipping
+  '''
+  w, h = dim
+  xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4) * scale + np.tile(offset, 2)
+  xyxy = np.clip(xyxy / (w, h, w, h), 0, 1)
+  keep = (xyxy[:, 2] > xyxy[:, 0]) & (xyxy[:, 3] > xyxy[:, 1])
+  return xyxy, keep
+
+
+def read_rgba(fp):
+  '''Reads a BGRA image, or None if it has no alpha channel'''
+  im = cv.imread(fp, cv.IMREAD_UNCHANGED)
+  if im is None or im.ndim != 3 or im.shape[2] != 4:
+    return None
+  return im
+
+
+def composite_file(task):
+  '''Composites a transparent render onto a background photo and writes it
+  :param task: (dict) with keys
+    fp_fg: path to RGBA render
+    fp_bg: path to background photo
+    fp_out: output image path
+    annos: list of annotation dicts with normalized x1, y1, x2, y2 of the render
+    dim: (int, int) output size, or None for the render size
+    scale: (float, float) min and max foreground scale relative to fitting the output
+    jitter: (float, float, float) brightness, contrast and saturation jitter
+    seed: random seed
+  :returns list of annotation dicts for the output image
+  '''
+  rng = np.random.default_rng(task['seed'])
+  im_fg = read_rgba(task['fp_fg'])
+  if im_fg is None:
+    raise ValueError(f'No alpha channel: {task["fp_fg"]}. Render with render.film_transparent')
+  fh, fw = im_fg.shape[:2]
+  dim = tuple(task.get('dim') or (fw, fh))
+  im_out = random_crop_resize(cv.imread(task['fp_bg'], cv.IMREAD_COLOR), dim, rng)
+
+  # crop to the visible foreground so it can be placed anywhere in the output
+  bounds = alpha_bounds(np.ascontiguousarray(im_fg[:, :, 3]))
+  annos_out = []
+  if bounds is not None:
+    bx1, by1, bx2, by2 = bounds
+    im_fg = im_fg[by1:by2, bx1:bx2]
+    bw, bh = bx2 - bx1, by2 - by1
+    fit = min(dim[0] / bw, dim[1] / bh)
+    scale = min(fit, fit * rng.uniform(*task.get('scale', (1, 1))))
+    sw, sh = max(1, round(bw * scale)), max(1, round(bh * scale))
+    im_rgb, alpha = prepare_foreground(im_fg, (sw, sh), rng, task.get('jitter', (0, 0, 0)))
+    x = int(rng.integers(0, dim[0] - sw + 1))
+    y = int(rng.integers(0, dim[1] - sh + 1))
+    alpha_paste(im_out, im_rgb, alpha, x, y)
+
+    annos = task['annos']
+    if annos:
+      xyxy = np.array([[a['x1'], a['y1'], a['x2'], a['y2']] for a in annos]) * (fw, fh, fw, fh)
+      xyxy -= (bx1, by1, bx1, by1)
+      xyxy, keep = transform_boxes(xyxy, scale, (x, y), dim)
+      fn_out = Path(task['fp_out']).name
+      for anno, box, k in zip(annos, xyxy.tolist(), keep):
+        if k:
+          annos_out.append({**anno, 'x1': box[0], 'y1': box[1], 'x2': box[2], 'y2': box[3],
+            'filename': fn_out})
+
+  cv.imwrite(task['fp_out'], im_out)
+  return annos_out
+
+
+# ---------------------------------------------------------------------------
+#
+# Copy-paste cutouts
+#
+# ---------------------------------------------------------------------------
+
+def resize_labels(labels, dim):
+  '''Nearest neighbor resize of a label map
+  :param labels: (numpy) int32 label map (h, w)
+  :param dim: (int, int) output width and height
+  '''
+  h, w = labels.shape[:2]
+  if (w, h) == tuple(dim):
+    return labels
+  ys = np.arange(dim[1]) * h // dim[1]
+  xs = np.arange(dim[0]) * w // dim[0]
+  return labels[ys[:, None], xs[None, :]]
+
+
+def extract_cutouts(im_real, labels, n_labels, min_pixels=40, connectivity=8):
+  '''Cuts every object out of a real image, one cutout per connected component
+  of a label. Duplicates sharing a mask color become separate cutouts
+  :param im_real: (numpy) uint8 BGR (h, w, 3)
+  :param labels: (numpy) int32 label map (h, w) with -1 for background
+  :param n_labels: (int) number of labels
+  :param min_pixels: minimum number of visible pixels per object
+  :param connectivity: (int) 4 or 8 pixel connectivity
+  :returns (list) of (object id, BGRA crop, (x1, y1, x2, y2), pixel count)
+  '''
+  cutouts = []
+  for idx, count, lx1, ly1, lx2, ly2 in zip(*anno_utils.labels_to_stats(labels, n_labels)):
+    if count <= min_pixels:
+      continue
+    im_bin = (labels[ly1:ly2, lx1:lx2] == idx).view(np.uint8)
+    _, im_cc, cc_stats, _ = cv.connectedComponentsWithStats(im_bin, connectivity=connectivity)
+    for cc, (x, y, w, h, area) in enumerate(cc_stats[1:], 1):
+      if area <= min_pixels:
+        continue
+      x1, y1 = int(lx1 + x), int(ly1 + y)
+      alpha = (im_cc[y:y + h, x:x + w] == cc).view(np.uint8) * np.uint8(255)
+      im = np.dstack([im_real[y1:y1 + h, x1:x1 + w], alpha])
+      cutouts.append((int(idx), im, (x1, y1, x1 + int(w), y1 + int(h)), int(area)))
+  return cutouts
+
+
+def cutout_file(fps, dir_out, lut, objects, min_pixels=40, truncated=False):
+  '''Extracts object cutouts from a real and mask image pair and writes them as RGBA PNGs
+  :param fps: (str, str) paths to the real and mask images
+  :param dir_out: (str) cutout image directory
+  :param lut: BGR color lookup table from build_color_lut
+  :param objects: list of (label, label_index, color_hex) tuples per object id
+  :param min_pixels: minimum number of mask pixels per cutout
+  :param truncated: (bool) keep objects touching the image border
+  :returns (list) of cutout dicts with filename, label, label_index, color, width,
+    height, pixels, truncated, source
+  '''
+  fp_real, fp_mask = fps
+  im_real = cv.imread(fp_real, cv.IMREAD_COLOR)
+  h, w = im_real.shape[:2]
+  labels = anno_utils.read_mask_labels(fp_mask, lut)
+  # masks may be rendered at a lower resolution
+  scale = w / labels.shape[1]
+  labels = resize_labels(labels, (w, h))
+  min_pixels = max(1, round(min_pixels * scale ** 2))
+  rows = []
+  cutouts = extract_cutouts(im_real, labels, len(objects), min_pixels)
+  for n, (idx, im, (x1, y1, x2, y2), count) in enumerate(cutouts):
+    is_truncated = x1 == 0 or y1 == 0 or x2 == w or y2 == h
+    if is_truncated and not truncated:
+      continue
+    fn = f'{Path(fp_real).stem}_{idx:04d}_{n:03d}.png'
+    cv.imwrite(str(Path(dir_out) / fn), im)
+    label, label_index, color_hex = objects[idx]
+    rows.append({'filename': fn, 'label': label, 'label_index': label_index, 'color': color_hex,
+      'width': x2 - x1, 'height': y2 - y1, 'pixels': count, 'truncated': is_truncated,
+      'source': Path(fp_real).name})
+  return rows
+
+
+def paste_file(task):
+  '''Pastes cutouts onto a background photo and writes it. Boxes are computed from
+  the visible pixels of each cutout after all pastes, so occluded cutouts shrink or drop
+  :param task: (dict) with keys
+    fp_bg: path to background photo
+    fp_out: output image path
+    cutouts: list of (path to RGBA cutout, label, label_index, color) tuples
+    dim: (int, int) output size, or None for the background size
+    scale: (float, float) min and max cutout size relative to the shorter output side
+    jitter: (float, float, float) brightness, contrast and saturation jitter
+    feather: (float) edge blur sigma in pixels
+    min_pixels: minimum number of visible pixels per annotation
+    seed: random seed
+  :returns list of annotation dicts for the output image
+  '''
+  rng = np.random.default_rng(task['seed'])
+  im_out = cv.imread(task['fp_bg'], cv.IMREAD_COLOR)
+  if task.get('dim'):
+    im_out = random_crop_resize(im_out, task['dim'], rng)
+  h, w = im_out.shape[:2]
+  labels = np.full((h, w), -1, dtype=np.int32)
+  cutouts = task['cutouts']
+  for idx, (fp_cutout, *_) in enumerate(cutouts):
+    im_fg = read_rgba(fp_cutout)
+    fh, fw = im_fg.shape[:2]
+    size = min(w, h) * rng.uniform(*task.get('scale', (0.1, 0.3)))
+    scale = min(size / max(fw, fh), w / fw, h / fh)
+    sw, sh = max(1, round(fw * scale)), max(1, round(fh * scale))
+    im_rgb, alpha = prepare_foreground(im_fg, (sw, sh), rng, task.get('jitter', (0, 0, 0)),
+      task.get('feather', 0))
+    x, y = int(rng.integers(0, w - sw + 1)), int(rng.integers(0, h - sh + 1))
+    alpha_paste(im_out, im_rgb, alpha, x, y)
+    # later cutouts occlude earlier ones
+    labels[y:y + sh, x:x + sw][alpha > 127] = idx
+  cv.imwrite(task['fp_out'], im_out)
+
+  fn_out = Path(task['fp_out']).name
+  annos = []
+  ids, counts, x1s, y1s, x2s, y2s = anno_utils.labels_to_stats(labels, len(cutouts))
+  for idx, count, x1, y1, x2, y2 in zip(ids, counts, x1s, y1s, x2s, y2s):
+    if count <= task.get('min_pixels', 40):
+      continue
+    _, label, label_index, color = cutouts[idx]
+    annos.append({'x1': x1 / w, 'y1': y1 / h, 'x2': x2 / w, 'y2': y2 / h, 'label': label,
+      'label_index': label_index, 'filename': fn_out, 'color': color})
+  return annos
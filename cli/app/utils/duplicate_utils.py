@@ -0,0 +1,65 @@
+"""
+Duplicate object registry for particle make_real
+- indexes duplicates by the name of their source object using set and dict
+  lookups instead of list scans
+- no bpy imports, works on object names
+"""
+
+
+def name_stem(name):
+  '''Returns the source object name of a Blender duplicate name, eg "rock.012" -> "rock"
+  :param name: (str) object name
+  :returns (str) name without the last ".suffix"
+  '''
+  stem, sep, _ = name.rpartition('.')
+  return stem if sep and stem else name
+
+
+class DuplicateRegistry:
+  '''Maps source object names to the duplicates and meshes created from them'''
+
+  def __init__(self, base_names):
+    '''
+    :param base_names: list of source object names in the particle system
+    '''
+    self.base_names = list(base_names)
+    self._base_set = set(self.base_names)
+    self.clear()
+
+  def clear(self):
+    '''Forgets all registered duplicates'''
+    self.duplicates = {name: [] for name in self.base_names}
+    self.meshes = {name: [] for name in self.base_names}
+
+  def register_new(self, names_before, names_after):
+    '''Registers objects that exist after make_real but not before
+    :param names_before: iterable of object names before duplicating
+    :param names_after: list of object names after duplicating
+    :returns list of (base name, duplicate name, ordinal) in names_after order. The
+      ordinal is the position of the duplicate among the duplicates of its base name
+    '''
+    names_before = set(names_before)
+    matches = []
+    for name in names_after:
+      if name in names_before or name in self._base_set:
+        continue
+      base_name = name_stem(name)
+      if base_name in self._base_set:
+        matches.append((base_name, name, len(self.duplicates[base_name])))
+        self.duplicates[base_name].append(name)
+    return matches
+
+  def add_mesh(self, base_name, mesh_name):
+    self.meshes[base_name].append(mesh_name)
+
+  @property
+  def num_duplicates(self):
+    return sum(len(x) for x in self.duplicates.values())
+
+  def all_duplicates(self):
+    '''Returns all duplicate object names'''
+    return [name for names in self.duplicates.values() for name in names]
+
+  def all_meshes(self):
+    '''Returns all copied mesh names'''
+    return [name for names in self.meshes.values() for name in names]
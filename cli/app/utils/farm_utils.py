@@ -0,0 +1,238 @@
+"""
+Multi-process render farm utilities
+- splits an iteration range into shards and runs one Blender process per shard
+- each shard reports its next unrendered iteration to a progress file
+- each shard appends to its own CSV files, merged after the farm finishes
+"""
+
+import csv
+import os
+import subprocess
+import time
+from dataclasses import dataclass, field
+from os.path import join
+from pathlib import Path
+
+
+@dataclass
+class Shard:
+  '''One contiguous [start, end) range of generator iterations'''
+  idx: int
+  start: int
+  end: int
+  fp_log: str = ''
+  fp_progress: str = ''
+  restarts: int = 0
+  proc: subprocess.Popen = field(default=None, repr=False)
+  fh_log: object = field(default=None, repr=False)
+
+  @property
+  def size(self):
+    return self.end - self.start
+
+  @property
+  def done(self):
+    return read_progress(self.fp_progress, self.start) >= self.end
+
+  @property
+  def key(self):
+    return shard_key(self.fp_progress)
+
+
+def split_range(start, end, n_shards):
+  '''Splits [start, end) into contiguous, near equal ranges
+  :param start: (int) first iteration
+  :param end: (int) last iteration, exclusive
+  :param n_shards: (int) max number of shards
+  :returns list of (start, end) tuples, empty ranges removed
+  '''
+  n = max(0, end - start)
+  n_shards = max(1, min(n_shards, n))
+  q, r = divmod(n, n_shards)
+  ranges = []
+  for i in range(n_shards):
+    size = q + (1 if i < r else 0)
+    if size:
+      ranges.append((start, start + size))
+    start += size
+  return ranges
+
+
+def read_progress(fp, default):
+  '''Reads the next unrendered iteration written by a generator
+  :param fp: (str) path to progress file
+  :param default: (int) value if the file is missing or unreadable
+  :returns (int) next iteration
+  '''
+  try:
+    with open(fp, 'r') as f:
+      return int(f.read().strip())
+  except (OSError, ValueError):
+    return default
+
+
+def write_progress(fp, idx):
+  '''Atomically writes the next unrendered iteration
+  :param fp: (str) path to progress file
+  :param idx: (int) next iteration
+  '''
+  fp_tmp = f'{fp}.tmp'
+  with open(fp_tmp, 'w') as f:
+    f.write(str(idx))
+  os.replace(fp_tmp, fp)
+
+
+def shard_key(fp_progress):
+  '''Returns the shard name used in per shard output filenames. Derived from the
+  progress file so it is the same across restarts
+  :param fp_progress: (str) path to progress file
+  :returns (str) shard key
+  '''
+  return Path(fp_progress).stem
+
+
+def shard_filepath(fp, key):
+  '''Inserts the shard key before the extension, eg "render_quality.shard_000_0-20.csv"
+  :param fp: (str) path to shared output file
+  :param key: (str) shard key
+  :returns (str) path to the shard's output file
+  '''
+  p = Path(fp)
+  return str(p.with_name(f'{p.stem}.{key}{p.suffix}'))
+
+
+def merge_csv(fp_out, fps_in, keep=None):
+  '''Appends shard CSV files to the shared CSV file and removes them.
+  Only call once the shards stopped, shards never write the shared file
+  :param fp_out: (str) path to shared CSV file
+  :param fps_in: list of shard CSV paths, missing files are skipped
+  :param keep: (set) only merge rows with these filenames. Default merges all rows
+  :returns (int) number of rows merged
+  '''
+  n = 0
+  for fp_in in fps_in:
+    if not Path(fp_in).exists():
+      continue
+    with open(fp_in, 'r', newline='') as fp:
+      reader = csv.DictReader(fp)
+      rows = [r for r in reader if keep is None or r['filename'] in keep]
+      fieldnames = reader.fieldnames
+    if rows:
+      write_header = not Path(fp_out).exists() or Path(fp_out).stat().st_size == 0
+      with open(fp_out, 'a', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=fieldnames)
+        if write_header:
+          writer.writeheader()
+        writer.writerows(rows)
+      n += len(rows)
+    os.remove(fp_in)
+  return n
+
+
+def build_shards(start, end, n_shards, dir_logs):
+  '''Creates shards with per shard log and progress files
+  :param start: (int) first iteration
+  :param end: (int) last iteration, exclusive
+  :param n_shards: (int) number of shards
+  :param dir_logs: (str) directory for log and progress files
+  :returns list of Shard
+  '''
+  shards = []
+  for i, (s, e) in enumerate(split_range(start, end, n_shards)):
+    fn = f'shard_{i:03d}_{s}-{e}'
+    shards.append(Shard(i, s, e, fp_log=join(dir_logs, f'{fn}.log'),
+      fp_progress=join(dir_logs, f'{fn}.progress')))
+  return shards
+
+
+class RenderFarm:
+  '''Runs one subprocess per shard, restarts crashed shards from their progress file'''
+
+  def __init__(self, build_args, shards, max_restarts=3, poll=1.0, log=None):
+    '''
+    :param build_args: function(shard, checkpoint) returning the subprocess args list
+    :param shards: list of Shard
+    :param max_restarts: (int) restarts allowed per shard before giving up
+    :param poll: (float) seconds between status checks
+    :param log: logger
+    '''
+    self.build_args = build_args
+    self.shards = shards
+    self.max_restarts = max_restarts
+    self.poll = poll
+    self.log = log
+    self.failed = []
+
+  def _launch(self, shard):
+    checkpoint = read_progress(shard.fp_progress, shard.start)
+    args = self.build_args(shard, checkpoint)
+    shard.fh_log = open(shard.fp_log, 'a')
+    shard.fh_log.write(f'# launch {shard.restarts}: {" ".join(map(str, args))}\n')
+    shard.fh_log.flush()
+    shard.proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=shard.fh_log,
+      stderr=subprocess.STDOUT, shell=False)
+    if self.log:
+      self.log.debug(f'Shard {shard.idx} [{checkpoint}, {shard.end}) pid: {shard.proc.pid}')
+
+  def _close(self, shard):
+    if shard.fh_log:
+      shard.fh_log.close()
+      shard.fh_log = None
+    shard.proc = None
+
+  def completed(self):
+    '''Returns total number of iterations completed by all shards'''
+    return sum(min(read_progress(s.fp_progress, s.start), s.end) - s.start for s in self.shards)
+
+  def run(self, pbar=None):
+    '''Runs all shards to completion
+    :param pbar: optional tqdm progress bar, updated with aggregate progress
+    :returns (bool) True if every shard completed its range
+    '''
+    for shard in self.shards:
+      Path(shard.fp_log).parent.mkdir(parents=True, exist_ok=True)
+    pending = [s for s in self.shards if not s.done]
+    running = []
+    for shard in pending:
+      self._launch(shard)
+      running.append(shard)
+
+    n_last = self.completed()
+    if pbar is not None:
+      pbar.update(n_last)
+
+    try:
+      while running:
+        time.sleep(self.poll)
+        for shard in list(running):
+          rc = shard.proc.poll()
+          if rc is None:
+            continue
+          self._close(shard)
+          if shard.done:
+            running.remove(shard)
+          elif shard.restarts < self.max_restarts:
+            shard.restarts += 1
+            if self.log:
+              self.log.warn(f'Shard {shard.idx} exited with code {rc}. '
+                f'Restart {shard.restarts}/{self.max_restarts}, see {shard.fp_log}')
+            self._launch(shard)
+          else:
+            if self.log:
+              self.log.error(f'Shard {shard.idx} failed after {shard.restarts} restarts, '
+                f'see {shard.fp_log}')
+            running.remove(shard)
+            self.failed.append(shard)
+        n = self.completed()
+        if pbar is not None and n != n_last:
+          pbar.update(n - n_last)
+        n_last = n
+    finally:
+      # stop remaining processes if interrupted
+      for shard in running:
+        if shard.proc is not None:
+          shard.proc.terminate()
+          shard.proc.wait()
+          self._close(shard)
+
+    return not self.failed
@@ -0,0 +1,165 @@
+"""
+Camera frustum projection of object bounding boxes
+- projects world space bounding box corners through a perspective camera to
+  estimate how much of the image each object covers before rendering
+- projects mesh vertices to 2D boxes for annotation without a mask render
+- no bpy imports, cameras are described by their world matrix and lens
+"""
+
+import warnings
+
+import numpy as np
+
+
+def transform_points(matrices_world, points_local):
+  '''Transforms local points of one mesh by many object matrices
+  :param matrices_world: (numpy) (n, 4, 4) object world matrices
+  :param points_local: (numpy) (k, 3) local vertex coordinates
+  :returns (numpy) (n, k, 3) world space points
+  '''
+  matrices_world = np.asarray(matrices_world, dtype=np.float64).reshape(-1, 4, 4)
+  points_local = np.asarray(points_local, dtype=np.float64)
+  return np.einsum('nij,kj->nki', matrices_world[:, :3, :3], points_local) \
+    + matrices_world[:, None, :3, 3]
+
+
+def box_corners(matrices_world, bounds_local):
+  '''Transforms local bounding box corners to world space
+  :param matrices_world: (numpy) (n, 4, 4) object world matrices
+  :param bounds_local: (numpy) (n, 8, 3) local bounding box corners
+  :returns (numpy) (n, 8, 3) world space corners
+  '''
+  matrices_world = np.asarray(matrices_world, dtype=np.float64)
+  bounds_local = np.asarray(bounds_local, dtype=np.float64)
+  return np.einsum('nij,nkj->nki', matrices_world[:, :3, :3], bounds_local) \
+    + matrices_world[:, None, :3, 3]
+
+
+class CameraFrustum:
+  '''Perspective camera with automatic sensor fit, like Blender's default camera'''
+
+  def __init__(self, matrix_world, lens, sensor_width, resolution, shift=(0, 0)):
+    '''
+    :param matrix_world: 4x4 camera world matrix. The camera looks down its -Z axis
+    :param lens: (float) focal length mm
+    :param sensor_width: (float) sensor size mm, fit to the larger image dimension
+    :param resolution: (int, int) render width and height in pixels
+    :param shift: (float, float) lens shift in units of the larger image dimension.
+      Shifting the lens moves the view, so the scene moves the other way in the image
+    '''
+    self.view = np.linalg.inv(np.asarray(matrix_world, dtype=np.float64))
+    w, h = resolution
+    scale = lens / sensor_width
+    if w >= h:
+      self.scale = np.array([scale, scale * w / h])
+    else:
+      self.scale = np.array([scale * h / w, scale])
+    self.shift = np.array(shift, dtype=np.float64) * max(w, h) / np.array([w, h])
+
+
+  def project(self, points):
+    '''Projects world points to normalized image coordinates
+    :param points: (numpy) (..., 3) world space points
+    :returns (uv, depth): uv (..., 2) with (0, 0) bottom left and (1, 1) top right,
+      depth (...) distance in front of the camera, negative behind it
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    p_cam = points @ self.view[:3, :3].T + self.view[:3, 3]
+    depth = -p_cam[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      uv = 0.5 - self.shift + self.scale * p_cam[..., :2] / depth[..., None]
+    return uv, depth
+
+
+  def projected_areas(self, corners, near=1e-3):
+    '''Estimates the image fraction covered by each bounding box
+    :param corners: (numpy) (n, 8, 3) world space bounding box corners
+    :param near: (float) minimum depth of visible points
+    :returns (numpy) (n,) area of the clipped 2D box of the projected corners,
+      as a fraction of the image. Boxes crossing the camera plane count as 1
+    '''
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 8, 3)
+    if not len(corners):
+      return np.zeros(0)
+    uv, depth = self.project(corners)
+    in_front = depth > near
+    uv = np.where(in_front[..., None], uv, np.nan)
+    with warnings.catch_warnings():
+      # boxes entirely behind the camera have no valid corners
+      warnings.simplefilter('ignore', RuntimeWarning)
+      lo = np.clip(np.nanmin(uv, axis=1), 0, 1)
+      hi = np.clip(np.nanmax(uv, axis=1), 0, 1)
+    areas = np.nan_to_num(np.prod(hi - lo, axis=1))
+    # partly behind the camera: the projection is unbounded, assume visible
+    areas[in_front.any(axis=1) & ~in_front.all(axis=1)] = 1.0
+    return areas
+
+
+  def project_boxes(self, points, ids, n, near=1e-3, grid=None, tolerance=0.05):
+    '''Projects the points of n objects to 2D boxes in one vectorized step
+    :param points: (numpy) (k, 3) world space points, sorted by object id
+    :param ids: (numpy) (k,) object id of each point
+    :param n: (int) number of objects
+    :param near: (float) minimum depth of visible points. Boxes of objects crossing
+      the camera plane only cover their points in front of the camera
+    :param grid: (int, int) columns and rows of the coarse depth buffer, or None
+      to skip the occlusion check
+    :param tolerance: (float) relative depth difference that still counts as visible
+    :returns (boxes, in_view, visible): boxes (n, 4) normalized x1, y1, x2, y2 with
+      (0, 0) top left, clipped to the image, in_view (n,) bool boxes with area,
+      visible (n,) fraction of depth buffer cells where the object is nearest, or None
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    ids = np.asarray(ids, dtype=np.int64)
+    uv, depth = self.project(points)
+    front = depth > near
+    # image y points down
+    x, y = uv[:, 0], 1 - uv[:, 1]
+    counts = np.bincount(ids, minlength=n)
+    starts = (np.cumsum(counts) - counts)[counts > 0]
+    boxes = np.tile([np.inf, np.inf, -np.inf, -np.inf], (n, 1))
+    if len(starts):
+      for i, (v, reduce) in enumerate(((x, np.minimum), (y, np.minimum),
+        (x, np.maximum), (y, np.maximum))):
+        fill = np.inf if reduce is np.minimum else -np.inf
+        boxes[counts > 0, i] = reduce.reduceat(np.where(front, v, fill), starts)
+    boxes = np.clip(boxes, 0, 1)
+    in_view = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    visible = None
+    if grid is not None:
+      visible = depth_visibility(x, y, depth, ids, n, grid, front, tolerance)
+    return boxes, in_view, visible
+
+
+def depth_visibility(x, y, depth, ids, n, grid, valid, tolerance=0.05):
+  '''Estimates how much of each object is not hidden by the others with a
+  coarse depth buffer of projected points
+  :param x: (numpy) (k,) normalized image x of each point
+  :param y: (numpy) (k,) normalized image y of each point
+  :param depth: (numpy) (k,) depth of each point
+  :param ids: (numpy) (k,) object id of each point
+  :param n: (int) number of objects
+  :param grid: (int, int) columns and rows of the depth buffer
+  :param valid: (numpy) (k,) bool points in front of the camera
+  :param tolerance: (float) relative depth difference that still counts as visible
+  :returns (numpy) (n,) fraction of covered cells where the object is nearest,
+    0 for objects out of view
+  '''
+  cols, rows = grid
+  valid = valid & (x >= 0) & (x < 1) & (y >= 0) & (y < 1)
+  cells = (y[valid] * rows).astype(np.int64) * cols + (x[valid] * cols).astype(np.int64)
+  depth, ids = depth[valid], ids[valid]
+  n_cells = cols * rows
+  # nearest depth per object and cell, then per cell over all objects
+  keys = ids * n_cells + cells
+  keys_uniq, inv = np.unique(keys, return_inverse=True)
+  depth_obj = np.full(len(keys_uniq), np.inf)
+  np.minimum.at(depth_obj, inv.ravel(), depth)
+  ids_uniq, cells_uniq = np.divmod(keys_uniq, n_cells)
+  zbuffer = np.full(n_cells, np.inf)
+  np.minimum.at(zbuffer, cells_uniq, depth_obj)
+  nearest = depth_obj <= zbuffer[cells_uniq] * (1 + tolerance)
+  covered = np.bincount(ids_uniq, minlength=n)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    visible = np.bincount(ids_uniq, weights=nearest, minlength=n) / covered
+  return np.nan_to_num(visible)
@@ -51,6 +51,38 @@ def is_grayscale(im, threshold=5):
   return mean < threshold
 
 
+def blend_overlay(im, im_mask, bg_alpha=125, im_out=None):
+  """Composites a color mask over an image using uint8 fixed-point math.
+  Equivalent to blend_modes multiply then addition at 0.5 opacity, within +/-1.
+  Black mask pixels are keyed as background with alpha bg_alpha
+    :param im: Numpy.ndarray uint8 (BGR)
+    :param im_mask: Numpy.ndarray uint8 (BGR) color mask
+    :param bg_alpha: (int) 0-255 opacity of the keyed background
+    :param im_out: Numpy.ndarray uint8 output buffer. Can be im for in-place
+    :returns: Numpy.ndarray uint8 (BGR)
+  """
+  if im_out is None:
+    im_out = np.empty_like(im)
+  # background: im * (1 - bg_alpha / 510)
+  lut_bg = np.round(np.arange(256) * (510 - bg_alpha) / 510).astype(np.uint8)
+  im_bg = cv.LUT(im, lut_bg)
+  bg_idxs = (cv.inRange(im_mask, (0, 0, 0), (0, 0, 0)) > 0)[:, :, None]
+  # foreground: min(255, (im + im * mask / 255 + mask) / 2)
+  acc = im.astype(np.uint16)
+  acc *= im_mask
+  acc += 128  # round(x / 255) == (x + 128 + ((x + 128) >> 8)) >> 8
+  acc += acc >> 8
+  acc >>= 8
+  acc += im
+  acc += im_mask
+  acc += 1
+  acc >>= 1
+  np.minimum(acc, 255, out=acc)
+  np.copyto(im_out, acc, casting='unsafe')
+  np.copyto(im_out, im_bg, where=bg_idxs)
+  return im_out
+
+
 
 ############################################
 # imutils (external)
@@ -0,0 +1,79 @@
+"""
+Per-frame render time budget
+- adjusts Cycles samples or the adaptive sampling noise threshold from recent
+  render times to approach a target number of seconds per frame
+- no bpy imports, RenderManager applies the returned settings
+"""
+
+from collections import deque
+from dataclasses import dataclass
+import statistics
+
+
+MODE_SAMPLES = 'samples'
+MODE_THRESHOLD = 'threshold'
+
+
+@dataclass
+class RenderQuality:
+  '''Quality settings and time of one rendered frame'''
+  samples: int
+  adaptive_threshold: float
+  render_time: float
+
+
+def clamp(x, lo, hi):
+  return max(lo, min(x, hi))
+
+
+class RenderBudget:
+  '''Feedback controller for seconds per frame'''
+
+  def __init__(self, target, samples=(16, 1024), threshold=(0.005, 0.2),
+    mode=MODE_SAMPLES, window=5, gain=0.5):
+    '''
+    :param target: (float) target render seconds per frame
+    :param samples: (int, int) min and max samples
+    :param threshold: (float, float) min and max adaptive sampling noise threshold
+    :param mode: (str) "samples" scales the sample count, "threshold" scales the noise threshold
+    :param window: (int) number of recent frames to take the median of
+    :param gain: (float) 0-1, fraction of the correction applied per frame in threshold mode
+    '''
+    if mode not in (MODE_SAMPLES, MODE_THRESHOLD):
+      raise ValueError(f'Unknown budget mode: {mode}. Options: {MODE_SAMPLES}, {MODE_THRESHOLD}')
+    self.target = float(target)
+    self.samples_range = (int(samples[0]), int(samples[1]))
+    self.threshold_range = (float(threshold[0]), float(threshold[1]))
+    self.mode = mode
+    self.gain = gain
+    self.times = deque(maxlen=window)
+    self.costs = deque(maxlen=window)
+
+
+  @classmethod
+  def from_cfg(cls, cfg):
+    '''Creates a budget from the render.budget YAML block'''
+    return cls(cfg['target'], samples=cfg.get('samples', (16, 1024)),
+      threshold=cfg.get('threshold', (0.005, 0.2)), mode=cfg.get('mode', MODE_SAMPLES),
+      window=cfg.get('window', 5), gain=cfg.get('gain', 0.5))
+
+
+  def update(self, render_time, samples, threshold):
+    '''Records a render and returns settings for the next frame
+    :param render_time: (float) seconds the last frame took
+    :param samples: (int) samples used for the last frame
+    :param threshold: (float) noise threshold used for the last frame
+    :returns (int, float) samples and threshold for the next frame
+    '''
+    self.times.append(render_time)
+    self.costs.append(render_time / max(samples, 1))
+    if self.mode == MODE_SAMPLES:
+      # render time grows about linearly with samples
+      samples = round(self.target / statistics.median(self.costs))
+    else:
+      # a higher threshold stops sampling earlier
+      ratio = statistics.median(self.times) / self.target
+      threshold = threshold * ratio ** self.gain
+    samples = clamp(samples, *self.samples_range)
+    threshold = clamp(threshold, *self.threshold_range)
+    return samples, threshold
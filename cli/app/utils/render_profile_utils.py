@@ -0,0 +1,155 @@
+"""
+Named Cycles render profiles
+- maps short YAML setting names to scene attribute paths
+- applies a profile to a scene and restores the saved values on cleanup
+- no bpy imports, works on any object with the same attribute paths
+"""
+
+# YAML setting name: scene attribute path
+SETTINGS = {
+  'samples': 'cycles.samples',
+  'adaptive_sampling': 'cycles.use_adaptive_sampling',
+  'adaptive_threshold': 'cycles.adaptive_threshold',
+  'adaptive_min_samples': 'cycles.adaptive_min_samples',
+  'max_bounces': 'cycles.max_bounces',
+  'diffuse_bounces': 'cycles.diffuse_bounces',
+  'glossy_bounces': 'cycles.glossy_bounces',
+  'transmission_bounces': 'cycles.transmission_bounces',
+  'transparent_bounces': 'cycles.transparent_max_bounces',
+  'volume_bounces': 'cycles.volume_bounces',
+  'caustics': ['cycles.caustics_reflective', 'cycles.caustics_refractive'],
+  'denoise': 'cycles.use_denoising',
+  'denoiser': 'cycles.denoiser',
+  'persistent_data': 'render.use_persistent_data',
+  # 0 uses all cores
+  'threads': ['render.threads_mode', 'render.threads'],
+  # Cycles X has one tile size, older versions set x and y
+  'tile_size': ['cycles.tile_size', 'render.tile_x', 'render.tile_y'],
+}
+
+PROFILES = {
+  'draft': {
+    'samples': 32,
+    'adaptive_sampling': True,
+    'adaptive_threshold': 0.1,
+    'adaptive_min_samples': 0,
+    'max_bounces': 4,
+    'diffuse_bounces': 2,
+    'glossy_bounces': 2,
+    'transmission_bounces': 2,
+    'transparent_bounces': 4,
+    'volume_bounces': 0,
+    'caustics': False,
+    'denoise': True,
+    'persistent_data': True,
+  },
+  'production': {
+    'samples': 256,
+    'adaptive_sampling': True,
+    'adaptive_threshold': 0.01,
+    'adaptive_min_samples': 0,
+    'max_bounces': 12,
+    'diffuse_bounces': 4,
+    'glossy_bounces': 4,
+    'transmission_bounces': 12,
+    'transparent_bounces': 8,
+    'volume_bounces': 0,
+    'caustics': False,
+    'denoise': True,
+    'persistent_data': True,
+  },
+}
+
+
+def get_attr(obj, path):
+  for name in path.split('.'):
+    obj = getattr(obj, name)
+  return obj
+
+
+def has_attr(obj, path):
+  try:
+    get_attr(obj, path)
+    return True
+  except AttributeError:
+    return False
+
+
+def set_attr(obj, path, value):
+  owner, _, name = path.rpartition('.')
+  setattr(get_attr(obj, owner) if owner else obj, name, value)
+
+
+def expand_setting(key, value):
+  '''Expands one YAML setting into (attribute path, value) pairs
+  :param key: (str) setting name in SETTINGS
+  :param value: setting value
+  :returns list of (path, value)
+  '''
+  paths = SETTINGS[key]
+  if key == 'threads':
+    return [(paths[0], 'FIXED' if value else 'AUTO')] + ([(paths[1], int(value))] if value else [])
+  if isinstance(paths, str):
+    return [(paths, value)]
+  return [(path, value) for path in paths]
+
+
+class RenderProfile:
+  '''Named set of Cycles settings'''
+
+  def __init__(self, name, settings=None):
+    '''
+    :param name: (str) profile name. Built-in profiles are "draft" and "production"
+    :param settings: (dict) settings overriding the built-in profile of this name,
+      or None if the config has no profile of this name
+    '''
+    if name not in PROFILES and settings is None:
+      raise ValueError(f'Unknown render profile: "{name}". Options: {list(PROFILES.keys())} '
+        'or a name in render.profiles')
+    self.name = name
+    self.settings = dict(PROFILES.get(name, {}))
+    self.settings.update(settings or {})
+    unknown = [k for k in self.settings.keys() if k not in SETTINGS]
+    if unknown:
+      raise ValueError(f'Unknown render profile settings: {unknown}. Options: {list(SETTINGS.keys())}')
+    self.defaults = None
+
+
+  def apply(self, scene):
+    '''Applies the profile, saving current values. Settings missing in this
+    Blender version are skipped
+    :param scene: bpy scene
+    :returns list of setting names that were skipped
+    '''
+    defaults = self.defaults if self.defaults is not None else []
+    skipped = []
+    for key, value in self.settings.items():
+      pairs = [(p, v) for p, v in expand_setting(key, value) if has_attr(scene, p)]
+      if not pairs:
+        skipped.append(key)
+      for path, v in pairs:
+        if self.defaults is None:
+          defaults.append((path, get_attr(scene, path)))
+        set_attr(scene, path, v)
+    self.defaults = defaults
+    return skipped
+
+
+  def restore(self, scene):
+    '''Restores the values saved by apply'''
+    # reversed so threads_mode is restored after threads
+    for path, value in reversed(self.defaults or []):
+      set_attr(scene, path, value)
+    self.defaults = None
+
+
+  def summary(self, scene=None):
+    '''Returns settings as a compact string, read from the scene if given'''
+    if scene is None:
+      return ', '.join(f'{k}={v}' for k, v in self.settings.items())
+    values = []
+    for key in self.settings.keys():
+      paths = [p for p, _ in expand_setting(key, self.settings[key]) if has_attr(scene, p)]
+      if paths:
+        values.append(f'{key}={get_attr(scene, paths[-1])}')
+    return ', '.join(values)
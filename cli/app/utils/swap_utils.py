@@ -0,0 +1,79 @@
+"""
+Material swap tables for mask/unmask
+- resolves object and material datablocks once, then masks and unmasks by
+  assigning from flat tables instead of looking up names every frame
+- no bpy imports, tables hold whatever handles they are given
+"""
+
+
+class MaterialSwapTable:
+  '''Flat tables of material assignments for the real and mask states'''
+
+  STATE_REAL = 'real'
+  STATE_MASK = 'mask'
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    '''Drops all handles. Call before removing any object in the table'''
+    # material slots
+    self.slots = []
+    self.slots_real = []
+    self.slots_mask = []
+    # objects without material slots get their active material assigned
+    self.objects = []
+    self.objects_real = []
+    self.objects_mask = []
+    # object colors, read by object color fill materials and Workbench object color
+    self.colors = []
+    self.colors_real = []
+    self.colors_mask = []
+    self.state = None
+
+  def __len__(self):
+    return len(self.slots) + len(self.objects)
+
+  def add(self, obj, materials_real, material_mask, color_mask=None):
+    '''Adds all material slots of an object
+    :param obj: object handle
+    :param materials_real: list of material handles per slot for the real state
+    :param material_mask: material handle for every slot in the mask state
+    :param color_mask: RGBA object color for the mask state. The current object
+      color is restored in the real state
+    '''
+    slots = list(obj.material_slots)
+    if slots:
+      for idx, slot in enumerate(slots):
+        self.slots.append(slot)
+        self.slots_real.append(materials_real[idx] if idx < len(materials_real) else None)
+        self.slots_mask.append(material_mask)
+    else:
+      self.objects.append(obj)
+      self.objects_real.append(materials_real[0] if materials_real else None)
+      self.objects_mask.append(material_mask)
+    if color_mask is not None:
+      self.colors.append(obj)
+      self.colors_real.append(tuple(obj.color))
+      self.colors_mask.append(tuple(color_mask))
+    self.state = None
+
+  def _apply(self, slot_materials, object_materials, object_colors):
+    for slot, material in zip(self.slots, slot_materials):
+      slot.material = material
+    for obj, material in zip(self.objects, object_materials):
+      obj.active_material = material
+    for obj, color in zip(self.colors, object_colors):
+      obj.color = color
+
+  def mask(self, force=False):
+    '''Assigns mask materials. No-op if already masked'''
+    if self.state != self.STATE_MASK or force:
+      self._apply(self.slots_mask, self.objects_mask, self.colors_mask)
+      self.state = self.STATE_MASK
+
+  def unmask(self, force=False):
+    '''Assigns real materials. No-op if already unmasked'''
+    if self.state != self.STATE_REAL or force:
+      self._apply(self.slots_real, self.objects_real, self.colors_real)
+      self.state = self.STATE_REAL
@@ -1,6 +1,10 @@
 """Sytem utilities"""
 
+import os
+import sys
 import signal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 class SignalInterrupt:
@@ -16,4 +20,23 @@ class SignalInterrupt:
   def check(self):
   	if self.interrupted:
   		sys.exit('Exiting. Signal interrupted')
-  
\ No newline at end of file
+
+
+def imap_threaded(fn, items, workers=None, prefetch=None):
+  '''Maps a function over items in a thread pool and yields results in order
+  :param fn: function to apply to each item
+  :param items: iterable of items
+  :param workers: (int) number of threads. Default is number of CPUs
+  :param prefetch: (int) max results computed ahead of the consumer. Default 2x workers
+  :returns generator of results in the same order as items
+  '''
+  workers = workers or os.cpu_count()
+  prefetch = max(1, prefetch or 2 * workers)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = deque()
+    for item in items:
+      futures.append(pool.submit(fn, item))
+      if len(futures) >= prefetch:
+        yield futures.popleft().result()
+    while futures:
+      yield futures.popleft().result()
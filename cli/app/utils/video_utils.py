@@ -0,0 +1,121 @@
+"""
+Video and animated GIF encoding utilities
+"""
+import shutil
+import subprocess
+
+import cv2 as cv
+import numpy as np
+from PIL import Image, GifImagePlugin
+
+
+def get_ffmpeg_exe():
+  '''Returns path to ffmpeg binary, preferring the one bundled with imageio-ffmpeg'''
+  try:
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+  except Exception:
+    return shutil.which('ffmpeg') or 'ffmpeg'
+
+
+class FFmpegWriter:
+  '''Writes frames in index order to an ffmpeg subprocess over a raw video pipe'''
+
+  def __init__(self, fp_out, size, fps, codec='libx264', bitrate=None, pix_fmt='yuv420p'):
+    '''
+    :param fp_out: (str) path to output video
+    :param size: (tuple) width, height of frames
+    :param fps: (int) frames per second
+    :param codec: (str) ffmpeg video codec
+    :param bitrate: (str) ffmpeg bitrate, eg "16M"
+    :param pix_fmt: (str) output pixel format
+    '''
+    self.size = tuple(size)
+    w, h = self.size
+    args = [get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+      '-f', 'rawvideo', '-vcodec', 'rawvideo', '-pix_fmt', 'bgr24',
+      '-s', f'{w}x{h}', '-r', str(fps), '-i', '-', '-an', '-vcodec', codec]
+    if bitrate:
+      args += ['-b:v', str(bitrate)]
+    # yuv420p requires even dimensions
+    args += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', pix_fmt, str(fp_out)]
+    self.proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+  def write(self, im):
+    '''Writes the next frame
+    :param im: (numpy) uint8 BGR image. Resized if it does not match the video size
+    '''
+    if im.shape[:2][::-1] != self.size:
+      im = cv.resize(im, self.size, interpolation=cv.INTER_AREA)
+    self.proc.stdin.write(np.ascontiguousarray(im, dtype=np.uint8).data)
+
+  def close(self):
+    '''Flushes remaining frames and waits for the encoder to finish'''
+    self.proc.stdin.close()
+    if self.proc.wait():
+      raise IOError(f'ffmpeg exited with code {self.proc.returncode}')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def build_gif_palette(ims, n_colors=256):
+  '''Builds one global palette from a sample of frames
+  :param ims: list of PIL.Image RGB frames
+  :param n_colors: (int) number of palette colors, max 256
+  :returns (PIL.Image) "P" mode image holding the palette
+  '''
+  w = max(im.size[0] for im in ims)
+  h = sum(im.size[1] for im in ims)
+  im_tiles = Image.new('RGB', (w, h))
+  y = 0
+  for im in ims:
+    im_tiles.paste(im.convert('RGB'), (0, y))
+    y += im.size[1]
+  return im_tiles.quantize(colors=n_colors, method=Image.MEDIANCUT)
+
+
+class GifWriter:
+  '''Writes frames to an animated GIF one at a time using a global palette'''
+
+  def __init__(self, fp_out, im_palette, fps, loop=0, dither=False):
+    '''
+    :param fp_out: (str) path to output GIF
+    :param im_palette: (PIL.Image) "P" mode image holding the global palette
+    :param fps: (int) frames per second
+    :param loop: (int) number of loops, 0 is forever
+    :param dither: (bool) Floyd-Steinberg dither frames. Disable for annotation masks
+    '''
+    self.im_palette = im_palette
+    self.duration = int(round(1000 / fps))  # milliseconds
+    self.loop = loop
+    self.dither = Image.FLOYDSTEINBERG if dither else Image.NONE
+    self.num_frames = 0
+    self.fp = open(fp_out, 'wb')
+
+  def write(self, im):
+    '''Quantizes and writes the next frame
+    :param im: (PIL.Image) RGB frame
+    '''
+    im_p = im.convert('RGB').quantize(palette=self.im_palette, dither=self.dither)
+    if not self.num_frames:
+      header, _ = GifImagePlugin.getheader(im_p, info={'loop': self.loop})
+      for chunk in header:
+        self.fp.write(chunk)
+    for chunk in GifImagePlugin.getdata(im_p, duration=self.duration):
+      self.fp.write(chunk)
+    self.num_frames += 1
+
+  def close(self):
+    '''Writes the GIF trailer'''
+    self.fp.write(b';')
+    self.fp.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()